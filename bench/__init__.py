@@ -0,0 +1 @@
+'''性能测试，在仓库根目录用 python -m bench.xxx 运行，加 --json 输出机器可读的结果'''
@@ -0,0 +1,41 @@
+import json
+import sys
+import time
+
+
+def timeit(fn,*args,repeat:int = 5,min_time:float = 0.2) -> dict:
+    '''对fn(*args)计时，自动选择循环次数，返回最好的一轮'''
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(number):
+            fn(*args)
+        cost = time.perf_counter() - start
+        if cost >= min_time / repeat or number >= 1 << 24:
+            break
+        number *= 2
+    best = cost
+    for _ in range(repeat - 1):
+        start = time.perf_counter()
+        for _ in range(number):
+            fn(*args)
+        best = min(best,time.perf_counter() - start)
+    return {
+        "ns_per_op":best / number * 1e9,
+        "ops_per_sec":number / best,
+    }
+
+
+def report(title:str,results:list) -> None:
+    '''results是dict列表，每项至少有name和ns_per_op，可以带baseline(基准的ns_per_op)
+        不是计时的结果用value和unit代替ns_per_op，baseline同样是基准的value'''
+    if "--json" in sys.argv:
+        print(json.dumps({"bench":title,"results":results},ensure_ascii=False))
+        return
+    print("==== {} ====".format(title))
+    for it in results:
+        value = it.get("value",it.get("ns_per_op"))
+        line = "{:<48} {:>12.0f} {}".format(it["name"],value,it.get("unit","ns/op"))
+        if it.get("baseline"):
+            line += "   x{:.2f}".format(it["baseline"] / value)
+        print(line)
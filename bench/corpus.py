@@ -0,0 +1,129 @@
+'''性能测试用的样本数据，尽量贴近各平台真实的帧'''
+import json
+
+ONEBOT_GROUP_MSG = json.dumps({
+    "time":1700000000,"self_id":10001,"post_type":"message","message_type":"group","sub_type":"normal",
+    "message_id":-2147483000,"group_id":123456789,"user_id":20002,"anonymous":None,"font":0,
+    "message":"[CQ:at,qq=10001] 今天的天气怎么样？&#91;测试&#93; [CQ:image,file=abc.image,url=https://gchat.qpic.cn/gchatpic_new/1/2-3-ABCDEF/0?term=2]",
+    "raw_message":"[CQ:at,qq=10001] 今天的天气怎么样？",
+    "sender":{"user_id":20002,"nickname":"某人","card":"群名片","sex":"unknown","age":0,"area":"","level":"1","role":"member","title":""}
+},ensure_ascii=False)
+
+KOOK_GROUP_MSG = json.dumps({"s":0,"sn":42,"d":{
+    "channel_type":"GROUP","type":9,"target_id":"5432109876543210","author_id":"1234567890",
+    "content":"(met)2418200000(met) 你好\\*世界\\* 这是一条 \\[kmarkdown\\] 消息","msg_id":"0a1b2c3d-4e5f-6789-abcd-ef0123456789",
+    "msg_timestamp":1700000000000,"nonce":"","from_type":1,
+    "extra":{"type":9,"code":"","guild_id":"1111222233334444","guild_type":0,"channel_name":"闲聊","mention":["2418200000"],
+        "mention_no_permission":[],"mention_roles":[],"mention_all":False,"mention_here":False,"nav_channels":[],
+        "author":{"id":"1234567890","username":"某人","identify_num":"1234","online":True,"os":"Websocket",
+            "status":1,"avatar":"https://img.kookapp.cn/avatars/2021-01/abc.png","vip_avatar":"","banner":"","nickname":"某人",
+            "roles":[5,3,12],"is_vip":False,"vip_amp":False,"bot":False,"is_sys":False}},
+    "kmarkdown":{"raw_content":"@机器人 你好*世界*","mention_part":[],"mention_role_part":[],"channel_part":[]}}},ensure_ascii=False)
+
+QQ_CHANNEL_MSG = json.dumps({"op":0,"s":7,"t":"AT_MESSAGE_CREATE","id":"AT_MESSAGE_CREATE:abcdef","d":{
+    "author":{"avatar":"https://thirdqq.qlogo.cn/0","bot":False,"id":"144115218676400000","username":"某人"},
+    "channel_id":"1234567","content":"<@!11111111111111111> 你好 &lt;世界&gt;","guild_id":"98765432109876543",
+    "id":"08a1b2c3d4e5f6a7b8c910d4a0a51a38b9014800ad9a0c6b0","member":{"joined_at":"2023-01-01T12:00:00+08:00","nick":"群昵称","roles":["4","1"]},
+    "mentions":[{"avatar":"","bot":True,"id":"11111111111111111","username":"机器人"}],"seq":55,"seq_in_channel":"55",
+    "timestamp":"2023-11-15T06:13:20+08:00"}},ensure_ascii=False)
+
+MIHOYO_CONTENT = json.dumps({
+    "content":{"text":"@机器人 你好 😀 这是测试消息 @某人 ","entities":[
+        {"offset":0,"length":4,"entity":{"type":"mentioned_robot","bot_id":"bot_abcdef"}},
+        {"offset":20,"length":4,"entity":{"type":"mentioned_user","user_id":"12345"}}]},
+    "user":{"portraitUri":"https://bbs-static.miyoushe.com/avatar/1.png","extra":json.dumps({"member_roles":{"name":"成员"}}),
+        "name":"某人","alias":"","id":"12345","portrait":"https://bbs-static.miyoushe.com/avatar/1.png"}
+},ensure_ascii=False)
+
+# 网关收到的原始帧，按适配器分类
+GATEWAY_FRAMES = {
+    "onebot":ONEBOT_GROUP_MSG,
+    "kook":KOOK_GROUP_MSG,
+    "qq":QQ_CHANNEL_MSG,
+    "mihoyo":MIHOYO_CONTENT,
+}
+
+# 转换后的satori事件
+SATORI_EVENT = {
+    "id":1,"type":"message-created","platform":"kook","self_id":"2418200000","timestamp":1700000000000,
+    "channel":{"id":"GROUP_5432109876543210","type":0,"name":"闲聊","parent_id":None},
+    "message":{"id":"0a1b2c3d-4e5f-6789-abcd-ef0123456789","content":"<at id=\"2418200000\"/> 你好*世界*","channel":None,
+        "guild":None,"member":None,"user":None,"created_at":1700000000000,"updated_at":None},
+    "user":{"id":"1234567890","name":"某人","nick":"某人","avatar":"https://img.kookapp.cn/avatars/2021-01/abc.png","is_bot":False},
+    "guild":{"id":"1111222233334444","name":None,"avatar":None},
+    "member":{"user":None,"nick":"某人","avatar":"https://img.kookapp.cn/avatars/2021-01/abc.png","joined_at":None},
+    "role":{"id":"[3, 5, 12]","name":None},
+}
+
+# 待发送的satori消息，覆盖常见的几种消息
+SATORI_MESSAGES = {
+    "short":"你好",
+    "long":"这是一条比较长的纯文本消息，用来模拟公告或者帮助信息。" * 40,
+    "escaped":"if a &lt; b &amp;&amp; c &gt; d then &quot;ok&quot;" * 10,
+    "mention":"<at id=\"10001\"/> 早上好 <at id=\"10002\"/><at id=\"10003\"/> 开会了 <at type=\"all\"/>",
+    "image":"看图：<img src=\"https://example.com/banner.png?size=large&amp;v=2\"/>",
+    "mixed":"<passive id=\"abc123\"/><at id=\"10001\"/> 今天的运势：大吉 🎉🎉 <img src=\"https://example.com/a.png\"/>后续文字",
+    "emoji":"😀😃😄😁😆😅😂🤣🥲☺️😊😇🙂🙃😉😌😍🥰😘😗😙😚😋😛😝😜🤪🤨🧐🤓😎🥸🤩🥳" * 5,
+}
+
+# onebot收到的字符串格式消息，后几条是不规范的CQ码，会走逐字符的慢路径
+CQ_MESSAGES = {
+    "plain":"今天晚上吃什么",
+    "long":"群公告：本群禁止发广告，违者踢出。" * 60,
+    "at":"[CQ:at,qq=10001] [CQ:at,qq=10002] 来开黑 [CQ:at,qq=all]",
+    "image":"[CQ:image,file=abc.image,url=https://gchat.qpic.cn/gchatpic_new/1/2-3-ABC/0?term=2&amp;is_origin=0]看看这个",
+    "escaped":"数组写法 a&#91;0&#93; &amp;&amp; b&#91;1&#93;，参数里的[CQ:share,url=https://a.com/?x=1&#44;2,title=&#91;分享&#93;]" * 5,
+    "mixed":("[CQ:reply,id=123][CQ:at,qq=10001] 好的[CQ:face,id=178]"
+             "[CQ:image,file=a.jpg,url=https://example.com/a.jpg,subType=0]收到") * 8,
+    "no_param":"表情[CQ:shake]结束",
+    "unclosed":"前面的文字[CQ:at,qq=10001",
+    "bad_key":"[CQ:at,q]q=1]后面",
+}
+
+# 几KB的长消息，用于比较各平台转义的速度
+LONG_TEXTS = {
+    "cjk":"这是一条很长的群公告，请大家仔细阅读并遵守群规，谢谢配合。" * 100,
+    "markup":"if (a < b && c > d) { arr[i] = \"x\"; } // *重点* ~删除~ `代码` - 列表 > 引用 \\ " * 60,
+    "emoji":"今天天气真好😀🎉🔥，出去玩吗？👍👍" * 120,
+}
+
+# 各个消息转换函数共用的语料，("at",id)是提及某人，("all",)是提及全体成员，字符串是普通文本
+# 由bench.transcoders渲染成各平台的格式，同一条语料在各平台的内容相同
+TRANSCODER_MESSAGES = {
+    "short":["早上好！"],
+    "long":["群公告：请大家遵守群规，a < b && c > d 时 *重点* 内容见 [置顶]，谢谢配合。" * 60],
+    "mention":[seg for i in range(20) for seg in (("at",str(10000 + i)),"收到 ")] + [("all",)," 十分钟后开会"],
+    "emoji":[("at","10001")," " + "😀😃😄😁😆😅😂🤣🥰😍" * 20 + " 好耶 ",("at","10002")," " + "🎉🎉🔥👍" * 10],
+}
+
+
+def qq_event_stream(count:int = 500) -> list:
+    '''模拟qq网关收到的一段事件(AT_MESSAGE_CREATE和GROUP_AT_MESSAGE_CREATE)，结果固定
+        和真实的流一样，少数成员反复发言，joined_at和roles重复出现'''
+    members = [{
+        "author":{"avatar":"https://thirdqq.qlogo.cn/{}".format(i),"bot":False,"id":str(144115218676400000 + i),"username":"成员{}".format(i)},
+        "member":{"joined_at":"2023-0{}-0{}T12:00:00+08:00".format(i % 9 + 1,i % 7 + 1),"nick":"群昵称{}".format(i),"roles":[["4","1"],["1"],["2","5","1"]][i % 3]},
+    } for i in range(12)]
+    contents = [
+        "<@!11111111111111111> 签到",
+        "<@!11111111111111111> 查询 &lt;角色名&gt; 的战绩",
+        "<@!11111111111111111> " + "今天的活动大家记得参加，奖励很丰厚。" * 8,
+        "<@!11111111111111111> <emoji:4> 早上好 <@!144115218676400003>",
+        "<@!11111111111111111> a &amp; b &lt;c&gt;",
+    ]
+    stream = []
+    for i in range(count):
+        who = members[(i * 7) % len(members)]
+        timestamp = "2023-11-15T{:02d}:{:02d}:{:02d}+08:00".format(6 + i // 3600,i // 60 % 60,i % 60)
+        if i % 5 == 4:
+            stream.append({"t":"GROUP_AT_MESSAGE_CREATE","d":{
+                "author":{"id":"E4F1A2B3C4D5E6F7A8B9C0D1E2F3A4B{}".format(i % 12)},
+                "content":" " + contents[i % len(contents)].split(" ",1)[1],
+                "group_id":"C9F778FE6ADF9D1D1DBE395BF744A33A","id":"ROBOT1.0_{}".format(i),
+                "timestamp":timestamp}})
+        else:
+            stream.append({"t":"AT_MESSAGE_CREATE","d":{
+                **who,"channel_id":"1234567","content":contents[i % len(contents)],"guild_id":"98765432109876543",
+                "id":"08a1b2c3d4e5f6a7b8c910d4a0a51a38b9014800ad9a0c6b{}".format(i),"seq":i,"seq_in_channel":str(i),
+                "timestamp":timestamp}})
+    return stream
@@ -0,0 +1,51 @@
+'''onebot CQ码编解码：先检查和旧的逐字符实现结果完全一致，再比较速度'''
+import random
+
+import escape
+import onebot_adapter
+from bench import legacy
+from bench.common import report, timeit
+from bench.corpus import CQ_MESSAGES
+
+
+def _random_cq(rng:random.Random) -> str:
+    # 由容易出错的片段随机拼接，覆盖转义、不完整的CQ码等情况
+    parts = ["[CQ:","at",",","qq=","=","]","[","&amp;","&#91;","&#93;","&#44;","&","&#9","文字","a"," "]
+    return "".join(rng.choice(parts) for _ in range(rng.randint(0,30)))
+
+
+def check_parity() -> int:
+    rng = random.Random(0)
+    samples = list(CQ_MESSAGES.values()) + [_random_cq(rng) for _ in range(20000)]
+    for text in samples:
+        want = onebot_adapter._cqmsg_to_arr_slow(text)
+        got = onebot_adapter._cqmsg_to_arr(text)
+        assert got == want,(text,got,want)
+        for enc,old_enc in ((escape.cq_text_escape,legacy._cq_text_encode),
+                            (escape.cq_params_escape,legacy._cq_params_encode)):
+            assert enc(text) == old_enc(text),text
+        # 编码后再解码要能还原
+        assert onebot_adapter._cqmsg_to_arr(escape.cq_text_escape(text)) == ([{"type":"text","data":{"text":text}}] if text else [])
+    return len(samples)
+
+
+def main():
+    count = check_parity()
+    results = []
+    for name,text in CQ_MESSAGES.items():
+        base = timeit(onebot_adapter._cqmsg_to_arr_slow,text)["ns_per_op"]
+        ret = timeit(onebot_adapter._cqmsg_to_arr,text)
+        results.append({"name":"decode {}".format(name),"baseline":base,**ret})
+    for name in ("long","escaped"):
+        text = CQ_MESSAGES[name]
+        base = timeit(legacy._cq_text_encode,text)["ns_per_op"]
+        ret = timeit(escape.cq_text_escape,text)
+        results.append({"name":"text encode {}".format(name),"baseline":base,**ret})
+        base = timeit(legacy._cq_params_encode,text)["ns_per_op"]
+        ret = timeit(escape.cq_params_escape,text)
+        results.append({"name":"params encode {}".format(name),"baseline":base,**ret})
+    report("onebot CQ codec (parity ok on {} samples)".format(count),results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,40 @@
+'''比较escape模块和旧的逐字符转义，先检查结果一致'''
+import escape
+from bench import legacy
+from bench.common import report, timeit
+from bench.corpus import LONG_TEXTS
+
+
+# (名字,新实现,旧实现)
+_PAIRS = [
+    ("satori escape",escape.satori_escape,legacy.satori_to_plain),
+    ("kmarkdown escape",escape.kmarkdown_escape,legacy._make_kook_text),
+    ("kmarkdown unescape",escape.kmarkdown_unescape,legacy.kook_msg_f),
+    ("cq text escape",escape.cq_text_escape,legacy._cq_text_encode),
+    ("cq params escape",escape.cq_params_escape,legacy._cq_params_encode),
+    ("qq escape",escape.qq_escape,legacy._make_qq_text),
+]
+
+
+def main():
+    results = []
+    for text_name,text in LONG_TEXTS.items():
+        for name,fn,old_fn in _PAIRS:
+            sample = text
+            if name.endswith("unescape"):
+                sample = legacy._make_kook_text(text)
+            assert fn(sample) == old_fn(sample),(name,text_name)
+            base = timeit(old_fn,sample)["ns_per_op"]
+            ret = timeit(fn,sample)
+            results.append({"name":"{} {}({}B)".format(name,text_name,len(sample.encode())),"baseline":base,**ret})
+    # 转义后再反转义要能还原
+    for text in LONG_TEXTS.values():
+        assert escape.satori_unescape(escape.satori_escape(text)) == text
+        assert escape.kmarkdown_unescape(escape.kmarkdown_escape(text)) == text
+        assert escape.cq_params_unescape(escape.cq_params_escape(text)) == text
+        assert escape.qq_unescape(escape.qq_escape(text)) == text
+    report("escape",results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+'''比较旧的数据模型(to_dict后再remove_json_null)和tool中带__slots__的模型
+    除了耗时，还用tracemalloc统计每个事件的内存分配'''
+import gc
+import tracemalloc
+
+import tool
+from bench import legacy
+from bench.common import report, timeit
+
+
+def _make_event(m):
+    # 和kook适配器转换一条群消息时构造的对象一样
+    return m.SatoriGroupMessageCreatedEvent(
+        id=1,
+        self_id="2418200000",
+        timestamp=1700000000000,
+        platform="kook",
+        channel=m.SatoriChannel(id="GROUP_5432109876543210",type=m.SatoriChannel.ChannelType.TEXT,name="闲聊"),
+        message=m.SatoriMessage(id="0a1b2c3d-4e5f-6789-abcd-ef0123456789",content="<at id=\"2418200000\"/> 你好",created_at=1700000000000),
+        user=m.SatoriUser(id="1234567890",name="某人",avatar="https://img.kookapp.cn/avatars/2021-01/abc.png",is_bot=False),
+        member=m.SatoriGuildMember(nick="某人",avatar="https://img.kookapp.cn/avatars/2021-01/abc.png"),
+        guild=m.SatoriGuild(id="1111222233334444"),
+        role=m.SatoriGuildRole(id="[3, 5, 12]"),
+    )
+
+
+def legacy_event() -> dict:
+    return tool.remove_json_null(_make_event(legacy).to_dict())
+
+
+def new_event() -> dict:
+    return _make_event(tool).to_dict()
+
+
+def _peak(fn) -> int:
+    '''处理一个事件时的内存峰值，包括中间对象'''
+    gc.collect()
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    base,_ = tracemalloc.get_traced_memory()
+    fn()
+    _,peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak - base
+
+
+def _retained(fn,count:int = 1000) -> tuple:
+    '''保留count个fn()的结果，返回每个的(字节数,内存块数)'''
+    gc.collect()
+    tracemalloc.start()
+    start = tracemalloc.take_snapshot()
+    kept = [fn() for _ in range(count)]
+    end = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    diff = end.compare_to(start,"filename")
+    size = sum(it.size_diff for it in diff)
+    blocks = sum(it.count_diff for it in diff)
+    del kept
+    return size / count,blocks / count
+
+
+def main():
+    assert legacy_event() == new_event()
+    results = []
+    base = timeit(legacy_event)["ns_per_op"]
+    results.append({"name":"build+to_dict","baseline":base,**timeit(new_event)})
+    base = _peak(legacy_event)
+    results.append({"name":"peak bytes/event","unit":"B","value":_peak(new_event),"baseline":base})
+    # 在队列中等待或者被缓存时，模型对象本身占用的内存
+    old_size,old_blocks = _retained(lambda: _make_event(legacy))
+    size,blocks = _retained(lambda: _make_event(tool))
+    results.append({"name":"model object bytes","unit":"B","value":size,"baseline":old_size})
+    results.append({"name":"model object blocks","unit":"blocks","value":blocks,"baseline":old_blocks})
+    report("event model",results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+'''一次突发1000个事件时，从适配器放入到hub编码成事件帧的开销
+    旧：asyncio.Queue逐个get，取出后再编码；新：EventQueue放入时编码，hub用get_many批量取出'''
+import asyncio
+
+from event_queue import EventQueue
+from tool import encode_event
+from bench.common import report, timeit
+
+BURST = 1000
+
+
+def _event(i:int) -> dict:
+    return {
+        "id":i,
+        "type":"message-created",
+        "platform":"onebot",
+        "self_id":"2418200000",
+        "timestamp":1700000000000 + i,
+        "channel":{"id":"GROUP_123456","type":0},
+        "message":{"id":str(i),"content":"你好"},
+        "user":{"id":"1234567890","name":"某人"},
+    }
+
+
+async def _legacy_burst() -> int:
+    queue = asyncio.Queue(maxsize=BURST)
+    async def producer():
+        for i in range(BURST):
+            queue.put_nowait(_event(i))
+    asyncio.create_task(producer())
+    total = 0
+    for _ in range(BURST):
+        msg = await queue.get()
+        total += len(encode_event(msg))
+    return total
+
+
+async def _new_burst() -> int:
+    queue = EventQueue({"event_queue":{"max_events":BURST}})
+    async def producer():
+        for i in range(BURST):
+            await queue.put(_event(i))
+    asyncio.create_task(producer())
+    total = 0
+    count = 0
+    while count < BURST:
+        for body in await queue.get_many(64):
+            total += len(body)
+            count += 1
+    return total
+
+
+def main():
+    loop = asyncio.new_event_loop()
+    run = loop.run_until_complete
+    assert run(_legacy_burst()) == run(_new_burst())
+    base = timeit(lambda: run(_legacy_burst()))["ns_per_op"] / BURST
+    cost = timeit(lambda: run(_new_burst()))["ns_per_op"] / BURST
+    report("event queue",[{"name":"burst of {} events, per event".format(BURST),"ns_per_op":cost,"baseline":base}])
+    loop.close()
+
+
+if __name__ == "__main__":
+    main()
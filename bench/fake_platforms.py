@@ -0,0 +1,274 @@
+'''本地模拟的平台服务端，供bench.loadtest使用，一个aiohttp应用按路径前缀模拟四个平台：
+    /onebot     onebot v11的正向ws和http api
+    /kook       kook的网关和REST API，bot配置的http_url指向这里
+    /qq         qq的token接口、网关和REST API，bot配置的http_url和token_url指向这里
+    /mihoyo     大别野的protobuf ws和REST API，bot配置的http_url指向这里
+    ws连上并完成登录后，等到go被设置再按rate推送events个消息事件
+    每个消息的文本中带有"lt"加发送时的time.time_ns()，消费端据此计算从平台到消费端的延迟
+'''
+import asyncio
+import itertools
+import time
+
+from aiohttp import web
+
+from tool import json_dumps
+from mihoyo_adapter import (PHeartBeatReply, PLoginReply, RobotEvent, RobotEventEventType, RobotEventExtendData,
+                            RobotEventExtendDataSendMessageInfo, ObjectName)
+
+ONEBOT_SELF_ID = "10001"
+KOOK_SELF_ID = "20001"
+QQ_SELF_ID = "60001"
+MIHOYO_SELF_ID = "bot_loadtest"
+
+# 各平台的消息发到这些频道，loadtest对同样的频道调用message.create
+ONEBOT_CHANNEL = "GROUP_123456"
+KOOK_CHANNEL = "GROUP_30001"
+QQ_CHANNEL = "CHANNEL_70001"
+MIHOYO_CHANNEL = "3_2"
+
+
+def _marker() -> str:
+    return "lt" + str(time.time_ns())
+
+
+def _mihoyo_pack(biztype:int,body:bytes,wid:int) -> bytes:
+    # 与AdapterMihoyo._send_ws_pack相同的包头，biztype在第24~28字节，包体从第32字节开始
+    headerlen = 24
+    return (0xBABEFACE.to_bytes(4,"little") + (headerlen + len(body)).to_bytes(4,"little")
+            + headerlen.to_bytes(4,"little") + wid.to_bytes(8,"little") + (1).to_bytes(4,"little")
+            + biztype.to_bytes(4,"little") + (104).to_bytes(4,"little",signed=True) + body)
+
+
+class FakePlatforms:
+    def __init__(self,events:int,rate:float = 0) -> None:
+        '''events是每个平台推送的事件数，rate是每个平台每秒推送的事件数，0表示尽快推送'''
+        self.events = events
+        self.rate = rate
+        self.go = asyncio.Event()
+        self.sent = {} # 平台 -> 已经推送的事件数
+        self.api_calls = {} # 平台 -> 收到的发送消息请求数
+        self._ids = itertools.count(1)
+        self._runner = None
+        self.port = None
+
+    def make_app(self) -> web.Application:
+        app = web.Application()
+        app.add_routes([
+            web.get("/onebot/ws",self._onebot_ws),
+            web.post("/onebot/{action}",self._onebot_api),
+            web.get("/kook/gateway/index",self._kook_gateway),
+            web.get("/kook/user/me",self._kook_me),
+            web.post("/kook/message/create",self._kook_send),
+            web.post("/kook/direct-message/create",self._kook_send),
+            web.get("/kook/ws",self._kook_ws),
+            web.post("/qq/token",self._qq_token),
+            web.get("/qq/gateway",self._qq_gateway),
+            web.get("/qq/users/@me",self._qq_me),
+            web.post("/qq/channels/{channel_id}/messages",self._qq_send),
+            web.get("/qq/ws",self._qq_ws),
+            web.get("/mihoyo/vila/api/bot/platform/getWebsocketInfo",self._mihoyo_ws_info),
+            web.post("/mihoyo/vila/api/bot/platform/sendMessage",self._mihoyo_send),
+            web.get("/mihoyo/ws",self._mihoyo_ws),
+        ])
+        return app
+
+    async def start(self,host:str = "127.0.0.1") -> int:
+        self._runner = web.AppRunner(self.make_app())
+        await self._runner.setup()
+        site = web.TCPSite(self._runner,host,0)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+        self.base_url = "http://{}:{}".format(host,self.port)
+        self.ws_base_url = "ws://{}:{}".format(host,self.port)
+        return self.port
+
+    async def stop(self) -> None:
+        if self._runner != None:
+            await self._runner.cleanup()
+
+    async def _push(self,platform:str,send,make_event) -> None:
+        '''等到go之后推送事件，make_event(序号)返回要发送的数据'''
+        await self.go.wait()
+        self.sent.setdefault(platform,0)
+        interval = 1 / self.rate if self.rate else 0
+        start = time.perf_counter()
+        for i in range(self.events):
+            if interval:
+                delay = start + i * interval - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            await send(make_event(i))
+            self.sent[platform] += 1
+
+    def _count_api(self,platform:str) -> None:
+        self.api_calls[platform] = self.api_calls.get(platform,0) + 1
+
+    # ---------------- onebot ----------------
+
+    async def _onebot_ws(self,request:web.Request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        def make_event(i:int) -> str:
+            return json_dumps({
+                "post_type":"message",
+                "message_type":"group",
+                "time":int(time.time()),
+                "self_id":int(ONEBOT_SELF_ID),
+                "group_id":int(ONEBOT_CHANNEL[6:]),
+                "user_id":1000 + i % 50,
+                "message_id":i,
+                "message":"[CQ:at,qq={}] {}".format(ONEBOT_SELF_ID,_marker()),
+                "sender":{"nickname":"user","card":"user","role":"member"},
+            })
+        await self._push("onebot",ws.send_str,make_event)
+        async for _ in ws:
+            pass
+        return ws
+
+    async def _onebot_api(self,request:web.Request):
+        action = request.match_info["action"]
+        if action == "get_login_info":
+            return web.json_response({"status":"ok","retcode":0,"data":{"user_id":int(ONEBOT_SELF_ID),"nickname":"bot"}})
+        if action in ("send_group_msg","send_private_msg"):
+            self._count_api("onebot")
+            return web.json_response({"status":"ok","retcode":0,"data":{"message_id":next(self._ids)}})
+        return web.json_response({"status":"failed","retcode":1404,"data":None})
+
+    # ---------------- kook ----------------
+
+    async def _kook_gateway(self,request:web.Request):
+        return web.json_response({"code":0,"data":{"url":self.ws_base_url + "/kook/ws"}})
+
+    async def _kook_me(self,request:web.Request):
+        return web.json_response({"code":0,"data":{"id":KOOK_SELF_ID,"username":"bot","avatar":""}})
+
+    async def _kook_send(self,request:web.Request):
+        await request.read()
+        self._count_api("kook")
+        return web.json_response({"code":0,"data":{"msg_id":str(next(self._ids)),"msg_timestamp":int(time.time() * 1000)}})
+
+    async def _kook_ws(self,request:web.Request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        await ws.send_str(json_dumps({"s":1,"d":{"code":0,"session_id":"loadtest"}}))
+        def make_event(i:int) -> str:
+            return json_dumps({"s":0,"sn":i + 1,"d":{
+                "channel_type":"GROUP",
+                "type":9,
+                "target_id":KOOK_CHANNEL[6:],
+                "author_id":str(40000 + i % 50),
+                "content":"(met){}(met) {}".format(KOOK_SELF_ID,_marker()),
+                "msg_id":"kook-{}".format(i),
+                "msg_timestamp":int(time.time() * 1000),
+                "extra":{
+                    "type":9,
+                    "guild_id":"50001",
+                    "channel_name":"loadtest",
+                    "author":{"id":str(40000 + i % 50),"username":"user","nickname":"user","avatar":"","bot":False,"roles":[1,2]},
+                },
+            }})
+        pusher = asyncio.create_task(self._push("kook",ws.send_str,make_event))
+        async for msg in ws:
+            if msg.type == web.WSMsgType.TEXT and '"s":2' in msg.data:
+                await ws.send_str('{"s":3}')
+        pusher.cancel()
+        return ws
+
+    # ---------------- qq ----------------
+
+    async def _qq_token(self,request:web.Request):
+        return web.json_response({"access_token":"loadtest","expires_in":"7200"})
+
+    async def _qq_gateway(self,request:web.Request):
+        return web.json_response({"url":self.ws_base_url + "/qq/ws"})
+
+    async def _qq_me(self,request:web.Request):
+        return web.json_response({"id":QQ_SELF_ID,"username":"bot","avatar":""})
+
+    async def _qq_send(self,request:web.Request):
+        await request.read()
+        self._count_api("qq")
+        return web.json_response({"id":str(next(self._ids))})
+
+    async def _qq_ws(self,request:web.Request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        await ws.send_str(json_dumps({"op":10,"d":{"heartbeat_interval":41250}}))
+        def make_event(i:int) -> str:
+            return json_dumps({"op":0,"s":i + 2,"t":"AT_MESSAGE_CREATE","d":{
+                "id":"qq-{}".format(i),
+                "channel_id":QQ_CHANNEL[8:],
+                "guild_id":"80001",
+                "content":"<@!{}> {}".format(QQ_SELF_ID,_marker()),
+                "timestamp":"2023-11-14T12:00:00+08:00",
+                "author":{"id":str(90000 + i % 50),"username":"user","avatar":"","bot":False},
+                "member":{"nick":"user","roles":["1","4"],"joined_at":"2023-01-01T00:00:00+08:00"},
+            }})
+        pusher = None
+        async for msg in ws:
+            if msg.type != web.WSMsgType.TEXT:
+                continue
+            if '"op":2' in msg.data and pusher == None: # identify
+                await ws.send_str(json_dumps({"op":0,"s":1,"t":"READY","d":{"session_id":"loadtest","user":{"id":QQ_SELF_ID}}}))
+                pusher = asyncio.create_task(self._push("qq",ws.send_str,make_event))
+            elif '"op":1' in msg.data: # 心跳
+                await ws.send_str('{"op":11}')
+        if pusher != None:
+            pusher.cancel()
+        return ws
+
+    # ---------------- mihoyo ----------------
+
+    async def _mihoyo_ws_info(self,request:web.Request):
+        return web.json_response({"retcode":0,"message":"OK","data":{
+            "websocket_url":self.ws_base_url + "/mihoyo/ws",
+            "uid":"1","app_id":104,"platform":3,"device_id":"loadtest",
+        }})
+
+    async def _mihoyo_send(self,request:web.Request):
+        await request.read()
+        self._count_api("mihoyo")
+        return web.json_response({"retcode":0,"message":"OK","data":{"bot_msg_id":str(next(self._ids))}})
+
+    async def _mihoyo_ws(self,request:web.Request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        villa_id,room_id = MIHOYO_CHANNEL.split("_")
+        def make_event(i:int) -> bytes:
+            text = "@bot " + _marker()
+            content = json_dumps({
+                "content":{"text":text,"entities":[{"offset":0,"length":4,"entity":{"type":"mentioned_robot","bot_id":MIHOYO_SELF_ID}}]},
+                "user":{"portraitUri":"","extra":json_dumps({"member_roles":{"name":"member"}})},
+            })
+            now = int(time.time())
+            evt = RobotEvent(
+                type=RobotEventEventType.SendMessage,
+                id="mihoyo-{}".format(i),
+                created_at=now,
+                send_at=now,
+                extend_data=RobotEventExtendData(send_message=RobotEventExtendDataSendMessageInfo(
+                    content=content,
+                    from_user_id=1000 + i % 50,
+                    send_at=now * 1000,
+                    object_name=ObjectName.Text,
+                    room_id=int(room_id),
+                    nickname="user",
+                    msg_uid="uid-{}".format(i),
+                    villa_id=int(villa_id),
+                )),
+            )
+            return _mihoyo_pack(30001,bytes(evt),i + 1)
+        pusher = None
+        async for msg in ws:
+            if msg.type != web.WSMsgType.BINARY:
+                continue
+            biztype = int.from_bytes(msg.data[24:28],"little")
+            if biztype == 7 and pusher == None: # 登录
+                await ws.send_bytes(_mihoyo_pack(7,bytes(PLoginReply(code=0)),0))
+                pusher = asyncio.create_task(self._push("mihoyo",ws.send_bytes,make_event))
+            elif biztype == 6: # 心跳
+                await ws.send_bytes(_mihoyo_pack(6,bytes(PHeartBeatReply(code=0)),0))
+        if pusher != None:
+            pusher.cancel()
+        return ws
@@ -0,0 +1,27 @@
+'''比较标准库json和tool中的json编解码(安装了orjson时为orjson)'''
+import json
+
+import tool
+from bench.common import report, timeit
+from bench.corpus import GATEWAY_FRAMES, SATORI_EVENT
+
+
+def main():
+    results = []
+    for platform,frame in GATEWAY_FRAMES.items():
+        base = timeit(json.loads,frame)["ns_per_op"]
+        ret = timeit(tool.json_loads,frame)
+        results.append({"name":"decode {}".format(platform),"baseline":base,**ret})
+    evt = tool.remove_json_null(SATORI_EVENT)
+    base = timeit(json.dumps,evt)["ns_per_op"]
+    ret = timeit(tool.json_dumps,evt)
+    results.append({"name":"encode satori event","baseline":base,**ret})
+    logins = [evt["user"]] * 20
+    base = timeit(json.dumps,logins)["ns_per_op"]
+    ret = timeit(tool.json_dumps_bytes,logins)
+    results.append({"name":"encode http response","baseline":base,**ret})
+    report("json codec ({})".format("orjson" if tool.orjson else "json"),results)
+
+
+if __name__ == "__main__":
+    main()
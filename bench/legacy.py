@@ -0,0 +1,458 @@
+'''被替换掉的旧实现，仅作为性能测试的基准'''
+import json
+import logging
+import time
+from enum import Enum
+from html.parser import HTMLParser
+
+import tool
+
+
+class _MyHTMLParser(HTMLParser):
+    def __init__(self, *, convert_charrefs: bool = True) -> None:
+        super().__init__(convert_charrefs=convert_charrefs)
+        self.data = {
+            "data":[]
+        }
+        self.temp_data = self.data
+    def handle_starttag(self, tag, attrs):
+        tag_obj = {
+            "pre": self.temp_data,
+            "type":tag,
+            "data":[]
+        }
+        obj = dict()
+        for it in attrs:
+            obj[it[0]] = it[1]
+        tag_obj["attrs"] = obj
+        self.temp_data["data"].append(tag_obj)
+        self.temp_data = tag_obj
+
+    def handle_endtag(self, tag):
+        last = self.temp_data["pre"]
+        del self.temp_data["pre"]
+        self.temp_data["data"] = self.temp_data["data"]
+        self.temp_data = last
+
+    def handle_data(self, data):
+        self.temp_data["data"].append(data)
+
+def parse_satori_html(text):
+    parser = _MyHTMLParser()
+    parser.feed(text)
+    ret = parser.data["data"]
+    return ret
+
+
+def _cq_text_encode(data: str) -> str:
+    ret_str = ""
+    for ch in data:
+        if ch == "&":
+            ret_str += "&amp;"
+        elif ch == "[":
+            ret_str += "&#91;"
+        elif ch == "]":
+            ret_str += "&#93;"
+        else:
+            ret_str += ch
+    return ret_str
+
+def _cq_params_encode(data: str) -> str:
+    ret_str = ""
+    for ch in data:
+        if ch == "&":
+            ret_str += "&amp;"
+        elif ch == "[":
+            ret_str += "&#91;"
+        elif ch == "]":
+            ret_str += "&#93;"
+        elif ch == ",":
+            ret_str += "&#44;"
+        else:
+            ret_str += ch
+    return ret_str
+
+def satori_to_plain(text):
+    ret = ""
+    for ch in text:
+        if ch == "\"":
+            ret += "&quot;"
+        elif ch == "&":
+            ret += "&amp;"
+        elif ch == "<":
+            ret += "&lt;"
+        elif ch == ">":
+            ret += "&gt;"
+        else:
+            ret += ch
+    return ret
+
+def kook_msg_f(msg):
+    ret = ""
+    is_f = False
+    for ch in msg:
+        if is_f:
+            is_f = False
+            ret += ch
+        elif ch == "\\":
+            is_f = True
+        else:
+            ret += ch
+    return ret
+
+def _make_kook_text(text):
+    ret = ""
+    for ch in text:
+        if ch in ["\\","*","~","[","(",")","]","-",">","`"]:
+            ret += "\\"
+        ret += ch
+    return ret
+
+def _make_qq_text(text:str):
+    ret = text
+    ret = ret.replace("&","&amp;")
+    ret = ret.replace("<","&lt;")
+    ret = ret.replace(">","&gt;")
+    return ret
+
+def _qqmsg_to_arr(cqstr) -> list:
+    text = ""
+    jsonarr = []
+    stat = 0
+    i = 0
+    while i < len(cqstr):
+        cur_ch = cqstr[i]
+        if stat == 0:
+            if cur_ch == '<':
+                stat = 1
+                jsonarr.append({
+                    "type":"text",
+                    "data":text
+                })
+                text = ""
+                text += cur_ch
+                i += 1
+            elif cur_ch == "&":
+                if cqstr[i:i+4] == "&gt;":
+                    text += ">"
+                    i += 4
+                elif cqstr[i:i+4] == "&lt;":
+                    text += "<"
+                    i += 4
+                elif cqstr[i:i+5] == "&amp;":
+                    text += "&"
+                    i += 5
+                else:
+                    text += "&"
+                    i += 1
+            else:
+                text += cur_ch
+                i += 1
+        else:
+            if cur_ch == '>':
+                stat = 0
+                text += ">"
+                jsonarr.append({
+                    "type":"embbed",
+                    "data":text
+                })
+                text = ""
+                i += 1
+            else:
+                i += 1
+                text += cur_ch
+
+    if text != "":
+        jsonarr.append({
+            "type":"text",
+            "data":text
+        })   
+    return jsonarr
+
+def _qqarr_to_satori(qqmsg_arr):
+    ret = ""
+    for it in qqmsg_arr:
+        if it["type"] == "text":
+            ret += tool.satori_to_plain(it["data"])
+        else:
+            if it["data"].startswith("<@!"):
+                user_id = it["data"][3:len(it["data"]) - 1]
+                ret += "<at id=\"{}\">".format(tool.satori_to_plain(user_id))
+            elif it["data"].startswith("<@"):
+                user_id = it["data"][2:len(it["data"]) - 1]
+                ret += "<at id=\"{}\">".format(tool.satori_to_plain(user_id))
+    return ret
+
+def qq_channel_event(data,id,self_id) -> dict:
+    # 同一个时间解析三次，mktime按本地时区计算，忽略了字符串中的时区偏移
+    satori_msg = _qqarr_to_satori(_qqmsg_to_arr(data["content"]))
+    return tool.SatoriGroupMessageCreatedEvent(
+        id=id,
+        self_id=self_id,
+        timestamp=int(time.mktime(time.strptime(data["timestamp"], "%Y-%m-%dT%H:%M:%S%z"))) * 1000,
+        platform="qq_guild",
+        channel=tool.SatoriChannel(
+            id="CHANNEL_"+data["channel_id"],
+            type=tool.SatoriChannel.ChannelType.TEXT,
+        ),
+        message=tool.SatoriMessage(
+            id=data["id"],
+            content=satori_msg,
+            created_at=int(time.mktime(time.strptime(data["timestamp"], "%Y-%m-%dT%H:%M:%S%z"))) * 1000
+        ),
+        user=tool.SatoriUser(
+            id=data["author"]["id"],
+            name=data["author"]["username"],
+            avatar=data["author"]["avatar"],
+            is_bot=data["author"]["bot"]
+        ),
+        member=tool.SatoriGuildMember(
+            nick=data["member"]["nick"],
+            avatar=data["author"]["avatar"],
+            joined_at=int(time.mktime(time.strptime(data["member"]["joined_at"], "%Y-%m-%dT%H:%M:%S%z"))) * 1000
+        ),
+        guild=tool.SatoriGuild(
+            id=data["guild_id"]
+        ),
+        role=tool.SatoriGuildRole(
+            id=json.dumps(sorted(data["member"]["roles"]))
+        )
+    ).to_dict()
+
+def qq_group_event(data,id,self_id) -> dict:
+    satori_msg = _qqarr_to_satori(_qqmsg_to_arr(data["content"]))
+    return tool.SatoriGroupMessageCreatedEvent(
+        id=id,
+        self_id=self_id,
+        timestamp=int(time.mktime(time.strptime(data["timestamp"], "%Y-%m-%dT%H:%M:%S%z"))) * 1000,
+        platform="qq_group",
+        channel=tool.SatoriChannel(
+            id="GROUP_"+data["group_id"],
+            type=tool.SatoriChannel.ChannelType.TEXT,
+        ),
+        message=tool.SatoriMessage(
+            id=data["id"],
+            content=satori_msg,
+            created_at=int(time.mktime(time.strptime(data["timestamp"], "%Y-%m-%dT%H:%M:%S%z"))) * 1000
+        ),
+        user=tool.SatoriUser(
+            id=data["author"]["id"]
+        ),
+        member=tool.SatoriGuildMember(
+        ),
+        guild=tool.SatoriGuild(
+            id="GROUP_"+data["group_id"]
+        ),
+        role=tool.SatoriGuildRole(
+            id="unkonw",
+            name="unkonw"
+        )
+    ).to_dict()
+
+_mihoyo_log = logging.getLogger("satori.mihoyo")
+
+def _mihoyo_msg_to_satori(content_obj)->str:
+    # 每个字符都扫描一遍entities，offset当作python字符串的下标
+    ret = ""
+    entities = content_obj["content"]["entities"]
+    text = content_obj["content"]["text"]
+    l = len(text)
+    i = 0
+    while i < l:
+        for en in entities:
+            if en["offset"] == i:
+                _mihoyo_log.debug("entity %s",en)
+                i += en["length"]
+                if en["entity"]["type"] == "mention_all":
+                    ret += "<at type=\"all\"/>"
+                elif en["entity"]["type"] == "mentioned_robot":
+                    ret += "<at id=\"{}\"/>".format(en["entity"]["bot_id"])
+                elif en["entity"]["type"] == "mentioned_user":
+                    ret += "<at id=\"{}\"/>".format(en["entity"]["user_id"])
+                break
+        else:
+            ret += tool.satori_to_plain(text[i])
+            i += 1
+    return ret
+
+
+class SatoriUser():
+    def __init__(self,id:str,name:str = None,avatar:str = None,is_bot:bool = None) -> None:
+        self.id = id
+        self.name = name
+        self.nick = name
+        self.avatar = avatar
+        self.is_bot = is_bot
+    def to_dict(self) -> dict:
+        return {
+            "id":self.id,
+            "name":self.name,
+            "nick":self.nick,
+            "avatar":self.avatar,
+            "is_bot":self.is_bot,
+        }
+    
+class SatoriGuildMember():
+    def __init__(self,user:SatoriUser = None,nick:str = None,avatar:str = None,joined_at:int = None) -> None:
+        self.user = user
+        self.nick = nick
+        self.avatar = avatar
+        self.joined_at = joined_at
+    def to_dict(self) -> dict:
+        return {
+            "user":self.user.to_dict() if self.user else None,
+            "nick":self.nick,
+            "avatar":self.avatar,
+            "joined_at":self.joined_at,
+        }
+    
+class SatoriGuildRole():
+    def __init__(self,id,name:str = None) -> None:
+        self.id = id
+        self.name = name
+    def to_dict(self) -> dict:
+        return {
+            "id":self.id,
+            "name":self.name,
+        }
+
+class SatoriGuild():
+    def __init__(self,id,name:str = None,avatar:str = None) -> None:
+        self.id = id
+        self.name = name
+        self.avatar = avatar
+    def to_dict(self) -> dict:
+        return {
+            "id":self.id,
+            "name":self.name,
+            "avatar":self.avatar,
+        }
+    
+class SatoriChannel():
+    class ChannelType(Enum):
+        TEXT = 0
+        DIRECT = 1
+        CATEGORY = 2
+        VOICE = 3
+        
+    def __init__(self,id:str,type:ChannelType,name:str = None,parent_id:str = None) -> None:
+        self.id = id
+        self.type = type
+        self.name = name
+        self.parent_id = parent_id
+    def to_dict(self) -> dict:
+        return {
+            "id":self.id,
+            "type":self.type.value,
+            "name":self.name,
+            "parent_id":self.parent_id,
+        }
+    
+class SatoriGuild():
+    def __init__(self,id:str,name:str = None,avatar:str = None) -> None:
+        self.id = id
+        self.name = name
+        self.avatar = avatar
+    def to_dict(self) -> dict:
+        return {
+            "id":self.id,
+            "name":self.name,
+            "avatar":self.avatar,
+        }
+class SatoriLogin():
+    class LoginStatus(Enum):
+        OFFLINE = 0
+        ONLINE = 1
+        CONNECT = 2
+        DISCONNECT = 3
+        RECONNECT = 4
+    def __init__(self,status:LoginStatus,user:SatoriUser = None,self_id:str = None,platform:str = None) -> None:
+        self.status = status
+        self.user = user
+        self.self_id = self_id
+        self.platform = platform
+    def to_dict(self) -> dict:
+        return {
+            "status":self.status.value,
+            "user":self.user.to_dict() if self.user else None,
+            "self_id":self.self_id,
+            "platform":self.platform,
+        }
+    
+class SatoriMessage():
+    def __init__(self,id:str,content:str,
+                 channel:SatoriChannel = None,
+                 guild:SatoriGuild = None,
+                 member = None,
+                 user:SatoriUser = None,
+                 created_at:int = None,
+                 updated_at:int = None) -> None:
+        self.id = id
+        self.content = content
+        self.channel = channel
+        self.guild = guild
+        self.member = member
+        self.user = user
+        self.created_at = created_at
+        self.updated_at = updated_at
+    def to_dict(self) -> dict:
+        return {
+            "id":self.id,
+            "content":self.content,
+            "channel":self.channel.to_dict() if self.channel else None,
+            "guild":self.guild.to_dict() if self.guild else None,
+            "member":self.member.to_dict() if self.member else None,
+            "user":self.user.to_dict() if self.user else None,
+            "created_at":self.created_at,
+            "updated_at":self.updated_at,
+        }
+
+class SatoriPrivateMessageCreatedEvent():
+    def __init__(self,id:int,platform:str,self_id:str,timestamp:int,channel:SatoriChannel,message:SatoriMessage,user:SatoriUser) -> None:
+        self.id = id
+        self.type = "message-created"
+        self.platform = platform
+        self.self_id = self_id
+        self.timestamp = timestamp
+        self.channel = channel
+        self.message = message
+        self.user = user
+    def to_dict(self) -> dict:
+        return {
+            "id":self.id,
+            "type":self.type,
+            "platform":self.platform,
+            "self_id":self.self_id,
+            "timestamp":self.timestamp,
+            "channel":self.channel.to_dict(),
+            "message":self.message.to_dict(),
+            "user":self.user.to_dict(),
+        }
+    
+class SatoriGroupMessageCreatedEvent():
+    def __init__(self,id:int,platform:str,self_id:str,timestamp:int,channel:SatoriChannel,message:SatoriMessage,user:SatoriUser,member:SatoriGuildMember,guild:SatoriGuild,role:SatoriGuildRole) -> None:
+        self.id = id
+        self.type = "message-created"
+        self.platform = platform
+        self.self_id = self_id
+        self.timestamp = timestamp
+        self.channel = channel
+        self.message = message
+        self.user = user
+        self.guild = guild
+        self.member = member
+        self.role = role
+    def to_dict(self) -> dict:
+        return {
+            "id":self.id,
+            "type":self.type,
+            "platform":self.platform,
+            "self_id":self.self_id,
+            "timestamp":self.timestamp,
+            "channel":self.channel.to_dict(),
+            "message":self.message.to_dict(),
+            "user":self.user.to_dict(),
+            "guild":self.guild.to_dict(),
+            "member":self.member.to_dict(),
+            "role":self.role.to_dict(),
+        }
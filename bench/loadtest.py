@@ -0,0 +1,308 @@
+'''端到端压测：在本地启动模拟的平台(见bench.fake_platforms)，用子进程运行satori.py连接它们
+    然后连上若干个事件ws消费者，并发调用message.create，输出：
+        事件吞吐(每个消费者每秒收到的事件数)
+        事件从平台发出到消费者收到的p50/p99延迟
+        message.create的p50/p99延迟和每秒请求数
+        压测前后satori进程(包括工作进程)的内存增长
+    参数固定时结果可以在不同提交之间比较，--json输出中带有参数和当前的提交
+    在仓库根目录运行：
+        python -m bench.loadtest --events 2000 --consumers 4 --api-requests 1000
+    可选参数：
+        --platforms onebot,kook,qq,mihoyo   要压测的平台
+        --events N          每个平台推送的事件数
+        --rate R            每个平台每秒推送的事件数，0表示尽快推送
+        --consumers N       事件ws消费者的个数
+        --api-requests N    message.create的调用次数，平均分给各个平台
+        --api-concurrency N message.create的并发数
+        --worker            各个bot在工作进程中运行
+        --timeout S         等待事件的最长时间
+'''
+import argparse
+import asyncio
+import os
+import re
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import aiohttp
+
+from tool import json_dumps, json_loads
+from bench.common import report
+from bench import fake_platforms as fake
+
+_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+_MARKER_RE = re.compile(r'lt(\d{19})')
+
+# 平台 -> (message.create用的X-Platform,X-Self-ID,频道)
+_TARGETS = {
+    "onebot":("onebot",fake.ONEBOT_SELF_ID,fake.ONEBOT_CHANNEL),
+    "kook":("kook",fake.KOOK_SELF_ID,fake.KOOK_CHANNEL),
+    "qq":("qq_guild",fake.QQ_SELF_ID,fake.QQ_CHANNEL),
+    "mihoyo":("mihoyo",fake.MIHOYO_SELF_ID,fake.MIHOYO_CHANNEL),
+}
+
+
+def _parse_args():
+    parser = argparse.ArgumentParser(description="satori端到端压测")
+    parser.add_argument("--platforms",default="onebot,kook,qq,mihoyo")
+    parser.add_argument("--events",type=int,default=2000)
+    parser.add_argument("--rate",type=float,default=0)
+    parser.add_argument("--consumers",type=int,default=4)
+    parser.add_argument("--api-requests",type=int,default=1000)
+    parser.add_argument("--api-concurrency",type=int,default=16)
+    parser.add_argument("--worker",action="store_true")
+    parser.add_argument("--timeout",type=float,default=120)
+    parser.add_argument("--json",action="store_true")
+    return parser.parse_args()
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1",0))
+        return s.getsockname()[1]
+
+
+def _percentile(values:list,p:float) -> float:
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1,round(p * (len(values) - 1)))]
+
+
+def _rss_bytes(pid:int) -> int:
+    '''进程及其子进程(工作进程)的常驻内存，只支持linux，取不到时返回0'''
+    total = 0
+    pids = [pid]
+    try:
+        with open("/proc/{}/task/{}/children".format(pid,pid)) as f:
+            pids += [int(it) for it in f.read().split()]
+    except OSError:
+        pass
+    for it in pids:
+        try:
+            with open("/proc/{}/status".format(it)) as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        total += int(line.split()[1]) * 1024
+        except OSError:
+            pass
+    return total
+
+
+def _git_commit() -> str:
+    try:
+        return subprocess.run(["git","rev-parse","--short","HEAD"],cwd=_ROOT,capture_output=True,text=True).stdout.strip()
+    except OSError:
+        return ""
+
+
+def _make_config(platforms:list,base_url:str,ws_base_url:str,port:int,worker:bool) -> dict:
+    bots = {
+        "onebot":{
+            "platform":"onebot",
+            "http_url":base_url + "/onebot",
+            "ws_url":ws_base_url + "/onebot/ws",
+            "access_token":"",
+        },
+        "kook":{
+            "platform":"kook",
+            "access_token":"loadtest",
+            "http_url":base_url + "/kook",
+        },
+        "qq":{
+            "platform":"qq",
+            "botqq":"1",
+            "appid":"1",
+            "token":"loadtest",
+            "appsecret":"loadtest",
+            "withgroup":False,
+            "http_url":base_url + "/qq",
+            "token_url":base_url + "/qq/token",
+        },
+        "mihoyo":{
+            "platform":"mihoyo",
+            "bot_id":fake.MIHOYO_SELF_ID,
+            "secret":"loadtest",
+            "villa_id":fake.MIHOYO_CHANNEL.split("_")[0],
+            "http_url":base_url + "/mihoyo",
+        },
+    }
+    botlist = []
+    for it in platforms:
+        bot = bots[it]
+        # 压测只关心吞吐，不让本地限速和队列丢弃影响结果
+        bot["ratelimit"] = {"enable":False}
+        bot["event_queue"] = {"overflow":"block"}
+        if worker:
+            bot["worker"] = True
+        botlist.append(bot)
+    return {
+        "botlist":botlist,
+        "web_port":port,
+        "web_host":"127.0.0.1",
+        "access_token":"",
+        "ws_overflow":"block",
+        "log":{"level":"WARNING"},
+    }
+
+
+async def _wait_ready(session:aiohttp.ClientSession,base:str,count:int,proc,timeout:float) -> None:
+    '''等到satori启动，并且所有bot都在线'''
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if proc.poll() != None:
+            raise RuntimeError("satori进程退出，exitcode={}".format(proc.returncode))
+        try:
+            async with session.post(base + "/v1/admin/login.list") as resp:
+                logins = json_loads(await resp.read())
+                if len([it for it in logins if it["status"] == 1]) >= count:
+                    return
+        except (aiohttp.ClientError,ValueError):
+            pass
+        await asyncio.sleep(0.2)
+    raise RuntimeError("等待bot上线超时")
+
+
+class _Consumer:
+    def __init__(self,expected:int) -> None:
+        self.expected = expected
+        self.received = 0
+        self.latencies = [] # 纳秒
+        self.first = None
+        self.last = None
+        self.done = asyncio.Event()
+        self.ready = asyncio.Event()
+
+    async def run(self,session:aiohttp.ClientSession,url:str) -> None:
+        async with session.ws_connect(url,max_msg_size=0) as ws:
+            await ws.send_str(json_dumps({"op":3,"body":{}}))
+            async for msg in ws:
+                if msg.type != aiohttp.WSMsgType.TEXT:
+                    continue
+                now = time.time_ns()
+                frame = json_loads(msg.data)
+                if frame["op"] == 4:
+                    self.ready.set()
+                    continue
+                if frame["op"] != 0:
+                    continue
+                content = frame["body"].get("message",{}).get("content","")
+                found = _MARKER_RE.search(content)
+                if found == None:
+                    continue
+                self.latencies.append(now - int(found.group(1)))
+                self.received += 1
+                if self.first == None:
+                    self.first = now
+                self.last = now
+                if self.received >= self.expected:
+                    self.done.set()
+                    return
+
+
+async def _api_load(session:aiohttp.ClientSession,base:str,platforms:list,total:int,concurrency:int) -> dict:
+    latencies = []
+    errors = 0
+    jobs = iter(range(total))
+    async def worker():
+        nonlocal errors
+        for i in jobs:
+            platform,self_id,channel = _TARGETS[platforms[i % len(platforms)]]
+            headers = {"X-Platform":platform,"X-Self-ID":self_id,"Content-Type":"application/json"}
+            body = json_dumps({"channel_id":channel,"content":"压测消息 {}".format(i)})
+            start = time.perf_counter_ns()
+            try:
+                async with session.post(base + "/v1/message.create",data=body,headers=headers) as resp:
+                    ret = await resp.read()
+                    if resp.status != 200 or not ret.startswith(b"["):
+                        errors += 1
+            except aiohttp.ClientError:
+                errors += 1
+            latencies.append(time.perf_counter_ns() - start)
+    start = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    cost = time.perf_counter() - start
+    return {"latencies":latencies,"errors":errors,"seconds":cost}
+
+
+async def _run(args) -> list:
+    platforms = [it for it in args.platforms.split(",") if it]
+    fakes = fake.FakePlatforms(args.events,args.rate)
+    await fakes.start()
+    port = _free_port()
+    base = "http://127.0.0.1:{}".format(port)
+    workdir = tempfile.mkdtemp(prefix="satori-loadtest-")
+    with open(os.path.join(workdir,"config.json"),"w",encoding="utf-8") as f:
+        f.write(json_dumps(_make_config(platforms,fakes.base_url,fakes.ws_base_url,port,args.worker)))
+    log_file = open(os.path.join(workdir,"satori.log"),"wb")
+    env = dict(os.environ)
+    env["PYTHONPATH"] = _ROOT + os.pathsep + env.get("PYTHONPATH","")
+    proc = subprocess.Popen([sys.executable,os.path.join(_ROOT,"satori.py")],cwd=workdir,stdout=log_file,stderr=subprocess.STDOUT,env=env)
+    try:
+        async with aiohttp.ClientSession() as session:
+            await _wait_ready(session,base,len(platforms),proc,60)
+            rss_start = _rss_bytes(proc.pid)
+            expected = args.events * len(platforms)
+            consumers = [_Consumer(expected) for _ in range(args.consumers)]
+            tasks = [asyncio.create_task(it.run(session,base.replace("http","ws") + "/v1/events")) for it in consumers]
+            await asyncio.gather(*[it.ready.wait() for it in consumers])
+
+            # 事件阶段
+            go_ns = time.time_ns()
+            fakes.go.set()
+            try:
+                await asyncio.wait_for(asyncio.gather(*[it.done.wait() for it in consumers]),args.timeout)
+            except asyncio.TimeoutError:
+                pass
+            for it in tasks:
+                it.cancel()
+            rss_events = _rss_bytes(proc.pid)
+
+            # API阶段
+            api = await _api_load(session,base,platforms,args.api_requests,args.api_concurrency)
+            rss_end = _rss_bytes(proc.pid)
+    finally:
+        proc.terminate()
+        try:
+            proc.wait(10)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+        log_file.close()
+        await fakes.stop()
+
+    received = sum(it.received for it in consumers)
+    latencies = [ns for it in consumers for ns in it.latencies]
+    elapsed = max(((it.last or go_ns) - go_ns for it in consumers),default=0) / 1e9
+    results = [
+        {"name":"events delivered (all consumers)","value":received,"unit":"events",
+         "expected":expected * len(consumers)},
+        {"name":"event throughput per consumer","value":received / len(consumers) / elapsed if elapsed else 0,"unit":"events/s"},
+        {"name":"event latency p50","value":_percentile(latencies,0.5) / 1e3,"unit":"us"},
+        {"name":"event latency p99","value":_percentile(latencies,0.99) / 1e3,"unit":"us"},
+        {"name":"message.create throughput","value":len(api["latencies"]) / api["seconds"] if api["seconds"] else 0,"unit":"req/s"},
+        {"name":"message.create latency p50","value":_percentile(api["latencies"],0.5) / 1e3,"unit":"us"},
+        {"name":"message.create latency p99","value":_percentile(api["latencies"],0.99) / 1e3,"unit":"us"},
+        {"name":"message.create errors","value":api["errors"],"unit":"requests"},
+        {"name":"rss at start","value":rss_start / 1024,"unit":"KiB"},
+        {"name":"rss growth after events","value":(rss_events - rss_start) / 1024,"unit":"KiB"},
+        {"name":"rss growth after api","value":(rss_end - rss_start) / 1024,"unit":"KiB"},
+    ]
+    if received < expected * len(consumers):
+        print("事件没有全部送达，satori的日志在 {}".format(workdir),file=sys.stderr)
+    return results
+
+
+def main():
+    args = _parse_args()
+    results = asyncio.run(_run(args))
+    title = "loadtest {} events={} rate={} consumers={} api={}x{}{} @{}".format(
+        args.platforms,args.events,args.rate,args.consumers,args.api_requests,args.api_concurrency,
+        " worker" if args.worker else "",_git_commit())
+    report(title,results)
+
+
+if __name__ == "__main__":
+    main()
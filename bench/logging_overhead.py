@@ -0,0 +1,29 @@
+'''热路径上打日志的开销：原来每个发出的帧都print一次，现在是关闭的DEBUG日志
+    print写到/dev/null，已经是它最便宜的情况，写到真正的终端时会慢得多'''
+import contextlib
+import logging
+import os
+
+from log import get_logger, lazy
+from tool import json_dumps
+from bench.common import report, timeit
+
+_FRAME = json_dumps({"op":0,"body":{"id":1,"type":"message-created","platform":"onebot","self_id":"2418200000",
+                    "channel":{"id":"GROUP_123456","type":0},"message":{"id":"1","content":"你好"}}})
+_GATEWAY = {"op":0,"s":1,"t":"AT_MESSAGE_CREATE","d":{"id":"1","content":"<@!123> 你好","author":{"id":"2"}}}
+
+
+def main():
+    log = get_logger("bench.ws.send")
+    log.setLevel(logging.INFO)
+    results = []
+    with open(os.devnull,"w") as devnull, contextlib.redirect_stdout(devnull):
+        base = timeit(lambda: print("--------ws_send_json",_FRAME))["ns_per_op"]
+        gateway_base = timeit(lambda: print(json_dumps(_GATEWAY)))["ns_per_op"]
+    results.append({"name":"frame, debug disabled","baseline":base,**timeit(lambda: log.debug("%s",_FRAME))})
+    results.append({"name":"gateway json, debug disabled (lazy)","baseline":gateway_base,**timeit(lambda: log.debug("%s",lazy(json_dumps,_GATEWAY)))})
+    report("logging overhead",results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+'''大别野消息entities的解码：先检查结果，再和旧的逐字符扫描比较速度
+    没有emoji等非BMP字符时，新旧实现的结果要完全一致
+    有这类字符时旧实现把UTF-16的offset当成python下标，位置会错，只检查新实现得到正确的结果
+    另外检查发送时生成的entities解码后能还原
+'''
+import asyncio
+import random
+
+import tool
+from mihoyo_adapter import AdapterMihoyo
+from bench import legacy
+from bench.common import report, timeit
+from bench.corpus import TRANSCODER_MESSAGES
+from bench.transcoders import to_mihoyo, to_satori, _run_sync
+
+
+def _random_segs(rng:random.Random,emoji:bool) -> list:
+    parts = ["文字","a","<",">","&","\"","  ","公告。"]
+    if emoji:
+        parts += ["😀","🎉","👍🏻"]
+    segs = []
+    for _ in range(rng.randint(0,30)):
+        if rng.random() < 0.3:
+            segs.append(("at",str(rng.randint(1,99999))) if rng.random() < 0.9 else ("all",))
+        else:
+            segs.append("".join(rng.choice(parts) for _ in range(rng.randint(1,5))))
+    return segs
+
+
+def _shuffled(content_obj:dict,rng:random.Random) -> dict:
+    # 平台给出的entities不保证按offset排序
+    entities = list(content_obj["content"]["entities"])
+    rng.shuffle(entities)
+    return {**content_obj,"content":{**content_obj["content"],"entities":entities}}
+
+
+def check(adapter:AdapterMihoyo) -> int:
+    rng = random.Random(0)
+    samples = [(segs,False) for name,segs in TRANSCODER_MESSAGES.items() if name != "emoji"]
+    samples += [(TRANSCODER_MESSAGES["emoji"],True)]
+    samples += [(_random_segs(rng,False),False) for _ in range(3000)]
+    samples += [(_random_segs(rng,True),True) for _ in range(3000)]
+    for segs,emoji in samples:
+        content_obj = _shuffled(to_mihoyo(segs),rng)
+        got = adapter._mihoyo_msg_to_satori(content_obj)
+        assert got == to_satori(segs),(segs,got)
+        if not emoji:
+            assert got == legacy._mihoyo_msg_to_satori(content_obj),segs
+        # 发送：satori -> 大别野的文本和entities，再解码回来
+        sent = _run_sync(adapter._satori_to_mihoyo(tool.parse_satori_html(to_satori(segs)),"1"))
+        if sent:
+            back = adapter._mihoyo_msg_to_satori(tool.json_loads(sent[0]["msg_content"]))
+            assert back == to_satori(segs),(segs,back)
+    return len(samples)
+
+
+async def _main() -> None:
+    adapter = AdapterMihoyo({"bot_id":"bot_bench","secret":"bench","villa_id":"1"})
+    count = check(adapter)
+    cases = dict(TRANSCODER_MESSAGES)
+    # 几KB的文本中有几百个提及
+    cases["long_mentions"] = [seg for i in range(300) for seg in (("at",str(10000 + i)),"第{}位同学请到前台签到。".format(i))]
+    results = []
+    for name,segs in cases.items():
+        content_obj = to_mihoyo(segs)
+        base = timeit(legacy._mihoyo_msg_to_satori,content_obj)["ns_per_op"]
+        ret = timeit(adapter._mihoyo_msg_to_satori,content_obj)
+        results.append({"name":"decode {} ({} entities)".format(name,len(content_obj["content"]["entities"])),"baseline":base,**ret})
+    await adapter._http.aclose()
+    report("mihoyo entities (checked {} samples)".format(count),results)
+
+
+def main():
+    asyncio.run(_main())
+
+
+if __name__ == "__main__":
+    main()
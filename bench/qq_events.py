@@ -0,0 +1,72 @@
+'''qq事件转成satori事件：旧实现(三次strptime+mktime、每条消息json.dumps身份组、先建对象再to_dict)和直接生成json对象比较
+    旧实现的mktime按本地时区计算，忽略了时间中的"+08:00"，只在本地时区为UTC+8时结果正确
+    所以检查前把进程的时区设为Asia/Shanghai，这时两者的结果要完全一致
+'''
+import os
+import random
+import time
+
+from qq_adapter import AdapterQQ, _qqmsg_to_satori
+from bench import legacy
+from bench.common import report, timeit
+from bench.corpus import qq_event_stream
+
+
+def _random_qq(rng:random.Random) -> str:
+    parts = ["<@!123>","<@456>","<emoji:4>","<","<@",">","&amp;","&lt;","&gt;","&","&lt","文字","a"," "]
+    return "".join(rng.choice(parts) for _ in range(rng.randint(0,20)))
+
+
+def _new_stream(adapter:AdapterQQ,stream:list) -> None:
+    for event in stream:
+        if event["t"] == "AT_MESSAGE_CREATE":
+            adapter._channel_event_to_satori(event["d"])
+        else:
+            adapter._group_event_to_satori(event["d"])
+
+
+def _legacy_stream(adapter:AdapterQQ,stream:list) -> None:
+    for event in stream:
+        if event["t"] == "AT_MESSAGE_CREATE":
+            legacy.qq_channel_event(event["d"],adapter._id,adapter._self_id)
+        else:
+            legacy.qq_group_event(event["d"],adapter._id,adapter._botqq)
+
+
+def check(adapter:AdapterQQ,stream:list) -> int:
+    rng = random.Random(0)
+    samples = [_random_qq(rng) for _ in range(20000)]
+    for text in samples:
+        assert _qqmsg_to_satori(text) == legacy._qqarr_to_satori(legacy._qqmsg_to_arr(text)),text
+    for event in stream:
+        if event["t"] == "AT_MESSAGE_CREATE":
+            want = legacy.qq_channel_event(event["d"],adapter._id,adapter._self_id)
+            got = adapter._channel_event_to_satori(event["d"])
+        else:
+            want = legacy.qq_group_event(event["d"],adapter._id,adapter._botqq)
+            got = adapter._group_event_to_satori(event["d"])
+        assert got == want,(got,want)
+    return len(samples) + len(stream)
+
+
+def main():
+    if hasattr(time,"tzset"):
+        os.environ["TZ"] = "Asia/Shanghai"
+        time.tzset()
+    adapter = AdapterQQ({"botqq":"1","appid":"1","token":"bench","appsecret":"bench"})
+    adapter._self_id = "11111111111111111"
+    stream = qq_event_stream()
+    count = check(adapter,stream)
+    base = timeit(_legacy_stream,adapter,stream)["ns_per_op"] / len(stream)
+    cost = timeit(_new_stream,adapter,stream)["ns_per_op"] / len(stream)
+    results = [{"name":"event stream ({} events), per event".format(len(stream)),"ns_per_op":cost,"baseline":base}]
+    for name,text in (("mention","<@!11111111111111111> 签到"),("long","<@!1> " + "今天的活动大家记得参加 &lt;奖励&gt;。" * 50)):
+        old = lambda text: legacy._qqarr_to_satori(legacy._qqmsg_to_arr(text))
+        base = timeit(old,text)["ns_per_op"]
+        ret = timeit(_qqmsg_to_satori,text)
+        results.append({"name":"content {}".format(name),"baseline":base,**ret})
+    report("qq events (checked {} samples)".format(count),results)
+
+
+if __name__ == "__main__":
+    main()
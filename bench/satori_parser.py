@@ -0,0 +1,18 @@
+'''比较tool.parse_satori_html和旧的基于HTMLParser的实现'''
+import tool
+from bench import legacy
+from bench.common import report, timeit
+from bench.corpus import SATORI_MESSAGES
+
+
+def main():
+    results = []
+    for name,text in SATORI_MESSAGES.items():
+        base = timeit(legacy.parse_satori_html,text)["ns_per_op"]
+        ret = timeit(tool.parse_satori_html,text)
+        results.append({"name":"parse {}".format(name),"baseline":base,**ret})
+    report("parse_satori_html",results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,149 @@
+'''各平台消息转换函数的微基准，语料见corpus.TRANSCODER_MESSAGES(短消息、长消息、大量提及、大量emoji)
+    每条语料先渲染成各平台收到或发送时的格式，再分别对转换函数计时
+    kook发送图片时的上传被替换成直接返回地址，语料中本来也没有需要上传的图片
+    可以在参数中给出名字的一部分，只运行匹配的项目：python -m bench.transcoders mihoyo --json
+'''
+import asyncio
+import sys
+
+import tool
+import escape
+from onebot_adapter import AdapterOnebot, _cqmsg_to_arr
+from kook_adapter import AdapterKook
+from mihoyo_adapter import AdapterMihoyo
+from qq_adapter import _qqmsg_to_satori
+from bench.common import report, timeit
+from bench.corpus import TRANSCODER_MESSAGES, SATORI_EVENT
+
+
+def _run_sync(coro):
+    '''运行一个中途不会挂起的协程，直接取得返回值，避免把事件循环的开销算进去'''
+    try:
+        coro.send(None)
+    except StopIteration as e:
+        return e.value
+    coro.close()
+    raise RuntimeError("协程挂起了")
+
+
+def _utf16_len(text:str) -> int:
+    return len(text.encode("utf-16-le")) // 2
+
+
+def to_satori(segs:list) -> str:
+    ret = ""
+    for seg in segs:
+        if isinstance(seg,str):
+            ret += escape.satori_escape(seg)
+        elif seg[0] == "at":
+            ret += "<at id=\"{}\"/>".format(seg[1])
+        else:
+            ret += "<at type=\"all\"/>"
+    return ret
+
+
+def to_cq(segs:list) -> str:
+    ret = ""
+    for seg in segs:
+        if isinstance(seg,str):
+            ret += escape.cq_text_escape(seg)
+        elif seg[0] == "at":
+            ret += "[CQ:at,qq={}]".format(seg[1])
+        else:
+            ret += "[CQ:at,qq=all]"
+    return ret
+
+
+def to_kook(segs:list) -> str:
+    ret = ""
+    for seg in segs:
+        if isinstance(seg,str):
+            ret += escape.kmarkdown_escape(seg)
+        elif seg[0] == "at":
+            ret += "(met){}(met)".format(seg[1])
+        else:
+            ret += "(met)all(met)"
+    return ret
+
+
+def to_qq(segs:list) -> str:
+    ret = ""
+    for seg in segs:
+        if isinstance(seg,str):
+            ret += escape.qq_escape(seg)
+        elif seg[0] == "at":
+            ret += "<@!{}>".format(seg[1])
+        else:
+            ret += "@everyone"
+    return ret
+
+
+def to_mihoyo(segs:list) -> dict:
+    '''大别野消息的content对象，提及是文本中的一段，entities的offset和length按UTF-16计算'''
+    text = ""
+    entities = []
+    for seg in segs:
+        if isinstance(seg,str):
+            text += seg
+            continue
+        if seg[0] == "at":
+            mention = "@用户{} ".format(seg[1])
+            entity = {"type":"mentioned_user","user_id":seg[1]}
+        else:
+            mention = "@全体成员 "
+            entity = {"type":"mention_all"}
+        entities.append({"offset":_utf16_len(text),"length":_utf16_len(mention),"entity":entity})
+        text += mention
+    return {"content":{"text":text,"entities":entities},"user":{"portraitUri":"","extra":"{}"}}
+
+
+async def _stub_kook_upload(img_url:str) -> str:
+    return "https://img.kookapp.cn/assets/stub.png"
+
+
+def _cases(onebot:AdapterOnebot,kook:AdapterKook,mihoyo:AdapterMihoyo) -> list:
+    '''返回(名字,函数,参数)列表'''
+    cases = []
+    for name,segs in TRANSCODER_MESSAGES.items():
+        satori = to_satori(segs)
+        satori_obj = tool.parse_satori_html(satori)
+        cq = to_cq(segs)
+        cqarr = _cqmsg_to_arr(cq)
+        event = {**SATORI_EVENT,"message":{**SATORI_EVENT["message"],"content":satori}}
+        cases += [
+            ("parse_satori_html " + name,tool.parse_satori_html,satori),
+            ("remove_json_null " + name,tool.remove_json_null,event),
+            ("onebot _cqmsg_to_arr " + name,_cqmsg_to_arr,cq),
+            ("onebot _cqarr_to_satori " + name,onebot._cqarr_to_satori,cqarr),
+            ("onebot _satori_to_cq " + name,lambda obj: _run_sync(onebot._satori_to_cq(obj)),satori_obj),
+            ("kook _kook_msg_to_satori " + name,lambda msg: kook._kook_msg_to_satori(9,msg),to_kook(segs)),
+            ("kook _satori_to_kook " + name,lambda obj: _run_sync(kook._satori_to_kook(obj)),satori_obj),
+            ("mihoyo _mihoyo_msg_to_satori " + name,mihoyo._mihoyo_msg_to_satori,to_mihoyo(segs)),
+            ("qq _qqmsg_to_satori " + name,_qqmsg_to_satori,to_qq(segs)),
+        ]
+    return cases
+
+
+async def _main() -> None:
+    selected = [it for it in sys.argv[1:] if not it.startswith("--")]
+    onebot = AdapterOnebot({"http_url":"http://127.0.0.1:5700","ws_url":"ws://127.0.0.1:5800"})
+    kook = AdapterKook({"access_token":"bench"})
+    kook._prepare_kook_img = _stub_kook_upload
+    mihoyo = AdapterMihoyo({"bot_id":"bot_bench","secret":"bench","villa_id":"1"})
+    results = []
+    for name,fn,arg in _cases(onebot,kook,mihoyo):
+        if selected and not any(it in name for it in selected):
+            continue
+        size = len((arg if isinstance(arg,str) else tool.json_dumps(arg)).encode())
+        results.append({"name":name,**timeit(fn,arg),"input_bytes":size})
+    for adapter in (onebot,kook,mihoyo):
+        await adapter._http.aclose()
+    report("message transcoders",results)
+
+
+def main():
+    asyncio.run(_main())
+
+
+if __name__ == "__main__":
+    main()
@@ -7,6 +7,13 @@ class Config:
         self.web_port:int = 8080
         self.web_host:str = "127.0.0.1"
         self.access_token:str = ""
+        self.ws_queue_size:int = 1000
+        self.ws_overflow:str = "drop_oldest"
+        self.replay_size:int = 1000
+        self.replay_bytes:int = 16 * 1024 * 1024
+        self.journal:dict = None
+        self.event_batch:int = 64
+        self.log:dict = {}
     
     async def read_config(self):
         async with aiofiles.open('config.json', mode='r') as f:
@@ -14,4 +21,18 @@ class Config:
         self.botlist = json_dat["botlist"]
         self.web_port = json_dat["web_port"]
         self.web_host = json_dat["web_host"]
-        self.access_token = json_dat["access_token"]
\ No newline at end of file
+        self.access_token = json_dat["access_token"]
+        if "ws_queue_size" in json_dat:
+            self.ws_queue_size = json_dat["ws_queue_size"]
+        if "ws_overflow" in json_dat:
+            self.ws_overflow = json_dat["ws_overflow"]
+        if "replay_size" in json_dat:
+            self.replay_size = json_dat["replay_size"]
+        if "replay_bytes" in json_dat:
+            self.replay_bytes = json_dat["replay_bytes"]
+        if "journal" in json_dat:
+            self.journal = json_dat["journal"]
+        if "event_batch" in json_dat:
+            self.event_batch = json_dat["event_batch"]
+        if "log" in json_dat:
+            self.log = json_dat["log"]
\ No newline at end of file
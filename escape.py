@@ -0,0 +1,82 @@
+'''各平台文本格式的转义与反转义
+    每种格式用一张(字符,转义)表描述，转义时按表逐个str.replace，
+    对于不含特殊字符的文本只做几次in判断，比逐字符拼接快很多
+'''
+import html
+import re
+
+
+def _make_escape(table:tuple):
+    def escape(text:str) -> str:
+        for ch,rep in table:
+            if ch in text:
+                text = text.replace(ch,rep)
+        return text
+    return escape
+
+
+def _make_unescape(table:tuple,mark:str = "&"):
+    # "&amp;"这种转义引导符自身的转义要放到最后还原，否则"&amp;lt;"会被还原成"<"
+    table = tuple(reversed(table))
+    def unescape(text:str) -> str:
+        if mark not in text:
+            return text
+        for ch,rep in table:
+            if rep in text:
+                text = text.replace(rep,ch)
+        return text
+    return unescape
+
+
+# satori消息中的纯文本，引导符"&"必须在表的最前面
+_SATORI_TABLE = (("&","&amp;"),("\"","&quot;"),("<","&lt;"),(">","&gt;"))
+# CQ码中的纯文本和参数
+_CQ_TEXT_TABLE = (("&","&amp;"),("[","&#91;"),("]","&#93;"))
+_CQ_PARAMS_TABLE = _CQ_TEXT_TABLE + ((",","&#44;"),)
+# qq的消息内嵌格式(<@user_id>、<emoji:id>等)
+_QQ_TABLE = (("&","&amp;"),("<","&lt;"),(">","&gt;"))
+# kook的KMarkdown
+_KMARKDOWN_CHARS = "\\*~[()]->`"
+
+satori_escape = _make_escape(_SATORI_TABLE)
+cq_text_escape = _make_escape(_CQ_TEXT_TABLE)
+cq_text_unescape = _make_unescape(_CQ_TEXT_TABLE)
+cq_params_escape = _make_escape(_CQ_PARAMS_TABLE)
+cq_params_unescape = _make_unescape(_CQ_PARAMS_TABLE)
+qq_escape = _make_escape(_QQ_TABLE)
+qq_unescape = _make_unescape(_QQ_TABLE)
+kmarkdown_escape = _make_escape(tuple((ch,"\\" + ch) for ch in _KMARKDOWN_CHARS))
+
+# satori允许任意html字符引用，除了这5个以外的交给html.unescape
+_SATORI_OTHER_REF_RE = re.compile(r'&(?!(?:lt|gt|amp|quot|apos);)')
+_satori_unescape_basic = _make_unescape(_SATORI_TABLE + (("'","&apos;"),))
+
+def satori_unescape(text:str) -> str:
+    if "&" not in text:
+        return text
+    if _SATORI_OTHER_REF_RE.search(text):
+        return html.unescape(text)
+    return _satori_unescape_basic(text)
+
+
+def kmarkdown_unescape(text:str) -> str:
+    '''KMarkdown中"\\"后面的任意字符都按原样输出，末尾单独的"\\"丢弃'''
+    if "\\" not in text:
+        return text
+    # 按"\\"切开后，每一段的第一个字符就是被转义的字符，空段说明是"\\\\"或者末尾的"\\"
+    parts = text.split("\\")
+    ret = [parts[0]]
+    i = 1
+    count = len(parts)
+    while i < count:
+        part = parts[i]
+        if part:
+            ret.append(part)
+            i += 1
+        elif i + 1 < count:
+            ret.append("\\")
+            ret.append(parts[i + 1])
+            i += 2
+        else:
+            i += 1
+    return "".join(ret)
@@ -0,0 +1,159 @@
+import asyncio
+import tempfile
+import time
+from collections import deque
+
+from tool import get_json_or, encode_event_bytes
+
+
+class EventQueue:
+    '''适配器收到的事件在这里排队，等待分发给satori的订阅者
+        事件在放入时就编码好(见tool.encode_event_bytes)，队列中保存的是编码后的片段，
+        所以可以按字节数(UTF-8编码后的长度)限制容量，溢出到磁盘时也不需要再编码一次
+        配置项放在bot配置的"event_queue"字段中，均可省略：
+        {
+            "max_events":1000,           最多积压多少个事件
+            "max_bytes":16777216,        最多积压多少字节的事件
+            "overflow":"drop_oldest",    积压满时的处理方式，见下
+            "spill_dir":null             overflow为spill时临时文件所在的目录，不填使用系统临时目录
+        }
+        overflow为积压满时的处理方式：
+            drop_oldest：丢弃最旧的事件
+            drop_newest：丢弃新来的事件
+            block：阻塞适配器读取平台事件，直到队列有空位
+            spill：写入磁盘上的临时文件，内存中的事件取完后再按顺序读回来
+    '''
+    def __init__(self,config = {}) -> None:
+        cfg = get_json_or(config,"event_queue",{})
+        self._max_events = get_json_or(cfg,"max_events",1000)
+        self._max_bytes = get_json_or(cfg,"max_bytes",16 * 1024 * 1024)
+        self._overflow = get_json_or(cfg,"overflow","drop_oldest")
+        self._spill_dir = get_json_or(cfg,"spill_dir",None)
+        self._items = deque() # (编码后的片段,UTF-8字节数)
+        self._bytes = 0
+        self._not_empty = asyncio.Event()
+        self._not_full = asyncio.Event()
+        self._not_full.set()
+        self._spill_file = None
+        self._spill_pos = 0 # 下一个要读回的事件在文件中的位置
+        self._spill_count = 0 # 文件中还没读回的事件数
+        self.received = 0
+        self.dropped_oldest = 0
+        self.dropped_newest = 0
+        self.spilled = 0
+        self.blocked_seconds = 0.0
+        self.max_depth = 0
+
+    def _is_full(self,size:int) -> bool:
+        # 队列为空时总能放进一个事件，避免单个超大事件永远放不进去
+        if not self._items:
+            return False
+        return len(self._items) >= self._max_events or self._bytes + size > self._max_bytes
+
+    async def put(self,evt:dict) -> None:
+        '''放入一个事件，evt是satori事件模型to_dict得到的dict'''
+        # 编码得到的就是bytes，字节数直接取长度，不用再编码一次
+        data = encode_event_bytes(evt)
+        size = len(data)
+        body = data.decode()
+        self.received += 1
+        if self._spill_count:
+            # 已经有事件在磁盘上，后来的也写到磁盘，保证顺序
+            self._spill(data)
+            return
+        while self._is_full(size):
+            if self._overflow == "block":
+                start = time.monotonic()
+                self._not_full.clear()
+                await self._not_full.wait()
+                self.blocked_seconds += time.monotonic() - start
+            elif self._overflow == "drop_newest":
+                self.dropped_newest += 1
+                return
+            elif self._overflow == "spill":
+                self._spill(data)
+                return
+            else:
+                self._bytes -= self._items.popleft()[1]
+                self.dropped_oldest += 1
+        self._items.append((body,size))
+        self._bytes += size
+        if len(self._items) > self.max_depth:
+            self.max_depth = len(self._items)
+        self._not_empty.set()
+
+    async def wait_writable(self) -> None:
+        '''overflow为block时，适配器在读取下一个平台事件之前调用，队列满时在这里等待
+            其它方式下立即返回'''
+        if self._overflow != "block":
+            return
+        while self._is_full(0):
+            start = time.monotonic()
+            self._not_full.clear()
+            await self._not_full.wait()
+            self.blocked_seconds += time.monotonic() - start
+
+    async def get_many(self,max_count:int) -> list:
+        '''等到有事件为止，然后一次取出最多max_count个编码好的事件'''
+        while not self._items and not self._spill_count:
+            self._not_empty.clear()
+            await self._not_empty.wait()
+        if not self._items:
+            return self._unspill(max_count)
+        count = min(max_count,len(self._items))
+        ret = []
+        for _ in range(count):
+            body,size = self._items.popleft()
+            self._bytes -= size
+            ret.append(body)
+        self._not_full.set()
+        return ret
+
+    async def get(self) -> str:
+        return (await self.get_many(1))[0]
+
+    def _spill(self,data:bytes) -> None:
+        if self._spill_file == None:
+            self._spill_file = tempfile.TemporaryFile(dir=self._spill_dir)
+        # 编码后的json不含换行，一行一个事件
+        self._spill_file.seek(0,2)
+        self._spill_file.write(data + b"\n")
+        self._spill_count += 1
+        self.spilled += 1
+        self._not_empty.set()
+
+    def _unspill(self,max_count:int) -> list:
+        f = self._spill_file
+        f.seek(self._spill_pos)
+        ret = []
+        while len(ret) < max_count and len(ret) < self._spill_count:
+            ret.append(f.readline()[:-1].decode())
+        self._spill_pos = f.tell()
+        self._spill_count -= len(ret)
+        if self._spill_count == 0:
+            # 全部读回后清空文件，下次溢出从头写
+            f.seek(0)
+            f.truncate()
+            self._spill_pos = 0
+        return ret
+
+    def stats(self) -> dict:
+        return {
+            "overflow":self._overflow,
+            "depth":len(self._items),
+            "bytes":self._bytes,
+            "max_depth":self.max_depth,
+            "spill_depth":self._spill_count,
+            "received":self.received,
+            "dropped_oldest":self.dropped_oldest,
+            "dropped_newest":self.dropped_newest,
+            "spilled":self.spilled,
+            "blocked_seconds":round(self.blocked_seconds,3),
+        }
+
+    def close(self) -> None:
+        if self._spill_file != None:
+            self._spill_file.close()
+            self._spill_file = None
+            self._spill_pos = 0
+            self._spill_count = 0
@@ -0,0 +1,152 @@
+import asyncio
+import time
+from contextlib import asynccontextmanager
+from urllib.parse import urlsplit
+
+import httpx
+
+from tool import get_json_or
+from metrics import Histogram, route_label
+from log import get_logger
+
+_log = get_logger("http_pool")
+
+
+class HttpPool:
+    '''适配器持有的长连接http客户端，所有http请求都应该通过这里发出
+        配置项放在bot配置的"http_pool"字段中，均可省略：
+        {
+            "http2":false,               是否启用HTTP/2（需要安装h2）
+            "max_connections":100,       连接池总连接数
+            "max_keepalive":20,          保持的空闲长连接数
+            "keepalive_expiry":30,       空闲长连接保持的秒数
+            "max_per_host":10,           单个主机的并发连接数
+            "timeout":30,                读写超时秒数
+            "connect_timeout":10         建立连接的超时秒数
+        }
+        limiter是可选的RateLimiter，请求时传入route(和channel)才会经过限速
+    '''
+    def __init__(self,config = {},limiter = None) -> None:
+        cfg = get_json_or(config,"http_pool",{})
+        self._http2 = get_json_or(cfg,"http2",False)
+        self._max_connections = get_json_or(cfg,"max_connections",100)
+        self._max_keepalive = get_json_or(cfg,"max_keepalive",20)
+        self._keepalive_expiry = get_json_or(cfg,"keepalive_expiry",30)
+        self._max_per_host = get_json_or(cfg,"max_per_host",10)
+        self._timeout = get_json_or(cfg,"timeout",30)
+        self._connect_timeout = get_json_or(cfg,"connect_timeout",10)
+        self._client:httpx.AsyncClient = None
+        self._limiter = limiter
+        self._host_sem = {}
+        # 复用已有连接的请求数(hit)和新建连接的请求数(miss)
+        self.hit = 0
+        self.miss = 0
+        # 每个路由(id合并成":id")的请求耗时，没有route的请求按url的路径统计
+        self._latency = {}
+        self.inflight = 0
+
+    def _get_client(self) -> httpx.AsyncClient:
+        if self._client == None:
+            limits = httpx.Limits(
+                max_connections=self._max_connections,
+                max_keepalive_connections=self._max_keepalive,
+                keepalive_expiry=self._keepalive_expiry
+            )
+            timeout = httpx.Timeout(self._timeout,connect=self._connect_timeout)
+            try:
+                self._client = httpx.AsyncClient(limits=limits,timeout=timeout,http2=self._http2)
+            except ImportError:
+                _log.warning("未安装h2，HTTP/2不可用，使用HTTP/1.1")
+                self._http2 = False
+                self._client = httpx.AsyncClient(limits=limits,timeout=timeout)
+        return self._client
+
+    def _get_sem(self,url:str) -> asyncio.Semaphore:
+        host = urlsplit(url).netloc
+        sem = self._host_sem.get(host)
+        if sem == None:
+            sem = asyncio.Semaphore(self._max_per_host)
+            self._host_sem[host] = sem
+        return sem
+
+    def _trace(self,kwargs:dict) -> list:
+        '''给请求加上trace，返回的列表在新建连接时会被放入一个元素'''
+        new_conn = []
+        async def trace(event_name,info):
+            if event_name == "connection.connect_tcp.started":
+                new_conn.append(True)
+        extensions = kwargs.pop("extensions",{})
+        extensions["trace"] = trace
+        kwargs["extensions"] = extensions
+        return new_conn
+
+    def _count(self,new_conn:list) -> None:
+        if new_conn:
+            self.miss += 1
+        else:
+            self.hit += 1
+
+    async def request(self,method:str,url:str,route:str = None,channel = None,**kwargs) -> httpx.Response:
+        '''发出请求，参数与httpx.AsyncClient.request相同
+            route是限速用的API路由名，channel是限速用的频道，不传route时不限速'''
+        if route != None and self._limiter != None and self._limiter.enable:
+            return await self._limiter.call(route,channel,lambda: self._request(method,url,route,dict(kwargs)))
+        return await self._request(method,url,route,kwargs)
+
+    async def _request(self,method:str,url:str,route:str,kwargs:dict) -> httpx.Response:
+        client = self._get_client()
+        new_conn = self._trace(kwargs)
+        async with self._get_sem(url):
+            self.inflight += 1
+            start = time.perf_counter()
+            try:
+                ret = await client.request(method,url,**kwargs)
+            finally:
+                self.inflight -= 1
+                self._observe(route if route != None else urlsplit(url).path,time.perf_counter() - start)
+        self._count(new_conn)
+        return ret
+
+    def _observe(self,route:str,seconds:float) -> None:
+        # 先把路由中的id合并成":id"，否则每个频道、用户都会有自己的直方图
+        label = route_label(route)
+        hist = self._latency.get(label)
+        if hist == None:
+            hist = Histogram()
+            self._latency[label] = hist
+        hist.observe(seconds)
+
+    @asynccontextmanager
+    async def stream(self,method:str,url:str,**kwargs):
+        '''流式请求，参数与httpx.AsyncClient.stream相同，响应体需要在async with块中读取'''
+        client = self._get_client()
+        new_conn = self._trace(kwargs)
+        async with self._get_sem(url):
+            async with client.stream(method,url,**kwargs) as ret:
+                self._count(new_conn)
+                yield ret
+
+    async def get(self,url:str,**kwargs) -> httpx.Response:
+        return await self.request("GET",url,**kwargs)
+
+    async def post(self,url:str,**kwargs) -> httpx.Response:
+        return await self.request("POST",url,**kwargs)
+
+    def stats(self) -> dict:
+        '''连接池命中情况'''
+        return {
+            "hit":self.hit,
+            "miss":self.miss,
+            "http2":self._http2,
+        }
+
+    def metrics(self) -> dict:
+        '''请求耗时直方图，按合并了id的路由分开'''
+        latency = {label:hist.snapshot() for label,hist in self._latency.items()}
+        return {"inflight":self.inflight,"latency":latency}
+
+    async def aclose(self) -> None:
+        if self._client != None:
+            client = self._client
+            self._client = None
+            await client.aclose()
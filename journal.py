@@ -0,0 +1,313 @@
+import asyncio
+import bisect
+import mmap
+import os
+import struct
+import threading
+import time
+
+from tool import get_json_or
+from log import get_logger
+
+_log = get_logger("journal")
+
+# 数据文件中每条记录的头：sn(uint64)、帧长度(uint32)，后面跟utf-8编码的事件帧
+_RECORD_HEAD = struct.Struct("<QI")
+# 索引文件中每一项：sn(uint64)、记录在数据文件中的偏移(uint64)
+_INDEX_ITEM = struct.Struct("<QQ")
+# 写盘一直失败时内存中最多保留的事件数，超出时丢弃最旧的
+_MAX_PENDING = 100000
+
+
+class _Segment:
+    def __init__(self,dir_path:str,first_sn:int) -> None:
+        self.first_sn = first_sn
+        self.data_path = os.path.join(dir_path,"{:020d}.log".format(first_sn))
+        self.index_path = os.path.join(dir_path,"{:020d}.idx".format(first_sn))
+
+    def count(self) -> int:
+        return os.path.getsize(self.index_path) // _INDEX_ITEM.size
+
+    def size(self) -> int:
+        return os.path.getsize(self.data_path) + os.path.getsize(self.index_path)
+
+
+class Journal:
+    '''satori事件的追加写日志，用于satoricq重启后的事件重放和离线分析
+        事件按sn顺序写入分段文件，每个分段有一个数据文件(.log)和一个定长索引文件(.idx)，
+        两者都可以直接mmap读取。写入在内存中攒批，由后台任务定时写盘并fsync
+        配置项放在config.json的"journal"字段中：
+        {
+            "path":"journal",            日志目录
+            "segment_bytes":67108864,    单个分段的大小上限
+            "fsync_interval":1,          写盘间隔秒数
+            "fsync_batch":512,           攒够这么多条事件时立即写盘
+            "max_age":604800,            分段保留秒数，0表示不限制
+            "max_bytes":1073741824,      所有分段的总大小上限，0表示不限制
+            "max_replay":10000           重放时每次从日志中读取的事件数，分批读取直到补齐
+        }
+    '''
+    def __init__(self,config:dict) -> None:
+        self._path = get_json_or(config,"path","journal")
+        self._segment_bytes = get_json_or(config,"segment_bytes",64 * 1024 * 1024)
+        self._fsync_interval = get_json_or(config,"fsync_interval",1)
+        self._fsync_batch = get_json_or(config,"fsync_batch",512)
+        self._max_age = get_json_or(config,"max_age",7 * 24 * 3600)
+        self._max_bytes = get_json_or(config,"max_bytes",1024 * 1024 * 1024)
+        self.max_replay = get_json_or(config,"max_replay",10000)
+        self._segments = [] # 按first_sn排序
+        self._lock = threading.Lock() # 保护_segments和文件写入，写盘和读取都在线程中进行
+        self._data_file = None
+        self._index_file = None
+        self._last_sn = 0
+        self._written_sn = 0 # 已经写入索引的最后一个sn
+        self._broken = False # 上次写盘失败，下次写之前要先修复最后一个分段
+        self._pending = []
+        self._wakeup = asyncio.Event()
+        self._closing = False
+        self._task = None
+
+    async def open(self) -> None:
+        '''打开日志目录，修复未写完整的尾部，并开始后台写盘'''
+        await asyncio.to_thread(self._open)
+        self._task = asyncio.create_task(self._flush_loop())
+
+    def last_sn(self) -> int:
+        '''日志中最后一个事件的sn(包括还未写盘的)'''
+        return self._last_sn
+
+    def append(self,sn:int,frame:str) -> None:
+        '''追加一个事件，sn必须递增'''
+        self._pending.append((sn,frame))
+        self._last_sn = sn
+        if len(self._pending) >= self._fsync_batch:
+            self._wakeup.set()
+
+    async def read_range(self,after_sn:int,until_sn:int,limit:int = None) -> list:
+        '''读取after_sn之后、until_sn及之前的已写盘事件，返回[(sn,帧)]'''
+        if limit == None:
+            limit = self.max_replay
+        return await asyncio.to_thread(self.read_range_sync,after_sn,until_sn,limit)
+
+    async def close(self) -> None:
+        if self._task:
+            # 不能取消，线程中正在进行的写盘会和下面的写入交错，让后台任务写完最后一批后自己退出
+            self._closing = True
+            self._wakeup.set()
+            await self._task
+            self._task = None
+        batch = self._take_pending()
+        try:
+            await asyncio.to_thread(self._write_batch,batch)
+        except Exception as e:
+            _log.warning("退出时写入失败，丢失%s个事件 %s",len(batch),e)
+        with self._lock:
+            if self._data_file:
+                self._data_file.close()
+                self._index_file.close()
+                self._data_file = None
+                self._index_file = None
+
+    def _take_pending(self) -> list:
+        batch = self._pending
+        self._pending = []
+        return batch
+
+    def _requeue(self,batch:list) -> None:
+        '''写盘失败的事件放回_pending的开头，下次重试，已经写入索引的不再重复写'''
+        self._pending = [it for it in batch if it[0] > self._written_sn] + self._pending
+        if len(self._pending) > _MAX_PENDING:
+            # 丢弃后sn不连续，_write_batch会在缺口处换新的分段
+            dropped = len(self._pending) - _MAX_PENDING
+            del self._pending[:dropped]
+            _log.warning("写盘失败的事件过多，丢弃最旧的%s个",dropped)
+
+    async def _flush_loop(self) -> None:
+        while not self._closing:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(),self._fsync_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            batch = self._take_pending()
+            try:
+                await asyncio.to_thread(self._write_batch,batch)
+            except Exception as e:
+                _log.warning("写入失败，稍后重试 %s",e)
+                self._requeue(batch)
+                continue
+            try:
+                await asyncio.to_thread(self._apply_retention)
+            except Exception as e:
+                _log.warning("清理旧分段失败 %s",e)
+
+    def _open(self) -> None:
+        os.makedirs(self._path,exist_ok=True)
+        first_sns = []
+        for name in os.listdir(self._path):
+            if name.endswith(".log"):
+                first_sns.append(int(name[:-4]))
+        first_sns.sort()
+        self._segments = [_Segment(self._path,sn) for sn in first_sns]
+        for seg in self._segments:
+            if not os.path.exists(seg.index_path):
+                open(seg.index_path,"wb").close()
+        if self._segments:
+            self._repair(self._segments[-1])
+            last = self._segments[-1]
+            count = last.count()
+            if count == 0:
+                self._last_sn = last.first_sn - 1
+            else:
+                self._last_sn = last.first_sn + count - 1
+        self._written_sn = self._last_sn
+
+    def _repair(self,seg:_Segment) -> None:
+        '''截掉崩溃时没有写完整的记录，先写数据后写索引，所以从最后一条索引往前找第一条完整的记录'''
+        data_size = os.path.getsize(seg.data_path)
+        count = seg.count()
+        data_end = 0
+        with open(seg.index_path,"rb") as fi,open(seg.data_path,"rb") as fd:
+            while count > 0:
+                fi.seek((count - 1) * _INDEX_ITEM.size)
+                sn,offset = _INDEX_ITEM.unpack(fi.read(_INDEX_ITEM.size))
+                if sn == seg.first_sn + count - 1 and offset + _RECORD_HEAD.size <= data_size:
+                    fd.seek(offset)
+                    record_sn,length = _RECORD_HEAD.unpack(fd.read(_RECORD_HEAD.size))
+                    if record_sn == sn and offset + _RECORD_HEAD.size + length <= data_size:
+                        data_end = offset + _RECORD_HEAD.size + length
+                        break
+                count -= 1
+        with open(seg.index_path,"r+b") as f:
+            f.truncate(count * _INDEX_ITEM.size)
+        with open(seg.data_path,"r+b") as f:
+            f.truncate(data_end)
+
+    def _write_batch(self,batch:list) -> None:
+        '''写入一批事件，失败时抛出异常，已经写入索引的部分记在_written_sn中'''
+        if not batch:
+            return
+        with self._lock:
+            try:
+                if self._broken:
+                    self._recover()
+                self._write_locked(batch)
+            except BaseException:
+                self._broken = True
+                raise
+
+    def _write_locked(self,batch:list) -> None:
+        data = bytearray()
+        index = bytearray()
+        offset = 0
+        if self._data_file != None:
+            offset = self._data_file.tell()
+        next_sn = self._written_sn + 1
+        for sn,frame in batch:
+            # 分段内的sn必须连续(read_range_sync和_repair都依赖这一点)，有缺口时换新的分段
+            if self._data_file == None or offset >= self._segment_bytes or sn != next_sn:
+                self._commit(data,index,next_sn - 1)
+                data = bytearray()
+                index = bytearray()
+                self._rotate(sn)
+                offset = self._data_file.tell()
+            payload = frame.encode()
+            index += _INDEX_ITEM.pack(sn,offset)
+            data += _RECORD_HEAD.pack(sn,len(payload))
+            data += payload
+            offset += _RECORD_HEAD.size + len(payload)
+            next_sn = sn + 1
+        self._commit(data,index,next_sn - 1)
+
+    def _recover(self) -> None:
+        '''上次写盘失败后文件尾部可能有不完整的记录或索引项，关闭文件并修复最后一个分段，下次写入时重新打开'''
+        if self._data_file:
+            self._data_file.close()
+            self._index_file.close()
+            self._data_file = None
+            self._index_file = None
+        if self._segments:
+            last = self._segments[-1]
+            self._repair(last)
+            self._written_sn = last.first_sn + last.count() - 1
+        self._broken = False
+
+    def _commit(self,data:bytearray,index:bytearray,last_sn:int) -> None:
+        '''先把数据写盘，再写索引'''
+        if not data:
+            return
+        self._data_file.write(data)
+        self._data_file.flush()
+        os.fsync(self._data_file.fileno())
+        self._index_file.write(index)
+        self._index_file.flush()
+        os.fsync(self._index_file.fileno())
+        self._written_sn = last_sn
+
+    def _rotate(self,first_sn:int) -> None:
+        if self._data_file:
+            self._data_file.close()
+            self._index_file.close()
+        if self._segments and self._segments[-1].count() == 0:
+            # 最后一个分段是空的(比如刚启动)，直接复用
+            seg = self._segments.pop()
+            os.remove(seg.data_path)
+            os.remove(seg.index_path)
+        elif self._segments and os.path.getsize(self._segments[-1].data_path) < self._segment_bytes \
+                and self._segments[-1].first_sn + self._segments[-1].count() == first_sn:
+            # 重启后接着写上一个没满的分段
+            seg = self._segments[-1]
+            self._data_file = open(seg.data_path,"ab")
+            self._index_file = open(seg.index_path,"ab")
+            return
+        seg = _Segment(self._path,first_sn)
+        self._segments.append(seg)
+        self._data_file = open(seg.data_path,"ab")
+        self._index_file = open(seg.index_path,"ab")
+
+    def _apply_retention(self) -> None:
+        with self._lock:
+            now = time.time()
+            total = 0
+            for seg in self._segments:
+                total += seg.size()
+            # 正在写的最后一个分段不删除
+            while len(self._segments) > 1:
+                seg = self._segments[0]
+                too_old = self._max_age and now - os.path.getmtime(seg.data_path) > self._max_age
+                too_big = self._max_bytes and total > self._max_bytes
+                if not too_old and not too_big:
+                    break
+                total -= seg.size()
+                os.remove(seg.data_path)
+                os.remove(seg.index_path)
+                self._segments.pop(0)
+
+    def read_range_sync(self,after_sn:int,until_sn:int,limit:int) -> list:
+        '''同步读取，可以在离线分析脚本中直接使用'''
+        ret = []
+        with self._lock:
+            segments = list(self._segments)
+            # 只读已经写入索引的部分
+            counts = [seg.count() for seg in segments]
+        first_sns = [seg.first_sn for seg in segments]
+        pos = bisect.bisect_right(first_sns,after_sn + 1) - 1
+        if pos < 0:
+            pos = 0
+        for seg,count in zip(segments[pos:],counts[pos:]):
+            if count == 0:
+                continue
+            start = max(after_sn + 1 - seg.first_sn,0)
+            if start >= count:
+                continue
+            with open(seg.index_path,"rb") as fi,open(seg.data_path,"rb") as fd:
+                with mmap.mmap(fi.fileno(),0,access=mmap.ACCESS_READ) as index_map, \
+                        mmap.mmap(fd.fileno(),0,access=mmap.ACCESS_READ) as data_map:
+                    for i in range(start,count):
+                        sn,offset = _INDEX_ITEM.unpack_from(index_map,i * _INDEX_ITEM.size)
+                        if sn > until_sn or len(ret) >= limit:
+                            return ret
+                        _,length = _RECORD_HEAD.unpack_from(data_map,offset)
+                        begin = offset + _RECORD_HEAD.size
+                        ret.append((sn,data_map[begin:begin + length].decode()))
+        return ret
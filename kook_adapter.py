@@ -1,27 +1,38 @@
-import traceback
-import httpx
 from websockets import connect
 import asyncio
 from typing import Optional
-from asyncio import Queue
 import json
-import time
-import base64
 
 from tool import *
+from http_pool import HttpPool
+from event_queue import EventQueue
+from ratelimit import RateLimiter
+from escape import kmarkdown_escape, kmarkdown_unescape
+from media import MediaCache, MediaFetcher, cancel_tasks
+from log import get_logger
+
+_log = get_logger("kook")
 
 
 class AdapterKook:
     def __init__(self,config = {}) -> None:
         '''用于初始化一些配置信息，尽量不要在这里阻塞，因为此处不具备异步环境，如果你需要读写配置文件，请在init_after中进行'''
         self._access_token = config["access_token"]
-        self._http_url = "https://www.kookapp.cn/api/v3"
+        self._http_url = get_json_or(config,"http_url","https://www.kookapp.cn/api/v3") # 可以改成本地的测试服务器
         self._is_stop = False
         self._login_status = SatoriLogin.LoginStatus.DISCONNECT
-        self._queue = Queue(maxsize=100)
+        self._queue = EventQueue(config)
+        self._ws_disconnects = 0 # ws断开或连接失败的次数
         self._id = 0
         self._sn = 0
         self._self_id = None
+        self._self_user = None # 缓存的/user/me结果
+        self._self_user_lock = asyncio.Lock()
+        self._limiter = RateLimiter(config,"kook")
+        self._http = HttpPool(config,self._limiter)
+        self._media = MediaCache(config)
+        self._fetcher = MediaFetcher(config,self._http)
+        self._ws_task = None
 
 
     async def enable(self) -> None:
@@ -42,80 +53,100 @@ class AdapterKook:
             你可以在这个函数里面进行数据保存之类的，这种用途下，请阻塞这个函数，直到保存完成
         '''
         self._is_stop = True
+        if self._ws_task:
+            self._ws_task.cancel()
+        await self._http.aclose()
+        self._queue.close()
+        await self._media.aclose()
+
+    def get_media_stats(self) -> dict:
+        '''媒体上传缓存的命中情况'''
+        return self._media.stats()
+
+    def get_ratelimit_stats(self) -> dict:
+        '''出站限速的状态'''
+        return self._limiter.stats()
+
+    async def get_events(self,max_count:int) -> list:
+        '''阻塞并等待事件，一次返回最多max_count个编码好的事件，如果你的适配器不具备接收消息的能力，请不要写这个函数'''
+        return await self._queue.get_many(max_count)
 
-    async def get_msg(self) -> dict:
-        '''阻塞并等待消息返回，如果你的适配器不具备接收消息的能力，请不要写这个函数'''
-        return await self._queue.get()
+    def get_event_queue_stats(self) -> dict:
+        '''事件队列的积压和丢弃情况'''
+        return self._queue.stats()
+
+    def get_metrics(self) -> dict:
+        '''给/v1/admin/metrics使用的运行指标'''
+        return {
+            "event_queue":self._queue.stats(),
+            "api":self._http.metrics(),
+            "ws_disconnects":self._ws_disconnects,
+        }
     
 
-    async def _ws_recv(self,websocket):
+    async def _ws_heartbeat(self,websocket):
+        '''每30秒发送一次心跳，随连接一起被取消'''
         try:
-            reply = await asyncio.wait_for(websocket.recv(),0.1)
-            return reply
-        except asyncio.TimeoutError:
-            return None
+            while True:
+                await asyncio.sleep(30)
+                await websocket.send(json_dumps({"s": 2,"sn": self._sn}))
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            pass # 连接已断开，由接收循环处理
 
     async def _ws_connect(self):
         self._login_status = SatoriLogin.LoginStatus.CONNECT
         ws_url = (await self._api_call("/gateway/index?compress=0"))["url"]
         async with connect(ws_url) as websocket:
-            tm = time.time()
-            while not self._is_stop:
-                reply = await self._ws_recv(websocket)
-                if not reply:
-                    now_time = time.time()
-                    if now_time - tm > 30:
-                        tm = now_time
-                        await websocket.send(json.dumps({"s": 2,"sn": self._sn}))
-                    continue
-                js = json.loads(reply)
-                s = js["s"]
-                if s == 5:raise Exception("recv reset ws")
-                elif s == 3:pass # heartbeat
-                elif s == 1:
-                    self._login_status = SatoriLogin.LoginStatus.ONLINE
-                    print("kook:ws连接成功")
-                elif s == 0:
-                    self._sn = js["sn"]
-                    asyncio.create_task(self._event_deal(js["d"]))
+            heartbeat_task = asyncio.create_task(self._ws_heartbeat(websocket))
+            try:
+                while not self._is_stop:
+                    reply = await websocket.recv()
+                    js = json_loads(reply)
+                    s = js["s"]
+                    if s == 5:raise Exception("recv reset ws")
+                    elif s == 3:pass # heartbeat
+                    elif s == 1:
+                        self._login_status = SatoriLogin.LoginStatus.ONLINE
+                        _log.info("ws连接成功")
+                        asyncio.create_task(self._refresh_self_user())
+                    elif s == 0:
+                        self._sn = js["sn"]
+                        await self._queue.wait_writable() # overflow为block时，队列满了就暂停读取
+                        asyncio.create_task(self._event_deal(js["d"]))
+            finally:
+                heartbeat_task.cancel()
 
     async def _ws_server(self) -> None:
-        while not self._is_stop:
-            try:
-                await self._ws_connect()
-            except:
-                self._login_status = SatoriLogin.LoginStatus.DISCONNECT
-                print(traceback.format_exc())
-                await asyncio.sleep(3)
-        self._login_status = SatoriLogin.LoginStatus.DISCONNECT
+        try:
+            while not self._is_stop:
+                try:
+                    await self._ws_connect()
+                except Exception:
+                    self._login_status = SatoriLogin.LoginStatus.DISCONNECT
+                    _log.exception("ws连接断开，3秒后重连")
+                    await asyncio.sleep(3)
+                if not self._is_stop:
+                    self._ws_disconnects += 1
+        finally:
+            self._login_status = SatoriLogin.LoginStatus.DISCONNECT
 
     async def init_after(self) -> None:
         '''适配器创建之后会调用一次，应该在这里进行ws连接等操作，如果不需要，可以不写'''
-        asyncio.create_task(self._ws_server())
+        await self._media.load()
+        self._ws_task = asyncio.create_task(self._ws_server())
 
     def _kook_msg_to_satori(self,msg_type:int,message:str)->str:
         ret = ""
         if msg_type == 2: #图片
             ret += "<img src={}/>".format(json.dumps(message))
         else:
-            def kook_msg_f(msg):
-                ret = ""
-                is_f = False
-                for ch in msg:
-                    if is_f:
-                        is_f = False
-                        ret += ch
-                    elif ch == "\\":
-                        is_f = True
-                    else:
-                        ret += ch
-                return ret
-            
             index = 0
             msg_list = message.split("(met)")
             for it in msg_list:
                 if index % 2 == 0:
-                    ret += satori_to_plain(kook_msg_f(it))
+                    ret += satori_to_plain(kmarkdown_unescape(it))
                 else:
                     if it == "all":
                         ret += "<at type=\"all\"/>"
@@ -169,7 +200,7 @@ class AdapterKook:
             )
         )
         self._id += 1
-        self._queue.put_nowait(satori_evt.to_dict())
+        await self._queue.put(satori_evt.to_dict())
 
     async def _deal_private_message_event(self,data,user_id:str):
 
@@ -205,22 +236,21 @@ class AdapterKook:
             platform="kook"
         ).to_dict()
         self._id += 1
-        self._queue.put_nowait(satori_evt)
+        await self._queue.put(satori_evt)
 
     async def _deal_group_increase_event(self,data):
         extra = data["extra"]
-        satori_evt = {
-            "id":self._id,
-            "type":"guild-member-added",
-            "platform":"kook",
-            "self_id":self._self_id,
-            "timestamp":data["msg_timestamp"],
-            "guild":SatoriGuild(id=data["target_id"]).to_dict(),
-            "member":SatoriGuildMember(joined_at=extra["body"]["joined_at"]).to_dict(),
-            "user":SatoriUser(id=extra["body"]["user_id"]).to_dict()
-        }
+        satori_evt = SatoriGuildMemberAddedEvent(
+            id=self._id,
+            platform="kook",
+            self_id=self._self_id,
+            timestamp=data["msg_timestamp"],
+            guild=SatoriGuild(id=data["target_id"]),
+            member=SatoriGuildMember(joined_at=extra["body"]["joined_at"]),
+            user=SatoriUser(id=extra["body"]["user_id"])
+        )
         self._id += 1
-        self._queue.put_nowait(satori_evt)
+        await self._queue.put(satori_evt.to_dict())
 
 
 
@@ -255,25 +285,19 @@ class AdapterKook:
             else:
                 await self._deal_person_evt(data)
         except:
-            print(traceback.format_exc())
+            _log.exception("处理事件失败")
     
-    async def _api_call(self,path,data = None) -> dict:
+    async def _api_call(self,path,data = None,channel = None) -> dict:
         url:str = self._http_url + path
         headers = {"Authorization":"Bot {}".format(self._access_token)}
+        route = path.split("?")[0]
         if data == None:
-            async with httpx.AsyncClient() as client:
-                return (await client.get(url,headers=headers)).json()["data"]
+            return json_loads((await self._http.get(url,headers=headers,route=route)).content)["data"]
         else:
-            async with httpx.AsyncClient() as client:
-                return (await client.post(url,headers=headers,data=data)).json()["data"]
+            return json_loads((await self._http.post(url,headers=headers,data=data,route=route,channel=channel)).content)["data"]
 
     def _make_kook_text(self,text):
-        ret = ""
-        for ch in text:
-            if ch in ["\\","*","~","[","(",")","]","-",">","`"]:
-                ret += "\\"
-            ret += ch
-        return ret
+        return kmarkdown_escape(text)
     
     async def _satori_to_kook(self,satori_obj) -> [dict]:
         to_send_data = []
@@ -309,23 +333,11 @@ class AdapterKook:
                         last_type = 1
                 elif node["type"] == "img":
                     img_url:str = node["attrs"]["src"]
-                    kook_img_url = ""
                     if img_url.startswith("https://img.kookapp.cn"):
                         kook_img_url = img_url
                     else:
-                        if img_url.startswith("data:image/"):
-                            base64_start = img_url.find("base64,")
-                            img_content = base64.b64decode(img_url[base64_start + 7:])
-                        else:
-                            async with httpx.AsyncClient() as client:
-                                img_content =  (await client.get(img_url)).content
-                        files = {
-                            'file':('test',img_content)
-                        }
-                        headers = {"Authorization":"Bot {}".format(self._access_token)}
-                        async with httpx.AsyncClient() as client:
-                            ret =  (await client.post(self._http_url + "/asset/create",files=files,headers=headers)).json()
-                            kook_img_url = ret["data"]["url"]
+                        # 图片在后台并发准备，create_message发到这一段时再等待
+                        kook_img_url = asyncio.create_task(self._prepare_kook_img(img_url))
                     to_send_data.append({
                         "type":2,
                         "content":kook_img_url
@@ -333,27 +345,61 @@ class AdapterKook:
                     last_type = 2
         return to_send_data
     
+    async def _prepare_kook_img(self,img_url:str) -> str:
+        '''下载图片并上传到kook，返回kook的图片地址'''
+        async with self._fetcher.limit:
+            with await self._fetcher.fetch(img_url) as media:
+                async def upload() -> str:
+                    files = {
+                        'file':('test',media.upload_body())
+                    }
+                    headers = {"Authorization":"Bot {}".format(self._access_token)}
+                    ret =  json_loads((await self._http.post(self._http_url + "/asset/create",files=files,headers=headers,route="/asset/create")).content)
+                    return ret["data"]["url"]
+                return await self._media.get_or_upload("kook",media.sha256,upload)
+
     async def create_message(self,platform:str,self_id:str,channel_id:str,content:str):
         '''发送消息'''
         satori_obj = parse_satori_html(content)
         to_sends = await self._satori_to_kook(satori_obj)
         if channel_id.startswith("GROUP_"):
-            channel_id = int(channel_id[6:])
-            to_ret = []
-            for it in to_sends:
-                ret = await self._api_call("/message/create",{"content":it["content"],"type":it["type"],"target_id":channel_id})
-                to_ret.append(SatoriMessage(id=ret["msg_id"],content="").to_dict())
-            return to_ret
+            path = "/message/create"
+            target_id = int(channel_id[6:])
         else:
+            path = "/direct-message/create"
+            target_id = channel_id
+        tasks = [it["content"] for it in to_sends if isinstance(it["content"],asyncio.Task)]
+        try:
             to_ret = []
+            # 按顺序发送，图片段发送前才等待它准备好，前面的段不用等后面的图片
             for it in to_sends:
-                ret = await self._api_call("/direct-message/create",{"content":it["content"],"type":it["type"],"target_id":channel_id})
+                content = it["content"]
+                if isinstance(content,asyncio.Task):
+                    content = await content
+                ret = await self._api_call(path,{"content":content,"type":it["type"],"target_id":target_id},channel=target_id)
                 to_ret.append(SatoriMessage(id=ret["msg_id"],content="").to_dict())
             return to_ret
+        finally:
+            cancel_tasks(tasks)
     
+    async def _get_self_user(self,refresh:bool = False) -> dict:
+        '''获取bot自己的信息，结果会被缓存，同时只会有一个请求'''
+        async with self._self_user_lock:
+            if refresh or self._self_user == None:
+                self._self_user = await self._api_call("/user/me")
+                self._self_id = self._self_user["id"]
+        return self._self_user
+
+    async def _refresh_self_user(self) -> None:
+        '''网关重新连接后刷新缓存的bot信息'''
+        try:
+            await self._get_self_user(refresh=True)
+        except Exception:
+            _log.exception("刷新bot信息失败")
+
     async def get_login(self,platform:Optional[str],self_id:Optional[str]) -> [dict]:
         '''获取登录信息，如果platform和self_id为空，那么应该返回一个列表'''
-        obret =  (await self._api_call("/user/me"))
+        obret =  await self._get_self_user()
         satori_ret = SatoriLogin(
             status=self._login_status,
             user=SatoriUser(
@@ -365,7 +411,6 @@ class AdapterKook:
             self_id=obret["id"],
             platform="kook"
         ).to_dict()
-        self._self_id = obret["id"]
         if platform == None and self_id == None:
             return [satori_ret]
         else:
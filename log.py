@@ -0,0 +1,100 @@
+'''日志，基于标准库logging
+    日志先放进队列，由后台线程写到控制台和文件，事件循环不会阻塞在stdout上
+    每条日志属于一个分类(logger名为"satori.分类")，可以分别设置级别和采样率：
+        _log = get_logger("qq")
+        _log.debug("收到 %s",lazy(json_dumps,js))
+    参数用%格式延迟格式化，级别不够或者被采样掉的日志不会格式化，lazy包装的函数也不会被调用
+    配置放在config.json的"log"字段中，均可省略：
+    {
+        "level":"INFO",                           默认级别
+        "levels":{"ws.send":"DEBUG"},             各分类的级别
+        "sample":{"ws.send":0.01},                各分类的采样率(0~1)，只作用于WARNING以下的日志
+        "file":null,                              同时写入这个文件
+        "format":"%(asctime)s %(levelname)s %(name)s: %(message)s"
+    }
+'''
+import atexit
+import logging
+import logging.handlers
+import queue
+
+_ROOT = "satori"
+_DEFAULT_FORMAT = "%(asctime)s %(levelname)s %(name)s: %(message)s"
+
+_listener = None
+_config = {}
+
+
+class lazy:
+    '''日志参数，真正输出时才调用func(*args)得到字符串'''
+    __slots__ = ("_func","_args")
+    def __init__(self,func,*args) -> None:
+        self._func = func
+        self._args = args
+    def __str__(self) -> str:
+        return str(self._func(*self._args))
+
+
+class _SampleFilter(logging.Filter):
+    '''每every条WARNING以下的日志只保留一条，用计数而不是随机数，开销固定'''
+    def __init__(self,rate:float) -> None:
+        super().__init__()
+        self._every = max(1,round(1 / rate)) if rate > 0 else 0
+        self._count = 0
+    def filter(self,record:logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING:
+            return True
+        if self._every == 0:
+            return False
+        self._count += 1
+        if self._count >= self._every:
+            self._count = 0
+            return True
+        return False
+
+
+def get_logger(category:str) -> logging.Logger:
+    return logging.getLogger(_ROOT + "." + category)
+
+
+def setup_logging(config:dict = {}) -> None:
+    '''按配置设置级别和采样，并启动后台写日志的线程，可以重复调用'''
+    global _listener,_config
+    _config = config
+    root = logging.getLogger(_ROOT)
+    root.setLevel(config.get("level","INFO"))
+    for category,level in config.get("levels",{}).items():
+        get_logger(category).setLevel(level)
+    for category,rate in config.get("sample",{}).items():
+        logger = get_logger(category)
+        for old in [f for f in logger.filters if isinstance(f,_SampleFilter)]:
+            logger.removeFilter(old)
+        logger.addFilter(_SampleFilter(rate))
+    formatter = logging.Formatter(config.get("format",_DEFAULT_FORMAT))
+    handlers = [logging.StreamHandler()]
+    if config.get("file") != None:
+        handlers.append(logging.FileHandler(config["file"],encoding="utf-8"))
+    for handler in handlers:
+        handler.setFormatter(formatter)
+    if _listener != None:
+        _listener.stop()
+    for old in list(root.handlers):
+        root.removeHandler(old)
+    log_queue = queue.SimpleQueue()
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+    root.propagate = False
+    _listener = logging.handlers.QueueListener(log_queue,*handlers)
+    _listener.start()
+
+
+def current_config() -> dict:
+    '''当前的日志配置，工作进程用它设置自己的日志'''
+    return _config
+
+
+def _stop() -> None:
+    # 退出前把队列中剩下的日志写完
+    if _listener != None:
+        _listener.stop()
+
+atexit.register(_stop)
@@ -0,0 +1,267 @@
+import asyncio
+import base64
+import hashlib
+import os
+import tempfile
+from collections import OrderedDict
+
+from tool import get_json_or, json_loads, json_dumps
+from log import get_logger
+
+_log = get_logger("media")
+
+
+class MediaCache:
+    '''按内容寻址的媒体上传缓存，记录(范围,sha256)到平台url的对应关系，同样的图片只上传一次
+        范围由适配器决定，比如"kook"，或者带上bot_id的"mihoyo:bot_xxx"
+        配置项放在bot配置的"media_cache"字段中，均可省略：
+        {
+            "max_items":4096,            最多缓存多少个url，超出时淘汰最久没用过的
+            "path":null                  持久化文件路径，不填则只缓存在内存中
+        }
+    '''
+    def __init__(self,config = {}) -> None:
+        cfg = get_json_or(config,"media_cache",{})
+        self._max_items = get_json_or(cfg,"max_items",4096)
+        self._path = get_json_or(cfg,"path",None)
+        self._items = OrderedDict() # (范围,sha256) -> url，最近用过的在最后
+        self._uploading = {} # 正在上传的key -> Future，相同的图片同时发送时只上传一次
+        self._dirty = False
+        self._save_task = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    async def load(self) -> None:
+        '''从持久化文件中恢复缓存，文件不存在或损坏时忽略'''
+        if self._path == None or not os.path.exists(self._path):
+            return
+        try:
+            items = await asyncio.to_thread(self._read_file)
+        except Exception as e:
+            _log.warning("读取失败 %s",e)
+            return
+        for scope,digest,url in items[-self._max_items:]:
+            self._items[(scope,digest)] = url
+
+    def get(self,scope:str,digest:str):
+        '''返回之前上传得到的url，没有则返回None'''
+        key = (scope,digest)
+        url = self._items.get(key)
+        if url == None:
+            self.misses += 1
+            return None
+        self._items.move_to_end(key)
+        self.hits += 1
+        return url
+
+    def put(self,scope:str,digest:str,url:str) -> None:
+        key = (scope,digest)
+        self._items[key] = url
+        self._items.move_to_end(key)
+        while len(self._items) > self._max_items:
+            self._items.popitem(last=False)
+            self.evictions += 1
+        self._schedule_save()
+
+    async def get_or_upload(self,scope:str,digest:str,upload) -> str:
+        '''命中时直接返回url，否则调用upload()上传并缓存结果
+            digest是内容的sha256，upload是无参数的协程函数，返回平台的url'''
+        url = self.get(scope,digest)
+        if url != None:
+            return url
+        key = (scope,digest)
+        fut = self._uploading.get(key)
+        while fut != None:
+            url = await asyncio.shield(fut)
+            if url != None:
+                return url
+            # 负责上传的调用者被取消了，等待新的上传者，或者自己来上传
+            fut = self._uploading.get(key)
+        fut = asyncio.get_running_loop().create_future()
+        self._uploading[key] = fut
+        try:
+            url = await upload()
+            self.put(scope,digest,url)
+            fut.set_result(url)
+            return url
+        except asyncio.CancelledError:
+            # 取消只属于这个调用者，其它等待者得到None后重新上传
+            fut.set_result(None)
+            raise
+        except Exception as e:
+            fut.set_exception(e)
+            # 没有其它等待者时，避免"Future exception was never retrieved"
+            fut.exception()
+            raise
+        finally:
+            del self._uploading[key]
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "size":len(self._items),
+            "hits":self.hits,
+            "misses":self.misses,
+            "evictions":self.evictions,
+            "hit_rate":self.hits / total if total else 0.0,
+        }
+
+    async def aclose(self) -> None:
+        '''保存未写盘的修改'''
+        if self._save_task:
+            await self._save_task
+        if self._dirty:
+            await self._save()
+
+    def _schedule_save(self) -> None:
+        if self._path == None:
+            return
+        self._dirty = True
+        if self._save_task == None or self._save_task.done():
+            self._save_task = asyncio.create_task(self._save_loop())
+
+    async def _save_loop(self) -> None:
+        # 上传期间的多次修改合并成一次写盘
+        while self._dirty:
+            await asyncio.sleep(1)
+            await self._save()
+
+    async def _save(self) -> None:
+        self._dirty = False
+        items = [[scope,digest,url] for (scope,digest),url in self._items.items()]
+        try:
+            await asyncio.to_thread(self._write_file,items)
+        except Exception as e:
+            _log.warning("保存失败 %s",e)
+
+    def _read_file(self) -> list:
+        with open(self._path,"rb") as f:
+            return json_loads(f.read())
+
+    def _write_file(self,items:list) -> None:
+        # 先写临时文件再替换，避免写到一半崩溃时留下损坏的文件
+        tmp_path = self._path + ".tmp"
+        with open(tmp_path,"w",encoding="utf-8") as f:
+            f.write(json_dumps(items))
+        os.replace(tmp_path,self._path)
+
+
+class MediaError(Exception):
+    '''媒体下载失败：超过大小限制、超时或者对方返回错误'''
+
+
+class FetchedMedia:
+    '''下载好的媒体，小于spool_bytes时放在内存中，否则放在临时文件中
+        用完需要close，可以用with语句'''
+    def __init__(self,spool_bytes:int) -> None:
+        self._spool_bytes = spool_bytes
+        self._buf = bytearray()
+        self._file = None
+        self._sha256 = hashlib.sha256()
+        self._md5 = hashlib.md5()
+        self.size = 0
+        self.head = b"" # 开头的一小段，用于判断图片格式
+
+    def write(self,chunk:bytes) -> None:
+        self._sha256.update(chunk)
+        self._md5.update(chunk)
+        self.size += len(chunk)
+        if len(self.head) < 32:
+            self.head += chunk[:32 - len(self.head)]
+        if self._file != None:
+            self._file.write(chunk)
+            return
+        self._buf += chunk
+        if len(self._buf) > self._spool_bytes:
+            self._file = tempfile.TemporaryFile()
+            self._file.write(self._buf)
+            self._buf = None
+
+    @property
+    def sha256(self) -> str:
+        return self._sha256.hexdigest()
+
+    @property
+    def md5(self) -> str:
+        return self._md5.hexdigest()
+
+    def upload_body(self):
+        '''用于httpx的files参数：内存中的返回bytes，临时文件返回文件对象，httpx会分块读取'''
+        if self._file == None:
+            return bytes(self._buf)
+        self._file.seek(0)
+        return self._file
+
+    def close(self) -> None:
+        if self._file != None:
+            self._file.close()
+            self._file = None
+        self._buf = bytearray()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*args) -> None:
+        self.close()
+
+
+class MediaFetcher:
+    '''流式下载要发送的媒体，边下载边计算哈希，大文件写入临时文件而不是全部放在内存中
+        配置项放在bot配置的"media_fetch"字段中，均可省略：
+        {
+            "max_bytes":33554432,        单个文件的大小上限
+            "spool_bytes":1048576,       超过这个大小的文件放到临时文件中
+            "timeout":60,                单个文件的下载总时间上限(秒)
+            "concurrency":4              每个bot同时准备(下载并上传)的图片数，由这个bot的所有消息共用
+        }
+    '''
+    def __init__(self,config,http) -> None:
+        cfg = get_json_or(config,"media_fetch",{})
+        self._max_bytes = get_json_or(cfg,"max_bytes",32 * 1024 * 1024)
+        self._spool_bytes = get_json_or(cfg,"spool_bytes",1024 * 1024)
+        self._timeout = get_json_or(cfg,"timeout",60)
+        self._http = http
+        # 适配器准备图片时持有，限制这个bot同时下载上传的图片数(所有消息共用，不是每条消息各自计算)
+        self.limit = asyncio.Semaphore(get_json_or(cfg,"concurrency",4))
+
+    async def fetch(self,url:str) -> FetchedMedia:
+        '''下载url，也支持data:xxx;base64,xxx格式'''
+        media = FetchedMedia(self._spool_bytes)
+        try:
+            if url.startswith("data:"):
+                base64_start = url.find("base64,")
+                self._write(media,base64.b64decode(url[base64_start + 7:]))
+            else:
+                await asyncio.wait_for(self._download(url,media),self._timeout)
+        except asyncio.TimeoutError:
+            media.close()
+            raise MediaError("media:下载超时 {}".format(url))
+        except BaseException:
+            media.close()
+            raise
+        return media
+
+    async def _download(self,url:str,media:FetchedMedia) -> None:
+        async with self._http.stream("GET",url) as res:
+            if res.status_code >= 400:
+                raise MediaError("media:下载失败 {} {}".format(res.status_code,url))
+            length = res.headers.get("Content-Length")
+            if length != None and length.isdigit() and int(length) > self._max_bytes:
+                raise MediaError("media:文件过大 {} {}".format(length,url))
+            async for chunk in res.aiter_bytes():
+                self._write(media,chunk)
+
+    def _write(self,media:FetchedMedia,chunk:bytes) -> None:
+        if media.size + len(chunk) > self._max_bytes:
+            raise MediaError("media:文件超过{}字节".format(self._max_bytes))
+        media.write(chunk)
+
+
+def cancel_tasks(tasks) -> None:
+    '''消息发送失败时取消还没完成的图片准备任务，已经结束的取走异常，避免"Task exception was never retrieved"'''
+    for task in tasks:
+        if not task.done():
+            task.cancel()
+        elif not task.cancelled():
+            task.exception()
@@ -0,0 +1,119 @@
+'''运行指标，由管理接口/v1/admin/metrics以Prometheus文本格式输出
+    热路径上只做计数和直方图的累加，格式化全部在抓取时进行，可以一直开着
+    适配器的指标由适配器的get_metrics返回普通的dict(可以经过工作进程的管道)，satori汇总后输出
+'''
+import bisect
+import re
+
+# API耗时直方图的桶上限(秒)
+DEFAULT_BUCKETS = (0.005,0.01,0.025,0.05,0.1,0.25,0.5,1.0,2.5,5.0,10.0)
+
+
+class Histogram:
+    __slots__ = ("bounds","counts","sum","count")
+    def __init__(self,bounds:tuple = DEFAULT_BUCKETS) -> None:
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1) # 每个桶单独计数，最后一个是+Inf，输出时再累加
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self,value:float) -> None:
+        self.counts[bisect.bisect_left(self.bounds,value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def snapshot(self) -> dict:
+        return {"bounds":list(self.bounds),"counts":list(self.counts),"sum":self.sum,"count":self.count}
+
+
+# 路由中的id替换成":id"，避免标签的取值无限增长
+# 只替换像id的段：纯数字、16位以上的十六进制，或者16位以上且带数字的openid之类
+# getUploadImageParams这样不带数字的长方法名不是id，保持原样
+_ROUTE_ID_RE = re.compile(r'/(?:\d+|[0-9A-Fa-f]{16,}|(?=[A-Za-z_-]*\d)[0-9A-Za-z_-]{16,})(?=/|$)')
+_route_labels = {}
+
+def route_label(route:str) -> str:
+    label = _route_labels.get(route)
+    if label == None:
+        label = _ROUTE_ID_RE.sub("/:id",route)
+        if len(_route_labels) < 4096:
+            _route_labels[route] = label
+    return label
+
+
+def _escape_label(value) -> str:
+    return str(value).replace("\\","\\\\").replace("\"","\\\"").replace("\n","\\n")
+
+
+def _format_labels(labels:dict) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(k,_escape_label(v)) for k,v in labels.items()) + "}"
+
+
+def _format_value(value) -> str:
+    if isinstance(value,bool):
+        return "1" if value else "0"
+    if isinstance(value,float):
+        if value == float("inf"):
+            return "+Inf"
+        return repr(value)
+    return str(value)
+
+
+class MetricsWriter:
+    '''按指标名分组收集样本，render输出Prometheus文本格式'''
+    def __init__(self) -> None:
+        self._families = {} # 指标名 -> (类型,说明,样本行列表)
+
+    def _lines(self,name:str,kind:str,help:str) -> list:
+        family = self._families.get(name)
+        if family == None:
+            family = (kind,help,[])
+            self._families[name] = family
+        return family[2]
+
+    def counter(self,name:str,help:str,labels:dict,value) -> None:
+        self._lines(name,"counter",help).append(name + _format_labels(labels) + " " + _format_value(value))
+
+    def gauge(self,name:str,help:str,labels:dict,value) -> None:
+        self._lines(name,"gauge",help).append(name + _format_labels(labels) + " " + _format_value(value))
+
+    def histogram(self,name:str,help:str,labels:dict,snapshot:dict) -> None:
+        '''snapshot是Histogram.snapshot()的结果'''
+        lines = self._lines(name,"histogram",help)
+        total = 0
+        for bound,count in zip(snapshot["bounds"] + [float("inf")],snapshot["counts"]):
+            total += count
+            lines.append(name + "_bucket" + _format_labels({**labels,"le":_format_value(float(bound))}) + " " + str(total))
+        lines.append(name + "_sum" + _format_labels(labels) + " " + _format_value(float(snapshot["sum"])))
+        lines.append(name + "_count" + _format_labels(labels) + " " + str(snapshot["count"]))
+
+    def render(self) -> str:
+        out = []
+        for name,(kind,help,lines) in self._families.items():
+            out.append("# HELP {} {}".format(name,help))
+            out.append("# TYPE {} {}".format(name,kind))
+            out += lines
+        out.append("")
+        return "\n".join(out)
+
+
+def write_adapter_metrics(writer:MetricsWriter,labels:dict,metrics:dict) -> None:
+    '''输出一个适配器get_metrics的结果'''
+    queue = metrics.get("event_queue")
+    if queue != None:
+        writer.counter("satori_adapter_events_received_total","适配器收到并放入事件队列的事件数",labels,queue["received"])
+        writer.gauge("satori_adapter_queue_depth","事件队列中积压的事件数",labels,queue["depth"] + queue["spill_depth"])
+        writer.gauge("satori_adapter_queue_bytes","事件队列内存中积压的字节数",labels,queue["bytes"])
+        writer.counter("satori_adapter_events_dropped_total","事件队列满时丢弃的事件数",{**labels,"reason":"oldest"},queue["dropped_oldest"])
+        writer.counter("satori_adapter_events_dropped_total","事件队列满时丢弃的事件数",{**labels,"reason":"newest"},queue["dropped_newest"])
+        writer.counter("satori_adapter_events_spilled_total","事件队列满时写入磁盘的事件数",labels,queue["spilled"])
+        writer.counter("satori_adapter_queue_blocked_seconds_total","事件队列满时阻塞读取的总时间",labels,queue["blocked_seconds"])
+    if "ws_disconnects" in metrics:
+        writer.counter("satori_adapter_ws_disconnects_total","与平台的ws连接断开或连接失败的次数",labels,metrics["ws_disconnects"])
+    api = metrics.get("api")
+    if api != None:
+        writer.gauge("satori_api_requests_inflight","正在进行的平台API请求数",labels,api["inflight"])
+        for route,snapshot in api["latency"].items():
+            writer.histogram("satori_api_request_duration_seconds","平台API请求的耗时，不含本地限速排队的时间",{**labels,"route":route},snapshot)
@@ -1,16 +1,17 @@
-import traceback
-import httpx
 from websockets import connect
 import asyncio
 from typing import Optional
-from asyncio import Queue
-import json
 import time
-import hashlib
 import imghdr
-import base64
 
 from tool import *
+from http_pool import HttpPool
+from event_queue import EventQueue
+from ratelimit import RateLimiter
+from media import MediaCache, MediaFetcher, cancel_tasks
+from log import get_logger, lazy
+
+_log = get_logger("mihoyo")
 
 
 from dataclasses import dataclass
@@ -325,18 +326,38 @@ class RobotEventExtendDataClickMsgComponentInfo(betterproto.Message):
 class RobotEventMessage(betterproto.Message):
     event: "RobotEvent" = betterproto.message_field(1)
 
+
+# 转换成<at>的实体类型，其余的(链接、房间、样式等)保留原文
+_MIHOYO_MENTION_TYPES = ("mention_all","mentioned_robot","mentioned_user")
+
+
+def _entity_offset(en) -> int:
+    return en["offset"]
+
+
+def _utf16_len(text:str) -> int:
+    '''大别野的offset和length使用的长度'''
+    return len(text.encode("utf-16-le")) // 2
+
+
 class AdapterMihoyo:
     def __init__(self,config = {}) -> None:
         '''用于初始化一些配置信息，尽量不要在这里阻塞，因为此处不具备异步环境，如果你需要读写配置文件，请在init_after中进行'''
-        self._http_url = "https://bbs-api.miyoushe.com"
+        self._http_url = get_json_or(config,"http_url","https://bbs-api.miyoushe.com") # 可以改成本地的测试服务器
         self._is_stop = False
         self._login_status = SatoriLogin.LoginStatus.DISCONNECT
-        self._queue = Queue(maxsize=100)
+        self._queue = EventQueue(config)
+        self._ws_disconnects = 0 # ws断开或连接失败的次数
         self._id = 0
         self._sn = 1
         self._self_id = config["bot_id"]
         self._secret = config["secret"]
         self._villa_id = config["villa_id"]
+        self._limiter = RateLimiter(config,"mihoyo")
+        self._http = HttpPool(config,self._limiter)
+        self._media = MediaCache(config)
+        self._fetcher = MediaFetcher(config,self._http)
+        self._ws_task = None
 
 
     async def enable(self) -> None:
@@ -357,10 +378,35 @@ class AdapterMihoyo:
             你可以在这个函数里面进行数据保存之类的，这种用途下，请阻塞这个函数，直到保存完成
         '''
         self._is_stop = True
-
-    async def get_msg(self) -> dict:
-        '''阻塞并等待消息返回，如果你的适配器不具备接收消息的能力，请不要写这个函数'''
-        return await self._queue.get()
+        if self._ws_task:
+            self._ws_task.cancel()
+        await self._http.aclose()
+        self._queue.close()
+        await self._media.aclose()
+
+    def get_media_stats(self) -> dict:
+        '''媒体上传缓存的命中情况'''
+        return self._media.stats()
+
+    def get_ratelimit_stats(self) -> dict:
+        '''出站限速的状态'''
+        return self._limiter.stats()
+
+    async def get_events(self,max_count:int) -> list:
+        '''阻塞并等待事件，一次返回最多max_count个编码好的事件，如果你的适配器不具备接收消息的能力，请不要写这个函数'''
+        return await self._queue.get_many(max_count)
+
+    def get_event_queue_stats(self) -> dict:
+        '''事件队列的积压和丢弃情况'''
+        return self._queue.stats()
+
+    def get_metrics(self) -> dict:
+        '''给/v1/admin/metrics使用的运行指标'''
+        return {
+            "event_queue":self._queue.stats(),
+            "api":self._http.metrics(),
+            "ws_disconnects":self._ws_disconnects,
+        }
 
     async def _send_ws_pack(self,ws,ws_dat,biztype):
         magic = 0xBABEFACE.to_bytes(length=4, byteorder='little', signed=False)
@@ -398,12 +444,16 @@ class AdapterMihoyo:
 
         await ws.send(to_send)
         
-    async def _ws_recv(self,websocket):
+    async def _ws_heartbeat(self,websocket,ws_dat):
+        '''每30秒发送一次心跳，随连接一起被取消'''
         try:
-            reply = await asyncio.wait_for(websocket.recv(),0.1)
-            return reply
-        except asyncio.TimeoutError:
-            return None
+            while True:
+                await asyncio.sleep(30)
+                await self._send_ws_pack(websocket,ws_dat,biztype=6)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            pass # 连接已断开，由接收循环处理
 
     async def _ws_connect(self):
         self._login_status = SatoriLogin.LoginStatus.CONNECT
@@ -412,77 +462,88 @@ class AdapterMihoyo:
         ws_url = ws_dat["websocket_url"]
         async with connect(ws_url) as websocket:
             await self._send_ws_pack(websocket,ws_dat,biztype=7)
-            tm = time.time()
-            while not self._is_stop:
-                reply = await self._ws_recv(websocket)
-                if not reply:
-                    now_time = time.time()
-                    if now_time - tm > 30:
-                        tm = now_time
-                        await self._send_ws_pack(websocket,ws_dat,biztype=6)
-                    continue
-                biztype = int.from_bytes(reply[24:28],byteorder='little',signed=False)
-                if biztype == 7: # 登录返回
-                    login_reply = PLoginReply().parse(reply[32:])
-                    if login_reply.code == 0:
-                        print("mihoyo:ws连接成功")
-                        self._login_status = SatoriLogin.LoginStatus.ONLINE
-                        continue
-                    else:
-                        print("mihoyo:ws连接失败",login_reply.to_json())
+            heartbeat_task = asyncio.create_task(self._ws_heartbeat(websocket,ws_dat))
+            try:
+                while not self._is_stop:
+                    reply = await websocket.recv()
+                    biztype = int.from_bytes(reply[24:28],byteorder='little',signed=False)
+                    if biztype == 7: # 登录返回
+                        login_reply = PLoginReply().parse(reply[32:])
+                        if login_reply.code == 0:
+                            _log.info("ws连接成功")
+                            self._login_status = SatoriLogin.LoginStatus.ONLINE
+                            continue
+                        else:
+                            _log.warning("ws连接失败 %s",lazy(login_reply.to_json))
+                            break
+                    elif biztype == 53:
+                        pkoff = PKickOff().parse(reply[32:])
+                        _log.warning("ws被踢下线 %s",pkoff.reason)
                         break
-                elif biztype == 53:
-                    print("mihoyo:ws被踢下线")
-                    pkoff = PKickOff().parse(reply[32:])
-                    print("mihoyo:" + pkoff.reason)
-                    break
-                elif biztype == 52:
-                    print("mihoyo:ws服务关机")
-                    break
-                elif biztype == 6:
-                    heart_reply = PHeartBeatReply().parse(reply[32:])
-                    if heart_reply.code != 0:
-                        print("mihoyo:ws心跳失败")
+                    elif biztype == 52:
+                        _log.warning("ws服务关机")
                         break
-                elif biztype == 30001: # 正常处理
-                    evt = RobotEvent().parse(reply[32:]).to_dict()
-                    asyncio.create_task(self._event_deal(evt))
+                    elif biztype == 6:
+                        heart_reply = PHeartBeatReply().parse(reply[32:])
+                        if heart_reply.code != 0:
+                            _log.warning("ws心跳失败")
+                            break
+                    elif biztype == 30001: # 正常处理
+                        evt = RobotEvent().parse(reply[32:]).to_dict()
+                        await self._queue.wait_writable() # overflow为block时，队列满了就暂停读取
+                        asyncio.create_task(self._event_deal(evt))
+            finally:
+                heartbeat_task.cancel()
 
     async def _ws_server(self) -> None:
-        while not self._is_stop:
-            try:
-                await self._ws_connect()
-            except:
-                self._login_status = SatoriLogin.LoginStatus.DISCONNECT
-                traceback.print_exc()
-                await asyncio.sleep(3)
-        self._login_status = SatoriLogin.LoginStatus.DISCONNECT
+        try:
+            while not self._is_stop:
+                try:
+                    await self._ws_connect()
+                except Exception:
+                    self._login_status = SatoriLogin.LoginStatus.DISCONNECT
+                    _log.exception("ws连接断开，3秒后重连")
+                    await asyncio.sleep(3)
+                if not self._is_stop:
+                    self._ws_disconnects += 1
+        finally:
+            self._login_status = SatoriLogin.LoginStatus.DISCONNECT
 
     async def init_after(self) -> None:
-        asyncio.create_task(self._ws_server())
+        await self._media.load()
+        self._ws_task = asyncio.create_task(self._ws_server())
 
     def _mihoyo_msg_to_satori(self,content_obj)->str:
-        ret = ""
-        entities = content_obj["content"]["entities"]
+        '''entities按offset排序后只扫描一遍，实体之间的文本整段转义
+            offset和length按UTF-16计算(emoji之类占两个单位)，文本中有这类字符时按utf-16-le编码后再切片'''
         text = content_obj["content"]["text"]
-        l = len(text)
-        i = 0
-        while i < l:
-            for en in entities:
-                if en["offset"] == i:
-                    print(en)
-                    i += en["length"]
-                    if en["entity"]["type"] == "mention_all": # 实际上收不到
-                        ret += "<at type=\"all\"/>"
-                    elif en["entity"]["type"] == "mentioned_robot":
-                        ret += "<at id=\"{}\"/>".format(en["entity"]["bot_id"])
-                    elif en["entity"]["type"] == "mentioned_user":
-                        ret += "<at id=\"{}\"/>".format(en["entity"]["user_id"])
-                    break
+        entities = [en for en in content_obj["content"]["entities"] if en["entity"]["type"] in _MIHOYO_MENTION_TYPES]
+        if len(entities) == 0:
+            return satori_to_plain(text)
+        data = text.encode("utf-16-le")
+        size = len(data) // 2
+        if size == len(text):
+            piece = lambda start,end: text[start:end]
+        else:
+            piece = lambda start,end: data[start * 2:end * 2].decode("utf-16-le",errors="replace")
+        ret = []
+        pos = 0
+        for en in sorted(entities,key=_entity_offset):
+            offset = en["offset"]
+            if offset < pos or offset >= size: # 与前一个实体重叠，或者超出文本
+                continue
+            ret.append(satori_to_plain(piece(pos,offset)))
+            entity = en["entity"]
+            if entity["type"] == "mention_all": # 实际上收不到
+                ret.append("<at type=\"all\"/>")
+            elif entity["type"] == "mentioned_robot":
+                ret.append("<at id=\"{}\"/>".format(entity["bot_id"]))
             else:
-                ret += satori_to_plain(text[i])
-                i += 1
-        return ret
+                ret.append("<at id=\"{}\"/>".format(entity["user_id"]))
+            pos = offset + en["length"]
+        if pos < size:
+            ret.append(satori_to_plain(piece(pos,size)))
+        return "".join(ret)
     async def _deal_group_message_event(self,data):
         extendData = data["extendData"]
 
@@ -493,9 +554,9 @@ class AdapterMihoyo:
 
         villaRoomId = villaId + "_" + roomId
 
-        content_obj = json.loads(sendMessage["content"])
+        content_obj = json_loads(sendMessage["content"])
 
-        extra_obj = json.loads(content_obj["user"]["extra"])
+        extra_obj = json_loads(content_obj["user"]["extra"])
 
         satori_msg = self._mihoyo_msg_to_satori(content_obj) # todo
 
@@ -531,7 +592,7 @@ class AdapterMihoyo:
             )
         )
         self._id += 1
-        self._queue.put_nowait(satori_evt.to_dict())
+        await self._queue.put(satori_evt.to_dict())
 
     async def _event_deal(self,data:dict):
         try:
@@ -539,10 +600,10 @@ class AdapterMihoyo:
             if event_type == "SendMessage":
                 await self._deal_group_message_event(data)
         except:
-            print(traceback.format_exc())
+            _log.exception("处理事件失败")
 
     
-    async def _api_call(self,path,data = None,villa_id = 0) -> dict:
+    async def _api_call(self,path,data = None,villa_id = 0,channel = None) -> dict:
         url:str = self._http_url + path
         headers = {"x-rpc-bot_id":self._self_id,"x-rpc-bot_secret":self._secret}
         if villa_id == 0:
@@ -550,15 +611,13 @@ class AdapterMihoyo:
         else:
             headers["x-rpc-bot_villa_id"] = villa_id
         if data == None:
-            async with httpx.AsyncClient() as client:
-                return (await client.get(url,headers=headers)).json()["data"]
+            return json_loads((await self._http.get(url,headers=headers,route=path)).content)["data"]
         else:
             headers["Content-Type"] = "application/json"
-            async with httpx.AsyncClient() as client:
-                ret =  (await client.post(url,headers=headers,data=data)).json()
-                if ret["retcode"] != 0:
-                    print("mihoyo:",ret)
-                return ret["data"]
+            ret =  json_loads((await self._http.post(url,headers=headers,content=data,route=path,channel=channel)).content)
+            if ret["retcode"] != 0:
+                _log.warning("API调用失败 %s %s",path,ret)
+            return ret["data"]
 
     
     async def _satori_to_mihoyo(self,satori_obj,villa_id) -> [dict]:
@@ -597,14 +656,14 @@ class AdapterMihoyo:
                         last_type = 1
 
                     l = len(to_send_data)
-                    ll = len(to_send_data[l - 1]["text"])
+                    ll = _utf16_len(to_send_data[l - 1]["text"])
                     to_send_data[l - 1]["text"] += text
                     if type == "all":
                         to_send_data[l - 1]["entities"].append({
                             "entity": {
                                 "type": "mention_all"
                             },
-                            "length":5,
+                            "length":_utf16_len(text),
                             "offset":ll
                         })
                     else:
@@ -614,7 +673,7 @@ class AdapterMihoyo:
                                     "type": "mentioned_robot",
                                     "bot_id": id
                                 },
-                                "length":len(id) + 1,
+                                "length":_utf16_len(text),
                                 "offset":ll
                             })
                         else:
@@ -623,46 +682,14 @@ class AdapterMihoyo:
                                     "type": "mentioned_user",
                                     "user_id": id
                                 },
-                                "length":len(id) + 1,
+                                "length":_utf16_len(text),
                                 "offset":ll
                             })
 
                 elif node["type"] == "img":
                     img_url:str = node["attrs"]["src"]
-                    mihoyo_img_url = ""
-                    if img_url.startswith("data:image/"):
-                        base64_start = img_url.find("base64,")
-                        img_content = base64.b64decode(img_url[base64_start + 7:])
-                    else:
-                        async with httpx.AsyncClient() as client:
-                            img_content =  (await client.get(img_url)).content
-                    ext = imghdr.what(file = "",h=img_content)
-                    m = hashlib.md5()
-                    m.update(img_content)
-                    headers = {"x-rpc-bot_id":self._self_id,"x-rpc-bot_secret":self._secret,"x-rpc-bot_villa_id":villa_id}
-                    upload_info_url = self._http_url + "/vila/api/bot/platform/getUploadImageParams"
-                    async with httpx.AsyncClient() as client:
-                        req = client.build_request("GET",upload_info_url,json={
-                            "md5":m.hexdigest(),
-                            "ext":ext
-                        },headers=headers)
-                        file_params = (await client.send(req)).json()["data"]["params"]
-                    files = {
-                        "x:extra":file_params["callback_var"]["x:extra"],
-                        "OSSAccessKeyId":file_params["accessid"],
-                        "signature":file_params["signature"],
-                        "success_action_status":file_params["success_action_status"],
-                        "name":file_params["name"],
-                        "callback":file_params["callback"],
-                        "x-oss-content-type":file_params["x_oss_content_type"],
-                        "key":file_params["key"],
-                        "policy":file_params["policy"],
-                        "Content-Disposition":file_params["content_disposition"],
-                        'file':('test',img_content)
-                    }
-                    async with httpx.AsyncClient() as client:
-                        ret =  (await client.post(file_params["host"],files=files)).json()
-                        mihoyo_img_url = ret["data"]["url"]
+                    # 图片在后台并发准备，create_message发到这一段时再等待
+                    mihoyo_img_url = asyncio.create_task(self._prepare_mihoyo_img(img_url,villa_id))
                     to_send_data.append({
                             "type":2,
                             "url":mihoyo_img_url,
@@ -674,36 +701,72 @@ class AdapterMihoyo:
             if type == 1:
                 to_send_data2.append({
                     "object_name":"MHY:Text",
-                    "msg_content":json.dumps({
+                    "msg_content":json_dumps({
                         "content":{
                             "text":it["text"],
                             "entities":it["entities"]
                         }
                 })})
             elif type == 2:
+                # 图片还在准备，msg_content在create_message中等图片地址出来后再生成
                 to_send_data2.append({
                     "object_name":"MHY:Image",
-                    "msg_content":json.dumps({
-                        "content":{
-                            "url":it["url"]
-                        }
-                        
-                })})
+                    "msg_content":it["url"]
+                })
                 
         return to_send_data2
+
+    async def _prepare_mihoyo_img(self,img_url:str,villa_id) -> str:
+        '''下载图片并上传到米游社，返回图片地址'''
+        async with self._fetcher.limit:
+            with await self._fetcher.fetch(img_url) as media:
+                async def upload() -> str:
+                    ext = imghdr.what(file = "",h=media.head)
+                    headers = {"x-rpc-bot_id":self._self_id,"x-rpc-bot_secret":self._secret,"x-rpc-bot_villa_id":villa_id}
+                    upload_info_url = self._http_url + "/vila/api/bot/platform/getUploadImageParams"
+                    file_params = json_loads((await self._http.get(upload_info_url,json={
+                        "md5":media.md5,
+                        "ext":ext
+                    },headers=headers,route="/vila/api/bot/platform/getUploadImageParams")).content)["data"]["params"]
+                    files = {
+                        "x:extra":file_params["callback_var"]["x:extra"],
+                        "OSSAccessKeyId":file_params["accessid"],
+                        "signature":file_params["signature"],
+                        "success_action_status":file_params["success_action_status"],
+                        "name":file_params["name"],
+                        "callback":file_params["callback"],
+                        "x-oss-content-type":file_params["x_oss_content_type"],
+                        "key":file_params["key"],
+                        "policy":file_params["policy"],
+                        "Content-Disposition":file_params["content_disposition"],
+                        'file':('test',media.upload_body())
+                    }
+                    ret =  json_loads((await self._http.post(file_params["host"],files=files)).content)
+                    return ret["data"]["url"]
+                return await self._media.get_or_upload("mihoyo:" + self._self_id,media.sha256,upload)
     
     async def create_message(self,platform:str,self_id:str,channel_id:str,content:str):
         '''发送消息'''
         villa_id = channel_id.split("_")[0]
         satori_obj = parse_satori_html(content)
         to_sends = await self._satori_to_mihoyo(satori_obj,villa_id)
-        to_ret = []
-        # print(to_sends)
-        for it in to_sends:
-            it["room_id"] = channel_id.split("_")[1]
-            ret = await self._api_call("/vila/api/bot/platform/sendMessage",json.dumps(it),villa_id=villa_id)
-            to_ret.append(SatoriMessage(id=ret["bot_msg_id"],content="").to_dict())
-        return to_ret
+        tasks = [it["msg_content"] for it in to_sends if isinstance(it["msg_content"],asyncio.Task)]
+        try:
+            to_ret = []
+            # 按顺序发送，图片段发送前才等待它准备好，前面的段不用等后面的图片
+            for it in to_sends:
+                if isinstance(it["msg_content"],asyncio.Task):
+                    it["msg_content"] = json_dumps({
+                        "content":{
+                            "url":await it["msg_content"]
+                        }
+                    })
+                it["room_id"] = channel_id.split("_")[1]
+                ret = await self._api_call("/vila/api/bot/platform/sendMessage",json_dumps(it),villa_id=villa_id,channel=channel_id)
+                to_ret.append(SatoriMessage(id=ret["bot_msg_id"],content="").to_dict())
+            return to_ret
+        finally:
+            cancel_tasks(tasks)
       
     
     async def get_login(self,platform:Optional[str],self_id:Optional[str]) -> [dict]:
@@ -726,11 +789,9 @@ class AdapterMihoyo:
         '''获取群组成员信息'''
         url = self._http_url + "/vila/api/bot/platform/getMember"
         headers = {"x-rpc-bot_id":self._self_id,"x-rpc-bot_secret":self._secret,"x-rpc-bot_villa_id":guild_id}
-        async with httpx.AsyncClient() as client:
-            req = client.build_request("GET",url,json={
-                "uid":user_id
-            },headers=headers)
-            obret = (await client.send(req)).json()["data"]["member"]
+        obret = json_loads((await self._http.get(url,json={
+            "uid":user_id
+        },headers=headers,route="/vila/api/bot/platform/getMember")).content)["data"]["member"]
         satori_ret = SatoriGuildMember(
             user=SatoriUser(
                 id=obret["basic"]["uid"],
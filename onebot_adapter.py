@@ -1,18 +1,54 @@
-import httpx
 from websockets import connect
 import asyncio
 from typing import Optional
-from asyncio import Queue
 import json
 import base64
-from tool import get_json_or, parse_satori_html, satori_to_plain
+import re
+from tool import *
+from http_pool import HttpPool
+from event_queue import EventQueue
+from escape import cq_text_escape, cq_text_unescape, cq_params_escape, cq_params_unescape
+from log import get_logger
+
+_log = get_logger("onebot")
+
+# 一个完整的CQ码，至少带一个参数；不满足的(没有参数、键里有逗号等)交给_cqmsg_to_arr_slow处理
+_CQ_CODE_RE = re.compile(r'\[CQ:([^,\]]*)((?:,[^,=\]]*=[^,\]]*)+)\]')
 
 def _cqmsg_to_arr(cqmsg) -> list:
     # 将 string 格式的 message 转化为 array 格式
     # https://github.com/botuniverse/onebot-11/blob/master/message/README.md
     if isinstance(cqmsg,list):
         return cqmsg
-    cqstr = cqmsg
+    if "[CQ:" not in cqmsg:
+        if len(cqmsg) == 0:
+            return []
+        return [{"type":"text","data":{"text":cq_text_unescape(cqmsg)}}]
+    jsonarr = []
+    pos = 0
+    for m in _CQ_CODE_RE.finditer(cqmsg):
+        start = m.start()
+        if start != pos:
+            text = cqmsg[pos:start]
+            if "[CQ:" in text:
+                return _cqmsg_to_arr_slow(cqmsg)
+            jsonarr.append({"type":"text","data":{"text":cq_text_unescape(text)}})
+        cqcode = {}
+        for param in m.group(2)[1:].split(","):
+            key,_,val = param.partition("=")
+            cqcode[cq_params_unescape(key)] = cq_params_unescape(val)
+        jsonarr.append({"type":cq_params_unescape(m.group(1)),"data":cqcode})
+        pos = m.end()
+    if pos != len(cqmsg):
+        text = cqmsg[pos:]
+        if "[CQ:" in text:
+            return _cqmsg_to_arr_slow(cqmsg)
+        jsonarr.append({"type":"text","data":{"text":cq_text_unescape(text)}})
+    return jsonarr
+
+
+def _cqmsg_to_arr_slow(cqstr:str) -> list:
+    # 逐字符的状态机，用于处理_CQ_CODE_RE匹配不了的不规范CQ码
     text = ""
     type_ = ""
     key = ""
@@ -158,35 +194,6 @@ def _cqmsg_to_arr(cqmsg) -> list:
     return jsonarr
 
 
-def _cq_text_encode(data: str) -> str:
-    ret_str = ""
-    for ch in data:
-        if ch == "&":
-            ret_str += "&amp;"
-        elif ch == "[":
-            ret_str += "&#91;"
-        elif ch == "]":
-            ret_str += "&#93;"
-        else:
-            ret_str += ch
-    return ret_str
-
-def _cq_params_encode(data: str) -> str:
-    ret_str = ""
-    for ch in data:
-        if ch == "&":
-            ret_str += "&amp;"
-        elif ch == "[":
-            ret_str += "&#91;"
-        elif ch == "]":
-            ret_str += "&#93;"
-        elif ch == ",":
-            ret_str += "&#44;"
-        else:
-            ret_str += ch
-    return ret_str
-
-
 class AdapterOnebot:
     def __init__(self,config = {}) -> None:
         '''用于初始化一些配置信息，尽量不要在这里阻塞，因为此处不具备异步环境，如果你需要读写配置文件，请在init_after中进行'''
@@ -197,9 +204,14 @@ class AdapterOnebot:
         else:
             self._access_token = None
         self._is_stop = False
-        self._login_status = 3  # DISCONNECT
-        self._queue = Queue(maxsize=100)
+        self._login_status = SatoriLogin.LoginStatus.DISCONNECT
+        self._queue = EventQueue(config)
+        self._ws_disconnects = 0 # ws断开或连接失败的次数
         self._id = 0
+        self._http = HttpPool(config)
+        self._ws_task = None
+        self._login_info = None # 缓存的/get_login_info结果
+        self._login_info_lock = asyncio.Lock()
 
     def _cqarr_to_satori(self,cqarr):
         ret = ""
@@ -235,37 +247,50 @@ class AdapterOnebot:
             你可以在这个函数里面进行数据保存之类的，这种用途下，请阻塞这个函数，直到保存完成
         '''
         self._is_stop = True
+        if self._ws_task:
+            self._ws_task.cancel()
+        await self._http.aclose()
+        self._queue.close()
 
-    async def get_msg(self) -> dict:
-        '''阻塞并等待消息返回，如果你的适配器不具备接收消息的能力，请不要写这个函数'''
-        return await self._queue.get()
+    async def get_events(self,max_count:int) -> list:
+        '''阻塞并等待事件，一次返回最多max_count个编码好的事件，如果你的适配器不具备接收消息的能力，请不要写这个函数'''
+        return await self._queue.get_many(max_count)
+
+    def get_event_queue_stats(self) -> dict:
+        '''事件队列的积压和丢弃情况'''
+        return self._queue.stats()
+
+    def get_metrics(self) -> dict:
+        '''给/v1/admin/metrics使用的运行指标'''
+        return {
+            "event_queue":self._queue.stats(),
+            "api":self._http.metrics(),
+            "ws_disconnects":self._ws_disconnects,
+        }
 
     async def init_after(self) -> None:
         '''适配器创建之后会调用一次，应该在这里进行ws连接等操作，如果不需要，可以不写'''
         async def _ws_server(self:AdapterOnebot) -> None:
             while not self._is_stop:
                 try:
-                    self._login_status = 2 # CONNECT
+                    self._login_status = SatoriLogin.LoginStatus.CONNECT
                     async with connect(self._ws_url) as websocket:
-                        print("onebot:ws已经连接")
-                        self._login_status = 1 # ONLINE
+                        _log.info("ws已经连接")
+                        self._login_status = SatoriLogin.LoginStatus.ONLINE
+                        asyncio.create_task(self._refresh_login_info())
                         try:
+                            # 阻塞接收，停止时由release取消本任务
                             while True:
-                                try:
-                                    reply = await asyncio.wait_for(websocket.recv(),0.1)
-                                    await self._event_deal(json.loads(reply))
-                                except asyncio.TimeoutError:
-                                    if self._is_stop:
-                                        await websocket.close()
-                                except asyncio.QueueFull:
-                                    print("队列满")
+                                reply = await websocket.recv()
+                                await self._event_deal(json_loads(reply))
                         except Exception as e:
-                            print(e)    
+                            _log.warning("ws接收失败 %s",e)
+                            self._ws_disconnects += 1
                 except Exception as e:
-                    print(e)
-                    print("onebot:ws连接已经断开")
-                    self._login_status = 3 # DISCONNECT
-        asyncio.create_task(_ws_server(self))
+                    _log.warning("ws连接已经断开 %s",e)
+                    self._ws_disconnects += 1
+                    self._login_status = SatoriLogin.LoginStatus.DISCONNECT
+        self._ws_task = asyncio.create_task(_ws_server(self))
     
     async def _event_deal(self,evt:dict):
         '''自己定义的事件转化函数'''
@@ -273,123 +298,82 @@ class AdapterOnebot:
         if post_type == "message":
             message_type = evt["message_type"]
             sender = evt["sender"]
+            user = SatoriUser(
+                id=str(evt["user_id"]),
+                name=get_json_or(sender,"nickname",None),
+                avatar=get_json_or(sender,"avatar",None)
+            )
+            message = SatoriMessage(
+                id=str(evt["message_id"]),
+                content=self._cqarr_to_satori(_cqmsg_to_arr(evt["message"])),
+                created_at=int(str(evt["time"] ) + "000")
+            )
             if message_type == "group":
-                channel_obj = {
-                        "id":"GROUP_"+str(evt["group_id"]),
-                        "type":0,
-                        "name":None,
-                        "parent_id":None
-                    }
-                guild_obj = {
-                    "id":"GROUP_"+str(evt["group_id"]),
-                    "name":None,
-                    "avatar":None
-                }
-                user_obj = {
-                    "id":str(evt["user_id"]),
-                    "name":get_json_or(sender,"nickname",None),
-                    "nick":get_json_or(sender,"nickname",None),
-                    "avatar":get_json_or(sender,"avatar",None),
-                    "is_bot":None
-                }
                 joined_at = get_json_or(sender,"join_time",None)
                 if joined_at:
                     joined_at = int(str(joined_at) + "000")
-                member_obj = {
-                    "nick":get_json_or(sender,"card",None),
-                    "avatar":get_json_or(sender,"avatar",None),
-                    "joined_at":joined_at
-                }
-                message_obj = {
-                    "id":str(evt["message_id"]),
-                    "content":self._cqarr_to_satori(_cqmsg_to_arr(evt["message"])),
-                    "created_at":int(str(evt["time"] ) + "000")
-                }
-                role_obj = {
-                        "id":get_json_or(sender, "role","member"),
-                        "name":get_json_or(sender,"role","member")
-                    }
-                satori_evt = {
-                    "id":self._id,
-                    "type":"message-created",
-                    "platform":"onebot",
-                    "self_id":str(evt["self_id"]),
-                    "timestamp":int(str(evt["time"] ) + "000"),
-                    "channel":channel_obj,
-                    "guild":guild_obj,
-                    "member":member_obj,
-                    "message":message_obj,
-                    "role":role_obj,
-                    "user":user_obj
-                }
+                satori_evt = SatoriGroupMessageCreatedEvent(
+                    id=self._id,
+                    platform="onebot",
+                    self_id=str(evt["self_id"]),
+                    timestamp=int(str(evt["time"] ) + "000"),
+                    channel=SatoriChannel(
+                        id="GROUP_"+str(evt["group_id"]),
+                        type=SatoriChannel.ChannelType.TEXT
+                    ),
+                    message=message,
+                    user=user,
+                    member=SatoriGuildMember(
+                        nick=get_json_or(sender,"card",None),
+                        avatar=get_json_or(sender,"avatar",None),
+                        joined_at=joined_at
+                    ),
+                    guild=SatoriGuild(
+                        id="GROUP_"+str(evt["group_id"])
+                    ),
+                    role=SatoriGuildRole(
+                        id=get_json_or(sender, "role","member"),
+                        name=get_json_or(sender,"role","member")
+                    )
+                )
                 self._id += 1
-                self._queue.put_nowait(satori_evt)
+                await self._queue.put(satori_evt.to_dict())
             elif message_type == "private":
-                channel_obj = {
-                        "id":str(evt["user_id"]),
-                        "type":1,
-                        "name":None,
-                        "parent_id":None
-                    }
-                user_obj = {
-                    "id":str(evt["user_id"]),
-                    "name":get_json_or(sender,"nickname",None),
-                    "nick":get_json_or(sender,"nickname",None),
-                    "avatar":get_json_or(sender,"avatar",None),
-                    "is_bot":None
-                }
-                joined_at = get_json_or(sender,"join_time",None)
-                if joined_at:
-                    joined_at = int(str(joined_at) + "000")
-                message_obj = {
-                    "id":str(evt["message_id"]),
-                    "content":self._cqarr_to_satori(_cqmsg_to_arr(evt["message"])),
-                    "created_at":int(str(evt["time"] ) + "000")
-                }
-                satori_evt = {
-                    "id":self._id,
-                    "type":"message-created",
-                    "platform":"onebot",
-                    "self_id":str(evt["self_id"]),
-                    "timestamp":int(str(evt["time"] ) + "000"),
-                    "channel":channel_obj,
-                    "message":message_obj,
-                    "user":user_obj
-                }
+                satori_evt = SatoriPrivateMessageCreatedEvent(
+                    id=self._id,
+                    platform="onebot",
+                    self_id=str(evt["self_id"]),
+                    timestamp=int(str(evt["time"] ) + "000"),
+                    channel=SatoriChannel(
+                        id=str(evt["user_id"]),
+                        type=SatoriChannel.ChannelType.DIRECT
+                    ),
+                    message=message,
+                    user=user
+                )
                 self._id += 1
-                self._queue.put_nowait(satori_evt)
+                await self._queue.put(satori_evt.to_dict())
         elif post_type == "notice":
             notice_type = evt["notice_type"]
             if notice_type == "group_increase":
-                guild_obj = {
-                    "id":"GROUP_"+str(evt["group_id"]),
-                    "name":None,
-                    "avatar":None
-                }
-                member_obj = {
-                    "nick":None,
-                    "avatar":get_json_or(evt,"avatar",None),
-                    "joined_at":int(str(evt["time"] ) + "000")
-                }
-                user_obj = {
-                    "id":str(evt["user_id"]),
-                    "name":None,
-                    "nick":None,
-                    "avatar":None,
-                    "is_bot":None
-                }
-                satori_evt = {
-                    "id":self._id,
-                    "type":"guild-member-added",
-                    "platform":"onebot",
-                    "self_id":str(evt["self_id"]),
-                    "timestamp":int(str(evt["time"] ) + "000"),
-                    "guild":guild_obj,
-                    "member":member_obj,
-                    "user":user_obj
-                }
+                satori_evt = SatoriGuildMemberAddedEvent(
+                    id=self._id,
+                    platform="onebot",
+                    self_id=str(evt["self_id"]),
+                    timestamp=int(str(evt["time"] ) + "000"),
+                    guild=SatoriGuild(
+                        id="GROUP_"+str(evt["group_id"])
+                    ),
+                    member=SatoriGuildMember(
+                        avatar=get_json_or(evt,"avatar",None),
+                        joined_at=int(str(evt["time"] ) + "000")
+                    ),
+                    user=SatoriUser(
+                        id=str(evt["user_id"])
+                    )
+                )
                 self._id += 1
-                self._queue.put_nowait(satori_evt)
+                await self._queue.put(satori_evt.to_dict())
 
     async def _api_call(self,path,data) -> dict:
         url:str = self._http_url + path
@@ -397,15 +381,14 @@ class AdapterOnebot:
             headers = {"Authorization":"Bearer {}".format(self._access_token)}
         else:
             headers = {}
-        async with httpx.AsyncClient() as client:
-            # headers["Content-Type"] = "application/json"
-            return (await client.post(url,headers=headers,data=data)).json()
+        # headers["Content-Type"] = "application/json"
+        return json_loads((await self._http.post(url,headers=headers,data=data)).content)
     
     async def _satori_to_cq(self,satori_obj) -> str:
         ret = ""
         for node in satori_obj:
             if isinstance(node,str):
-                ret += _cq_text_encode(node)
+                ret += cq_text_escape(node)
             else:
                 if node["type"] == "at":
                     type = get_json_or(node["attrs"],"type",None)
@@ -413,13 +396,13 @@ class AdapterOnebot:
                     if type == "all":
                         ret += "[CQ:at,qq=all]"
                     elif id != None:
-                        ret += "[CQ:at,qq={}]".format(_cq_params_encode(id))
+                        ret += "[CQ:at,qq={}]".format(cq_params_escape(id))
                 elif node["type"] == "img":
                     img_url = node["attrs"]["src"]
                     if img_url.startswith("data:image/"):
                         base64_start = img_url.find("base64,")
                         img_url = "base64://" + img_url[base64_start + 7:]
-                    ret += "[CQ:image,file={}]".format(_cq_params_encode(img_url)) 
+                    ret += "[CQ:image,file={}]".format(cq_params_escape(img_url)) 
 
         return ret
 
@@ -437,21 +420,33 @@ class AdapterOnebot:
             ret = await self._api_call("/send_private_msg",{"user_id":user_id,"message":to_send})
             return [{"id":str(ret["data"]["message_id"]),"content":""}]
     
+    async def _get_login_info(self,refresh:bool = False) -> dict:
+        '''获取bot自己的信息，结果会被缓存，同时只会有一个请求'''
+        async with self._login_info_lock:
+            if refresh or self._login_info == None:
+                self._login_info = (await self._api_call("/get_login_info",{}))["data"]
+        return self._login_info
+
+    async def _refresh_login_info(self) -> None:
+        '''ws重新连接后刷新缓存的bot信息'''
+        try:
+            await self._get_login_info(refresh=True)
+        except Exception as e:
+            _log.warning("刷新bot信息失败 %s",e)
+
     async def get_login(self,platform:Optional[str],self_id:Optional[str]) -> [dict]:
         '''获取登录信息，如果platform和self_id为空，那么应该返回一个列表'''
-        obret =  (await self._api_call("/get_login_info",{}))["data"]
-        satori_ret = {
-            "user":{
-                "id":str(obret["user_id"]),
-                "name":obret["nickname"],
-                "nick":obret["nickname"],
-                "avatar":get_json_or(obret,"avatar",None),
-                "is_bot":None
-            },
-            "self_id":str(obret["user_id"]),
-            "platform":"onebot",
-            "status":self._login_status,
-        }
+        obret =  await self._get_login_info()
+        satori_ret = SatoriLogin(
+            status=self._login_status,
+            user=SatoriUser(
+                id=str(obret["user_id"]),
+                name=obret["nickname"],
+                avatar=get_json_or(obret,"avatar",None)
+            ),
+            self_id=str(obret["user_id"]),
+            platform="onebot"
+        ).to_dict()
         if platform == None and self_id == None:
             return [satori_ret]
         else:
@@ -466,16 +461,16 @@ class AdapterOnebot:
         joined_at = get_json_or(obret,"join_time",None)
         if joined_at:
             joined_at = int(str(joined_at) + "000")
-        satori_ret = {
-            "user":{
-                "id":str(obret["user_id"]),
-                "name":get_json_or(obret,"nickname",None),
-                "nick":get_json_or(obret,"card",None),
-                "avatar":get_json_or(obret,"avatar",None),
-                "is_bot":None
-            },
-            "nick":get_json_or(obret,"card",None),
-            "avatar":get_json_or(obret,"avatar",None),
-            "joined_at":joined_at,
-        }
+        user = SatoriUser(
+            id=str(obret["user_id"]),
+            name=get_json_or(obret,"nickname",None),
+            avatar=get_json_or(obret,"avatar",None)
+        )
+        user.nick = get_json_or(obret,"card",None)
+        satori_ret = SatoriGuildMember(
+            user=user,
+            nick=get_json_or(obret,"card",None),
+            avatar=get_json_or(obret,"avatar",None),
+            joined_at=joined_at
+        ).to_dict()
         return satori_ret
\ No newline at end of file
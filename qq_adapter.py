@@ -1,69 +1,80 @@
-import traceback
-import httpx
 from websockets import connect
 import asyncio
 from typing import Optional
-from asyncio import Queue
 import json
-import time
-import base64
+import datetime
+import re
 
 from tool import *
+from http_pool import HttpPool
+from event_queue import EventQueue
+from ratelimit import RateLimiter
+from escape import qq_escape, qq_unescape
+from media import FetchedMedia, MediaFetcher
+from log import get_logger, lazy
 
+_log = get_logger("qq")
+_log_gateway = get_logger("qq.gateway") # 网关收到的每个事件
 
-def _qqmsg_to_arr(cqstr) -> list:
-    text = ""
-    jsonarr = []
-    stat = 0
-    i = 0
-    while i < len(cqstr):
-        cur_ch = cqstr[i]
-        if stat == 0:
-            if cur_ch == '<':
-                stat = 1
-                jsonarr.append({
-                    "type":"text",
-                    "data":text
-                })
-                text = ""
-                text += cur_ch
-                i += 1
-            elif cur_ch == "&":
-                if cqstr[i:i+4] == "&gt;":
-                    text += ">"
-                    i += 4
-                elif cqstr[i:i+4] == "&lt;":
-                    text += "<"
-                    i += 4
-                elif cqstr[i:i+5] == "&amp;":
-                    text += "&"
-                    i += 5
-                else:
-                    text += "&"
-                    i += 1
-            else:
-                text += cur_ch
-                i += 1
-        else:
-            if cur_ch == '>':
-                stat = 0
-                text += ">"
-                jsonarr.append({
-                    "type":"embbed",
-                    "data":text
-                })
-                text = ""
-                i += 1
-            else:
-                i += 1
-                text += cur_ch
 
-    if text != "":
-        jsonarr.append({
-            "type":"text",
-            "data":text
-        })   
-    return jsonarr
+# qq消息中的内嵌格式，如<@!user_id>、<emoji:id>，从"<"到第一个">"
+_QQ_EMBED_RE = re.compile(r'<[^>]*>')
+
+def _qqmsg_to_satori(content:str) -> str:
+    '''qq消息转成satori消息，文本整段反转义再转义，内嵌格式中只转换提及'''
+    if "<" not in content:
+        return satori_to_plain(qq_unescape(content))
+    ret = []
+    pos = 0
+    for m in _QQ_EMBED_RE.finditer(content):
+        ret.append(satori_to_plain(qq_unescape(content[pos:m.start()])))
+        embed = m.group()
+        if embed.startswith("<@!"):
+            ret.append("<at id=\"{}\">".format(satori_to_plain(embed[3:-1])))
+        elif embed.startswith("<@"):
+            ret.append("<at id=\"{}\">".format(satori_to_plain(embed[2:-1])))
+        pos = m.end()
+    rest = content[pos:]
+    lt = rest.find("<")
+    if lt == -1:
+        ret.append(satori_to_plain(qq_unescape(rest)))
+    else:
+        # 没有闭合的"<"之后按原样作为文本
+        ret.append(satori_to_plain(qq_unescape(rest[:lt]) + rest[lt:]))
+    return "".join(ret)
+
+
+def _iso_to_ms(text:str) -> int:
+    '''qq的时间(如"2023-11-15T06:13:20+08:00")转成毫秒时间戳，按其中的时区偏移计算'''
+    return int(datetime.datetime.fromisoformat(text).timestamp() * 1000)
+
+
+# 同一个成员的加入时间和身份组在每条消息中重复出现，解析结果缓存起来
+_joined_at_cache = {}
+_role_id_cache = {}
+
+def _joined_at_ms(text:str) -> int:
+    ms = _joined_at_cache.get(text)
+    if ms == None:
+        ms = _iso_to_ms(text)
+        if len(_joined_at_cache) < 4096:
+            _joined_at_cache[text] = ms
+    return ms
+
+
+def _role_id(roles:list) -> str:
+    key = tuple(roles)
+    role_id = _role_id_cache.get(key)
+    if role_id == None:
+        role_id = json.dumps(sorted(roles))
+        if len(_role_id_cache) < 4096:
+            _role_id_cache[key] = role_id
+    return role_id
+
+
+def _without_none(obj:dict) -> dict:
+    return {k:v for k,v in obj.items() if v != None}
+
 
 class AdapterQQ:
     def __init__(self,config = {}) -> None:
@@ -76,16 +87,25 @@ class AdapterQQ:
         else:
             self._withgroup = None
         self._appsecret = config["appsecret"]
-        self._http_url = "https://api.sgroup.qq.com"
+        self._http_url = get_json_or(config,"http_url","https://api.sgroup.qq.com") # 可以改成本地的测试服务器
+        self._token_url = get_json_or(config,"token_url","https://bots.qq.com/app/getAppAccessToken")
         self._is_stop = False
         self._login_status = SatoriLogin.LoginStatus.DISCONNECT
-        self._queue = Queue(maxsize=100)
+        self._queue = EventQueue(config)
+        self._ws_disconnects = 0 # ws断开或连接失败的次数
         self._id = 0
         self._sn = None
         self._self_id = None
+        self._self_user = None # 缓存的/users/@me结果
+        self._self_user_lock = asyncio.Lock()
         self._access_token = None
         self._expires_in = 0
         self.msgid_map = dict()
+        self._limiter = RateLimiter(config,"qq")
+        self._http = HttpPool(config,self._limiter)
+        self._fetcher = MediaFetcher(config,self._http)
+        self._ws_task = None
+        self._token_task = None
         # self._self_name = None
 
 
@@ -107,184 +127,181 @@ class AdapterQQ:
             你可以在这个函数里面进行数据保存之类的，这种用途下，请阻塞这个函数，直到保存完成
         '''
         self._is_stop = True
+        if self._ws_task:
+            self._ws_task.cancel()
+        if self._token_task:
+            self._token_task.cancel()
+        await self._http.aclose()
+        self._queue.close()
+
+    def get_ratelimit_stats(self) -> dict:
+        '''出站限速的状态'''
+        return self._limiter.stats()
 
-    async def get_msg(self) -> dict:
-        '''阻塞并等待消息返回，如果你的适配器不具备接收消息的能力，请不要写这个函数'''
-        return await self._queue.get()
+    async def get_events(self,max_count:int) -> list:
+        '''阻塞并等待事件，一次返回最多max_count个编码好的事件，如果你的适配器不具备接收消息的能力，请不要写这个函数'''
+        return await self._queue.get_many(max_count)
+
+    def get_event_queue_stats(self) -> dict:
+        '''事件队列的积压和丢弃情况'''
+        return self._queue.stats()
+
+    def get_metrics(self) -> dict:
+        '''给/v1/admin/metrics使用的运行指标'''
+        return {
+            "event_queue":self._queue.stats(),
+            "api":self._http.metrics(),
+            "ws_disconnects":self._ws_disconnects,
+        }
     
 
-    async def _ws_recv(self,websocket):
+    async def _ws_heartbeat(self,websocket):
+        '''每30秒发送一次心跳，随连接一起被取消'''
         try:
-            reply = await asyncio.wait_for(websocket.recv(),0.1)
-            return reply
-        except asyncio.TimeoutError:
-            return None
+            while True:
+                await asyncio.sleep(30)
+                await websocket.send(json_dumps({"op": 1,"d": self._sn}))
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            pass # 连接已断开，由接收循环处理
 
     async def _ws_connect(self):
         self._login_status = SatoriLogin.LoginStatus.CONNECT
         ws_url = (await self._api_call("/gateway"))["url"]
         async with connect(ws_url) as websocket:
-            tm = time.time()
-            while not self._is_stop:
-                reply = await self._ws_recv(websocket)
-                if not reply:
-                    now_time = time.time()
-                    if now_time - tm > 30:
-                        tm = now_time
-                        await websocket.send(json.dumps({"op": 1,"d": self._sn}))
-                    continue
-                js = json.loads(reply)
-                op = js["op"]
-                if op == 0: # 事件
-                    self._sn = js["s"]
-                    t = js["t"]
-                    if t == "READY":
-                        print("qq:ws连接成功")
-                        print(json.dumps(js))
-                        self._login_status = SatoriLogin.LoginStatus.ONLINE
-                    else:
-                        print(json.dumps(js))
-                        asyncio.create_task(self._deal_event(js))
-                elif op == 1: # 心跳
-                    await websocket.send(json.dumps({"op":11}))
-                elif op == 7: # 重连
-                    print("qq:服务端要求重连")
-                    break
-                elif op == 9: # 参数错误
-                    print("qq:参数错误:",json.dumps(js))
-                    break
-                elif op == 10: # ws建立成功
-                    if self._withgroup:
-                        await websocket.send(json.dumps({
-                            "op":2,
-                            "d":{
-                                "token":"QQBot {}".format(self._access_token),
-                                "intents":0 | (1 << 0) | (1 << 1) | (1 << 30) | (1 << 25),
-                                "shard":[0, 1],
-                            }
-                        }))
-                    else:
-                        await websocket.send(json.dumps({
-                            "op":2,
-                            "d":{
-                                "token":"QQBot {}".format(self._access_token),
-                                "intents":0 | (1 << 0) | (1 << 1) | (1 << 30),
-                                "shard":[0, 1],
-                            }
-                        }))
-                elif op == 11: # HTTP Callback ACK
-                    pass
+            heartbeat_task = asyncio.create_task(self._ws_heartbeat(websocket))
+            try:
+                while not self._is_stop:
+                    reply = await websocket.recv()
+                    js = json_loads(reply)
+                    op = js["op"]
+                    if op == 0: # 事件
+                        self._sn = js["s"]
+                        t = js["t"]
+                        if t == "READY":
+                            _log.info("ws连接成功")
+                            _log_gateway.debug("%s",reply)
+                            self._login_status = SatoriLogin.LoginStatus.ONLINE
+                            asyncio.create_task(self._refresh_self_user())
+                        else:
+                            _log_gateway.debug("%s",reply) # 原样输出收到的帧，不用再编码一次
+                            await self._queue.wait_writable() # overflow为block时，队列满了就暂停读取
+                            asyncio.create_task(self._deal_event(js))
+                    elif op == 1: # 心跳
+                        await websocket.send(json_dumps({"op":11}))
+                    elif op == 7: # 重连
+                        _log.info("服务端要求重连")
+                        break
+                    elif op == 9: # 参数错误
+                        _log.warning("参数错误 %s",lazy(json_dumps,js))
+                        break
+                    elif op == 10: # ws建立成功
+                        if self._withgroup:
+                            await websocket.send(json_dumps({
+                                "op":2,
+                                "d":{
+                                    "token":"QQBot {}".format(self._access_token),
+                                    "intents":0 | (1 << 0) | (1 << 1) | (1 << 30) | (1 << 25),
+                                    "shard":[0, 1],
+                                }
+                            }))
+                        else:
+                            await websocket.send(json_dumps({
+                                "op":2,
+                                "d":{
+                                    "token":"QQBot {}".format(self._access_token),
+                                    "intents":0 | (1 << 0) | (1 << 1) | (1 << 30),
+                                    "shard":[0, 1],
+                                }
+                            }))
+                    elif op == 11: # HTTP Callback ACK
+                        pass
+            finally:
+                heartbeat_task.cancel()
 
     async def _ws_server(self) -> None:
-        while not self._is_stop:
-            try:
-                await self._ws_connect()
-            except:
-                self._login_status = SatoriLogin.LoginStatus.DISCONNECT
-                print(traceback.format_exc())
-                await asyncio.sleep(3)
-        self._login_status = SatoriLogin.LoginStatus.DISCONNECT
+        try:
+            while not self._is_stop:
+                try:
+                    await self._ws_connect()
+                except Exception:
+                    self._login_status = SatoriLogin.LoginStatus.DISCONNECT
+                    _log.exception("ws连接断开，3秒后重连")
+                    await asyncio.sleep(3)
+                if not self._is_stop:
+                    self._ws_disconnects += 1
+        finally:
+            self._login_status = SatoriLogin.LoginStatus.DISCONNECT
 
     async def _token_refresh(self):
-        async with httpx.AsyncClient() as client:
-            if not self._expires_in or int(self._expires_in) < 60 * 5:
-                url = "https://bots.qq.com/app/getAppAccessToken"
-                ret = (await client.post(url,json={
-                    "appId":self._appid,
-                    "clientSecret":self._appsecret
-                })).json()
-                self._access_token = ret["access_token"]
-                self._expires_in = ret["expires_in"]
-                # print(ret)
+        if not self._expires_in or int(self._expires_in) < 60 * 5:
+            ret = json_loads((await self._http.post(self._token_url,json={
+                "appId":self._appid,
+                "clientSecret":self._appsecret
+            })).content)
+            self._access_token = ret["access_token"]
+            self._expires_in = ret["expires_in"]
+            # print(ret)
+
+    def _channel_event_to_satori(self,data) -> dict:
+        '''频道消息直接生成satori事件的json对象，每个字段只计算一次'''
+        author = data["author"]
+        member = data["member"]
+        timestamp = _iso_to_ms(data["timestamp"])
+        # 登录完成前self_id还是None，这时不输出这个字段
+        return _without_none({
+            "id":self._id,
+            "type":"message-created",
+            "platform":"qq_guild",
+            "self_id":self._self_id,
+            "timestamp":timestamp,
+            "channel":{"id":"CHANNEL_"+data["channel_id"],"type":SatoriChannel.ChannelType.TEXT.value},
+            "message":{"id":data["id"],"content":_qqmsg_to_satori(data["content"]),"created_at":timestamp},
+            "user":_without_none({
+                "id":author["id"],
+                "name":author["username"],
+                "nick":author["username"],
+                "avatar":author["avatar"],
+                "is_bot":author["bot"]
+            }),
+            "guild":{"id":data["guild_id"]},
+            "member":_without_none({
+                "nick":member["nick"],
+                "avatar":author["avatar"],
+                "joined_at":_joined_at_ms(member["joined_at"])
+            }),
+            "role":{"id":_role_id(member["roles"])},
+        })
+
+    def _group_event_to_satori(self,data) -> dict:
+        '''群消息直接生成satori事件的json对象'''
+        timestamp = _iso_to_ms(data["timestamp"])
+        return {
+            "id":self._id,
+            "type":"message-created",
+            "platform":"qq_group",
+            "self_id":self._botqq,
+            "timestamp":timestamp,
+            "channel":{"id":"GROUP_"+data["group_id"],"type":SatoriChannel.ChannelType.TEXT.value},
+            "message":{"id":data["id"],"content":_qqmsg_to_satori(data["content"]),"created_at":timestamp},
+            "user":{"id":data["author"]["id"]},
+            "guild":{"id":"GROUP_"+data["group_id"]},
+            "member":{},
+            "role":{"id":"unkonw","name":"unkonw"},
+        }
 
-    async def _qqarr_to_satori(self,qqmsg_arr):
-        ret = ""
-        for it in qqmsg_arr:
-            if it["type"] == "text":
-                ret += satori_to_plain(it["data"])
-            else:
-                if it["data"].startswith("<@!"):
-                    user_id = it["data"][3:len(it["data"]) - 1]
-                    ret += "<at id=\"{}\">".format(satori_to_plain(user_id))
-                elif it["data"].startswith("<@"):
-                    user_id = it["data"][2:len(it["data"]) - 1]
-                    ret += "<at id=\"{}\">".format(satori_to_plain(user_id))
-        return ret
-    
     async def _deal_channel_event(self,data):
-        qqmsg_arr = _qqmsg_to_arr(data["content"])
-        # print("qqmsg_arr",qqmsg_arr)
-        satori_msg = await self._qqarr_to_satori(qqmsg_arr)
+        satori_evt = self._channel_event_to_satori(data)
         self.msgid_map["CHANNEL_"+data["channel_id"]] = data["id"]
-        satori_evt = SatoriGroupMessageCreatedEvent(
-            id=self._id,
-            self_id=self._self_id,
-            timestamp=int(time.mktime(time.strptime(data["timestamp"], "%Y-%m-%dT%H:%M:%S%z"))) * 1000,
-            platform="qq_guild",
-            channel=SatoriChannel(
-                id="CHANNEL_"+data["channel_id"],
-                type=SatoriChannel.ChannelType.TEXT,
-            ),
-            message=SatoriMessage(
-                id=data["id"],
-                content=satori_msg,
-                created_at=int(time.mktime(time.strptime(data["timestamp"], "%Y-%m-%dT%H:%M:%S%z"))) * 1000
-            ),
-            user=SatoriUser(
-                id=data["author"]["id"],
-                name=data["author"]["username"],
-                avatar=data["author"]["avatar"],
-                is_bot=data["author"]["bot"]
-            ),
-            member=SatoriGuildMember(
-                nick=data["member"]["nick"],
-                avatar=data["author"]["avatar"],
-                joined_at=int(time.mktime(time.strptime(data["member"]["joined_at"], "%Y-%m-%dT%H:%M:%S%z"))) * 1000
-            ),
-            guild=SatoriGuild(
-                id=data["guild_id"]
-            ),
-            role=SatoriGuildRole(
-                id=json.dumps(sorted(data["member"]["roles"]))
-            )
-        )
         self._id += 1
-        self._queue.put_nowait(satori_evt.to_dict())
+        await self._queue.put(satori_evt)
 
     async def _deal_group_event(self,data):
-        qqmsg_arr = _qqmsg_to_arr(data["content"])
-        # print("qqmsg_arr",qqmsg_arr)
-        satori_msg = await self._qqarr_to_satori(qqmsg_arr)
+        satori_evt = self._group_event_to_satori(data)
         self.msgid_map["GROUP_"+data["group_id"]] = data["id"]
-        satori_evt = SatoriGroupMessageCreatedEvent(
-            id=self._id,
-            self_id=self._botqq,
-            timestamp=int(time.mktime(time.strptime(data["timestamp"], "%Y-%m-%dT%H:%M:%S%z"))) * 1000,
-            platform="qq_group",
-            channel=SatoriChannel(
-                id="GROUP_"+data["group_id"],
-                type=SatoriChannel.ChannelType.TEXT,
-            ),
-            message=SatoriMessage(
-                id=data["id"],
-                content=satori_msg,
-                created_at=int(time.mktime(time.strptime(data["timestamp"], "%Y-%m-%dT%H:%M:%S%z"))) * 1000
-            ),
-            user=SatoriUser(
-                id=data["author"]["id"]
-            ),
-            member=SatoriGuildMember(
-            ),
-            guild=SatoriGuild(
-                id="GROUP_"+data["group_id"]
-            ),
-            role=SatoriGuildRole(
-                id="unkonw",
-                name="unkonw"
-            )
-        )
         self._id += 1
-        self._queue.put_nowait(satori_evt.to_dict())
+        await self._queue.put(satori_evt)
 
     async def _deal_event(self,event):
         try:
@@ -299,84 +316,73 @@ class AdapterQQ:
                     if ("group_id" in d) and d["group_id"]:
                         await self._deal_group_event(d)
         except:
-            print(traceback.format_exc())
+            _log.exception("处理事件失败")
 
     async def _token_refresh_task(self):
-        while True:
+        while not self._is_stop:
+            await asyncio.sleep(60) # 每60秒检测一次token是否过期，停止时由release取消
             try:
                 await self._token_refresh()
-                index = 0
-                while index < 60: # 每60秒检测一次token是否过期
-                    await asyncio.sleep(1)
-                    if self._is_stop:
-                        break
-                    index += 1
-                if self._is_stop:break
-            except:
-                print(traceback.format_exc())
+            except Exception:
+                _log.exception("刷新token失败")
 
     async def init_after(self) -> None:
         '''适配器创建之后会调用一次，应该在这里进行ws连接等操作，如果不需要，可以不写'''
         try:
             await self._token_refresh()
         except:
-            print(traceback.format_exc())
-        asyncio.create_task(self._token_refresh_task())
-        asyncio.create_task(self._ws_server())
+            _log.exception("获取token失败")
+        self._token_task = asyncio.create_task(self._token_refresh_task())
+        self._ws_task = asyncio.create_task(self._ws_server())
 
     async def _api_call(self,path,data = None) -> dict:
         url:str = self._http_url + path
         headers = {"Authorization":"QQBot {}".format(self._access_token),"X-Union-Appid":self._appid}
+        route = path.split("?")[0]
         if data == None:
-            async with httpx.AsyncClient() as client:
-                return (await client.get(url,headers=headers)).json()
+            return json_loads((await self._http.get(url,headers=headers,route=route)).content)
         else:
-            async with httpx.AsyncClient() as client:
-                ret = (await client.post(url,headers=headers,json=data))
-                # print(ret.content)
-                return ret.json()
+            ret = (await self._http.post(url,headers=headers,json=data,route=route))
+            # print(ret.content)
+            return json_loads(ret.content)
 
     def _make_qq_text(self,text:str):
-        ret = text
-        ret = ret.replace("&","&amp;")
-        ret = ret.replace("<","&lt;")
-        ret = ret.replace(">","&gt;")
-        return ret
+        return qq_escape(text)
     
     async def _satori_to_qq(self,satori_obj,platform = "qq_guild") -> [dict]:
         to_reply_id = None
         ret_text = ""
         ret_img = []
-        for node in satori_obj:
-            if isinstance(node,str):
-                text = self._make_qq_text(node)
-                ret_text += text
-            else:
-                if node["type"] == "at":
-                    type = get_json_or(node["attrs"],"type",None)
-                    id = get_json_or(node["attrs"],"id",None)
-                    if type == "all":
-                        # 注意，机器人不支持at all，不能发，也不能收，这里假装at all了
-                        ret_text += "@全体成员"
-                        # text = "<@everyone>"
-                    elif id != None:
-                        ret_text += "<@{}>".format(self._make_qq_text(id))
-                elif node["type"] == "img":
-                    img_url:str = node["attrs"]["src"]
-                    if img_url.startswith("data:image/"):
-                        base64_start = img_url.find("base64,")
-                        img_content = base64.b64decode(img_url[base64_start + 7:])
-                        ret_img.append(img_content)
-                    else:
-                        if platform == "qq_guild":
-                            async with httpx.AsyncClient() as client:
-                                img_content =  (await client.get(img_url)).content
-                                ret_img.append(img_content)
+        try:
+            for node in satori_obj:
+                if isinstance(node,str):
+                    text = self._make_qq_text(node)
+                    ret_text += text
+                else:
+                    if node["type"] == "at":
+                        type = get_json_or(node["attrs"],"type",None)
+                        id = get_json_or(node["attrs"],"id",None)
+                        if type == "all":
+                            # 注意，机器人不支持at all，不能发，也不能收，这里假装at all了
+                            ret_text += "@全体成员"
+                            # text = "<@everyone>"
+                        elif id != None:
+                            ret_text += "<@{}>".format(self._make_qq_text(id))
+                    elif node["type"] == "img":
+                        img_url:str = node["attrs"]["src"]
+                        if img_url.startswith("data:image/") or platform == "qq_guild":
+                            ret_img.append(await self._fetcher.fetch(img_url))
                         else:
                             ret_img.append(img_url)
-                elif node["type"] == "passive":
-                    to_reply_id = node["attrs"]["id"]
-                    
+                    elif node["type"] == "passive":
+                        to_reply_id = node["attrs"]["id"]
+        except BaseException:
+            # 后面的图片下载失败时，已经下载好的图片还没有交给create_message，在这里关闭
+            for img in ret_img:
+                if isinstance(img,FetchedMedia):
+                    img.close()
+            raise
+
         ret_vec = []
         ret_vec.append({
             "content":ret_text,
@@ -398,25 +404,31 @@ class AdapterQQ:
         to_reply_id = self.msgid_map[channel_id]
         satori_obj = parse_satori_html(content)
         to_sends = await self._satori_to_qq(satori_obj,platform)
-        # print(to_sends)
+        try:
+            return await self._send_qq(platform,channel_id,to_reply_id,to_sends)
+        finally:
+            for it in to_sends:
+                if isinstance(it["file_image"],FetchedMedia):
+                    it["file_image"].close()
+
+    async def _send_qq(self,platform:str,channel_id:str,to_reply_id,to_sends:list) -> list:
         if channel_id.startswith("CHANNEL_") and platform == "qq_guild":
             channel_id = channel_id[8:]
             to_ret = []
             for it in to_sends:
                 if it["to_reply_id"]:to_reply_id = it["to_reply_id"]
-                async with httpx.AsyncClient() as client:
-                    headers = {"Authorization":"QQBot {}".format(self._access_token),"X-Union-Appid":self._appid,"Accept":"application/json"}
-                    url:str = self._http_url + "/channels/{}/messages".format(channel_id)
-                    data = {
-                        "msg_id":to_reply_id,
-                        "content":it["content"]
-                    }
-                    if it["file_image"]:
-                        ret = (await client.post(url,headers=headers,data=data,files={"file_image":it["file_image"]})).json()
-                    else:
-                        ret = (await client.post(url,headers=headers,json=data)).json()
-                    # print(ret)
-                    to_ret.append(SatoriMessage(id=ret["id"],content="").to_dict())
+                headers = {"Authorization":"QQBot {}".format(self._access_token),"X-Union-Appid":self._appid,"Accept":"application/json"}
+                url:str = self._http_url + "/channels/{}/messages".format(channel_id)
+                data = {
+                    "msg_id":to_reply_id,
+                    "content":it["content"]
+                }
+                if it["file_image"]:
+                    ret = json_loads((await self._http.post(url,headers=headers,data=data,files={"file_image":it["file_image"].upload_body()},route="/channels/messages",channel=channel_id)).content)
+                else:
+                    ret = json_loads((await self._http.post(url,headers=headers,json=data,route="/channels/messages",channel=channel_id)).content)
+                # print(ret)
+                to_ret.append(SatoriMessage(id=ret["id"],content="").to_dict())
             return to_ret
         elif channel_id.startswith("GROUP_") and platform == "qq_group":
             channel_id = channel_id[6:]
@@ -424,22 +436,36 @@ class AdapterQQ:
             msg_seq = 1
             for it in to_sends:
                 if it["to_reply_id"]:to_reply_id = it["to_reply_id"]
-                async with httpx.AsyncClient() as client:
-                    headers = {"Authorization":"QQBot {}".format(self._access_token),"X-Union-Appid":self._appid,"Accept":"application/json"}
-                    url:str = self._http_url + "/v2/groups/{}/messages".format(channel_id)
-                    data = {
-                        "msg_id":to_reply_id,
-                        "content":it["content"],
-                        "msg_type":0,
-                        "msg_seq":msg_seq,
-                        # "image": 目前暂不支持
-                    }
-                    msg_seq += 1
-                    ret = (await client.post(url,headers=headers,json=data)).json()
-                    # print(ret)
-                    to_ret.append(SatoriMessage(id=ret["msg_id"],content="").to_dict())
+                headers = {"Authorization":"QQBot {}".format(self._access_token),"X-Union-Appid":self._appid,"Accept":"application/json"}
+                url:str = self._http_url + "/v2/groups/{}/messages".format(channel_id)
+                data = {
+                    "msg_id":to_reply_id,
+                    "content":it["content"],
+                    "msg_type":0,
+                    "msg_seq":msg_seq,
+                    # "image": 目前暂不支持
+                }
+                msg_seq += 1
+                ret = json_loads((await self._http.post(url,headers=headers,json=data,route="/v2/groups/messages",channel=channel_id)).content)
+                # print(ret)
+                to_ret.append(SatoriMessage(id=ret["msg_id"],content="").to_dict())
             return to_ret
     
+    async def _get_self_user(self,refresh:bool = False) -> dict:
+        '''获取bot自己的信息，结果会被缓存，同时只会有一个请求'''
+        async with self._self_user_lock:
+            if refresh or self._self_user == None:
+                self._self_user = await self._api_call("/users/@me")
+                self._self_id = self._self_user["id"]
+        return self._self_user
+
+    async def _refresh_self_user(self) -> None:
+        '''网关重新连接后刷新缓存的bot信息'''
+        try:
+            await self._get_self_user(refresh=True)
+        except Exception:
+            _log.exception("刷新bot信息失败")
+
     async def get_login(self,platform:Optional[str],self_id:Optional[str]) -> [dict]:
         '''获取登录信息，如果platform和self_id为空，那么应该返回一个列表'''
 
@@ -454,7 +480,7 @@ class AdapterQQ:
                     platform="qq_group"
                 ).to_dict()
         else: 
-            obret =  (await self._api_call("/users/@me"))
+            obret =  await self._get_self_user()
             satori_ret = SatoriLogin(
                 status=self._login_status,
                 user=SatoriUser(
@@ -466,7 +492,6 @@ class AdapterQQ:
                 self_id=obret["id"],
                 platform="qq_guild"
             ).to_dict()
-            self._self_id = obret["id"]
             if platform == "qq_guild":
                 return satori_ret
             elif platform == None:
@@ -497,6 +522,6 @@ class AdapterQQ:
                 ),
                 nick=get_json_or(obret,"nick",None),
                 avatar=obret["user"]["avatar"],
-                joined_at=int(time.mktime(time.strptime(obret["joined_at"], "%Y-%m-%dT%H:%M:%S%z"))) * 1000
+                joined_at=_joined_at_ms(obret["joined_at"])
             ).to_dict()
             return satori_ret
\ No newline at end of file
@@ -0,0 +1,235 @@
+import asyncio
+import time
+from collections import OrderedDict
+
+from tool import get_json_or, json_loads
+from metrics import route_label
+from log import get_logger
+
+_log = get_logger("ratelimit")
+
+
+class _Bucket:
+    '''令牌桶，rate为None时不限速，只在服务器要求等待时等待
+        等待的请求通过锁排队，先来的先发'''
+    def __init__(self,rate,burst) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0 # 服务器要求在这个时间之前不要再发请求
+        self.limit = None # 从服务器学到的限制
+        self.remaining = None
+        self.waiting = 0
+        self._lock = asyncio.Lock()
+
+    def _refill(self,now:float) -> None:
+        if self.rate != None:
+            self.tokens = min(self.burst,self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self) -> float:
+        '''等到可以发送为止，返回等待的秒数'''
+        start = time.monotonic()
+        self.waiting += 1
+        try:
+            async with self._lock:
+                while True:
+                    now = time.monotonic()
+                    if now < self.blocked_until:
+                        await asyncio.sleep(self.blocked_until - now)
+                        continue
+                    if self.rate == None:
+                        break
+                    self._refill(now)
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        break
+                    await asyncio.sleep((1 - self.tokens) / self.rate)
+        finally:
+            self.waiting -= 1
+        return time.monotonic() - start
+
+    def block(self,seconds:float) -> None:
+        self.blocked_until = max(self.blocked_until,time.monotonic() + seconds)
+
+    def learn(self,limit:int,remaining:int,reset:float) -> None:
+        '''根据服务器返回的剩余次数调整，用完时一直等到服务器说的重置时间'''
+        self.limit = limit
+        self.remaining = remaining
+        if remaining <= 0:
+            self.block(reset)
+        elif self.rate != None:
+            self._refill(time.monotonic())
+            self.tokens = min(self.tokens,remaining)
+
+    def idle(self) -> bool:
+        if self.waiting or time.monotonic() < self.blocked_until:
+            return False
+        self._refill(time.monotonic())
+        return self.rate == None or self.tokens >= self.burst
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        self._refill(now)
+        return {
+            "rate":self.rate,
+            "burst":self.burst,
+            "tokens":round(self.tokens,2) if self.rate != None else None,
+            "limit":self.limit,
+            "remaining":self.remaining,
+            "blocked_for":round(max(0.0,self.blocked_until - now),2),
+            "waiting":self.waiting,
+        }
+
+
+def _header_float(headers,name:str,default:float) -> float:
+    try:
+        return float(headers[name])
+    except (KeyError,ValueError):
+        return default
+
+
+def _kook_hint(res,codes) -> tuple:
+    '''kook：X-Rate-Limit-*响应头，超限时返回429'''
+    headers = res.headers
+    learned = None
+    if "X-Rate-Limit-Remaining" in headers:
+        learned = (
+            int(_header_float(headers,"X-Rate-Limit-Limit",0)),
+            int(_header_float(headers,"X-Rate-Limit-Remaining",1)),
+            _header_float(headers,"X-Rate-Limit-Reset",1),
+        )
+    retry_after = None
+    if res.status_code == 429:
+        retry_after = _header_float(headers,"X-Rate-Limit-Reset",1)
+    return learned,retry_after,"X-Rate-Limit-Global" in headers
+
+
+def _qq_hint(res,codes) -> tuple:
+    '''qq：超限时返回429，或者在错误的body中带上超频的错误码'''
+    retry_after = None
+    if res.status_code == 429:
+        retry_after = _header_float(res.headers,"Retry-After",1)
+    elif res.status_code >= 400 and codes:
+        try:
+            code = json_loads(res.content).get("code")
+        except Exception:
+            code = None
+        if code in codes:
+            retry_after = _header_float(res.headers,"Retry-After",1)
+    return None,retry_after,False
+
+
+def _mihoyo_hint(res,codes) -> tuple:
+    '''米游社：http状态码总是200，超频体现在retcode中'''
+    retry_after = None
+    if res.status_code == 429:
+        retry_after = 1
+    elif codes:
+        try:
+            code = json_loads(res.content).get("retcode")
+        except Exception:
+            code = None
+        if code in codes:
+            retry_after = 1
+    return None,retry_after,False
+
+
+# 平台 -> (解析响应的函数,默认的超频错误码)
+_PLATFORM_HINTS = {
+    "kook":(_kook_hint,[]),
+    "qq":(_qq_hint,[22009]),
+    "mihoyo":(_mihoyo_hint,[]),
+}
+
+
+class RateLimiter:
+    '''一个bot的出站限速：整个bot一个令牌桶，每个API路由一个，每个频道一个
+        请求会排队等待令牌而不是直接失败；从响应中学习服务器的限制，遇到超限按服务器给的时间等待后重试
+        配置项放在bot配置的"ratelimit"字段中，均可省略：
+        {
+            "enable":true,               是否启用
+            "rate":20,                   整个bot每秒的请求数
+            "burst":40,                  整个bot允许的突发请求数
+            "channel_rate":5,            单个频道每秒的发送数
+            "channel_burst":5,           单个频道允许的突发发送数
+            "max_retries":3,             超限后最多重试几次
+            "codes":[22009]              表示超频的业务错误码，默认值与平台有关
+        }
+        路由桶默认不限速，只按服务器返回的剩余次数和重置时间等待
+        路由中的id合并成":id"，同一类接口共用一个桶；路由桶和频道桶各自最多保留_MAX_BUCKETS个，超出时淘汰最久没用过的
+    '''
+    _MAX_BUCKETS = 1024
+
+    def __init__(self,config,platform:str) -> None:
+        cfg = get_json_or(config,"ratelimit",{})
+        hint,codes = _PLATFORM_HINTS[platform]
+        self._hint = hint
+        self.enable = get_json_or(cfg,"enable",True)
+        self._codes = set(get_json_or(cfg,"codes",codes))
+        if self.enable and platform == "mihoyo" and not self._codes:
+            # 米游社超频时http状态码仍是200，只能靠retcode识别
+            _log.warning("mihoyo的ratelimit没有配置codes，无法识别平台的超频响应，只按本地的速率限速")
+        self._channel_rate = get_json_or(cfg,"channel_rate",5)
+        self._channel_burst = get_json_or(cfg,"channel_burst",5)
+        self._max_retries = get_json_or(cfg,"max_retries",3)
+        self._bot = _Bucket(get_json_or(cfg,"rate",20),get_json_or(cfg,"burst",40))
+        self._routes = OrderedDict() # 最近用过的在最后
+        self._channels = OrderedDict()
+        self.requests = 0
+        self.limited = 0 # 被服务器判定超限的次数
+        self.wait_seconds = 0.0 # 在本地排队等待的总时间
+
+    def _get_bucket(self,buckets:OrderedDict,key,rate,burst) -> _Bucket:
+        bucket = buckets.get(key)
+        if bucket != None:
+            buckets.move_to_end(key)
+            return bucket
+        while len(buckets) >= self._MAX_BUCKETS:
+            # 优先淘汰最久没用过的空闲桶，都不空闲时淘汰最久没用过的，正在用它的请求持有引用，不受影响
+            for k,v in buckets.items():
+                if v.idle():
+                    del buckets[k]
+                    break
+            else:
+                buckets.popitem(last=False)
+        bucket = _Bucket(rate,burst)
+        buckets[key] = bucket
+        return bucket
+
+    async def call(self,route:str,channel,send):
+        '''send是无参数的协程函数，返回httpx.Response，超限时会重新调用它'''
+        route_bucket = self._get_bucket(self._routes,route_label(route),None,None)
+        channel_bucket = None
+        if channel != None:
+            channel_bucket = self._get_bucket(self._channels,channel,self._channel_rate,self._channel_burst)
+        retries = 0
+        while True:
+            waited = await self._bot.acquire()
+            waited += await route_bucket.acquire()
+            if channel_bucket != None:
+                waited += await channel_bucket.acquire()
+            self.wait_seconds += waited
+            self.requests += 1
+            res = await send()
+            learned,retry_after,is_global = self._hint(res,self._codes)
+            if learned != None:
+                route_bucket.learn(*learned)
+            if retry_after == None:
+                return res
+            self.limited += 1
+            (self._bot if is_global else route_bucket).block(retry_after)
+            if retries >= self._max_retries:
+                return res
+            retries += 1
+
+    def stats(self) -> dict:
+        return {
+            "requests":self.requests,
+            "limited":self.limited,
+            "wait_seconds":round(self.wait_seconds,3),
+            "bot":self._bot.stats(),
+            "routes":{k:v.stats() for k,v in self._routes.items()},
+            "channels":{str(k):v.stats() for k,v in self._channels.items()},
+        }
@@ -1,4 +1,6 @@
 import asyncio
+import inspect
+import signal
 
 import aiohttp
 from kook_adapter import AdapterKook
@@ -6,99 +8,396 @@ from mihoyo_adapter import AdapterMihoyo
 from onebot_adapter import AdapterOnebot
 from config import Config
 from aiohttp import web
-import json
 import uuid
+from collections import deque
+from itertools import islice
 from qq_adapter import AdapterQQ
+from journal import Journal
+from worker import WorkerAdapter, use_worker
+from metrics import MetricsWriter, write_adapter_metrics
+from log import get_logger, setup_logging
 
-from tool import remove_json_null
+from tool import remove_json_null, json_loads, json_dumps, json_dumps_bytes, get_json_or, encode_event
+
+_log = get_logger("hub")
+_log_http = get_logger("http")
+_log_ws = get_logger("ws")
+_log_send = get_logger("ws.send") # 每个发出的帧，量很大，需要时再打开DEBUG
+
+class _EventSubscriber:
+    '''一个/v1/events连接，事件放入有界队列，由该连接独占的写任务按顺序发出
+        overflow为队列满时的处理方式：
+            drop_oldest：丢弃最旧的事件
+            disconnect：断开这个连接
+            block：阻塞事件的生产者，直到队列有空位
+    '''
+    def __init__(self,ws:web.WebSocketResponse,transport:asyncio.Transport,maxsize:int,overflow:str) -> None:
+        self.ws = ws
+        self._transport = transport
+        self.is_access = False
+        self._maxsize = maxsize
+        self._overflow = overflow
+        self._queue = deque()
+        self._ctrl_queue = deque() # pong、ready等控制帧，优先发送，不受队列长度限制
+        self._not_empty = asyncio.Event()
+        self._not_full = asyncio.Event()
+        self._not_full.set()
+        self._closed = False
+        self._close_task = None
+        # 滞后计数
+        self.sent = 0
+        self.dropped = 0
+        self.max_lag = 0
+        self._task = asyncio.create_task(self._writer())
+
+    def lag(self) -> int:
+        '''还未发出的事件数'''
+        return len(self._queue)
+
+    def stats(self) -> dict:
+        return {
+            "lag":self.lag(),
+            "max_lag":self.max_lag,
+            "sent":self.sent,
+            "dropped":self.dropped,
+        }
+
+    def put_replay(self,frames:list) -> None:
+        '''放入重放的事件，不受队列长度限制(总量已由重放缓冲区限制)'''
+        if self._closed:
+            return
+        self._queue.extend(frames)
+        if len(self._queue) > self.max_lag:
+            self.max_lag = len(self._queue)
+        self._not_empty.set()
+
+    def put_ctrl(self,js) -> None:
+        if self._closed:
+            return
+        self._ctrl_queue.append(js)
+        self._not_empty.set()
+
+    async def put(self,frame:str) -> None:
+        '''放入一个已经编码好的事件帧'''
+        if self._closed:
+            return
+        while len(self._queue) >= self._maxsize:
+            if self._overflow == "disconnect":
+                self.dropped += 1
+                _log_ws.warning("事件连接积压满，断开连接")
+                # 这里在所有连接共用的事件分发中，不能等待关闭完成
+                self.disconnect()
+                return
+            elif self._overflow == "block":
+                self._not_full.clear()
+                await self._not_full.wait()
+                if self._closed:
+                    return
+            else:
+                self._queue.popleft()
+                self.dropped += 1
+        self._queue.append(frame)
+        if len(self._queue) > self.max_lag:
+            self.max_lag = len(self._queue)
+        self._not_empty.set()
+
+    async def _writer(self) -> None:
+        try:
+            while True:
+                while not self._ctrl_queue and not self._queue:
+                    self._not_empty.clear()
+                    await self._not_empty.wait()
+                if self._ctrl_queue:
+                    await Satori.ws_send_json(self.ws,self._ctrl_queue.popleft())
+                else:
+                    frame = self._queue.popleft()
+                    self._not_full.set()
+                    self.sent += 1
+                    await Satori.ws_send_text(self.ws,frame)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            _log_ws.info("发送失败 %s",e)
+            self.disconnect()
+
+    def stop(self) -> None:
+        '''停止写任务，连接由调用者关闭'''
+        self._closed = True
+        self._not_full.set()
+        self._task.cancel()
+
+    def disconnect(self) -> None:
+        '''停止写任务，在单独的任务中关闭连接，立即返回'''
+        if self._closed:
+            return
+        self.stop()
+        self._close_task = asyncio.create_task(self._close_ws())
+
+    async def _close_ws(self) -> None:
+        try:
+            await asyncio.wait_for(self.ws.close(),5)
+        except (asyncio.CancelledError,Exception) as e:
+            # 取消写任务时aiohttp共用的drain等待也被取消，这时close会抛出CancelledError
+            _log_ws.debug("关闭事件连接 %r",e)
+        finally:
+            # 对方不读数据时发送缓冲区排不空，transport会一直停在closing状态，丢弃缓冲区直接断开
+            if self._transport != None:
+                self._transport.abort()
+
+class _ReplayBuffer:
+    '''最近事件的环形缓冲区，同时按条数和字节数(UTF-8编码后的长度)限制，用于断线重连后重放事件
+        每个事件有一个单调递增的序号sn，缓冲区内的sn是连续的'''
+    def __init__(self,max_count:int,max_bytes:int) -> None:
+        self._max_count = max_count
+        self._max_bytes = max_bytes
+        self._frames = deque() # (sn,已编码的事件帧,UTF-8字节数)
+        self._bytes = 0
+
+    def append(self,sn:int,frame:str) -> None:
+        size = len(frame.encode())
+        self._frames.append((sn,frame,size))
+        self._bytes += size
+        while self._frames and (len(self._frames) > self._max_count or self._bytes > self._max_bytes):
+            self._bytes -= self._frames.popleft()[2]
+
+    def first_sn(self) -> int:
+        '''缓冲区中最早的sn，缓冲区为空时返回None'''
+        if not self._frames:
+            return None
+        return self._frames[0][0]
+
+    def since(self,sn:int) -> list:
+        '''返回sn之后的所有事件帧'''
+        first_sn = self.first_sn()
+        if first_sn == None:
+            return []
+        start = max(sn + 1 - first_sn,0)
+        return [frame for _,frame,_ in islice(self._frames,start,None)]
+
+# satori的API路径 -> (适配器中对应的函数名, 需要从请求体中依次取出的参数)
+_API_TABLE = {
+    "/v1/login.get":("get_login",()),
+    "/v1/guild.member.get":("get_guild_member",("guild_id","user_id")),
+    "/v1/message.create":("create_message",("channel_id","content")),
+    "/v1/channel.list":("get_channel_list",("guild_id",)),
+    "/v1/user.get":("get_user",("user_id",)),
+}
+
+# 管理API路径 -> 适配器中返回统计信息的函数名，没有实现这个函数的适配器不出现在结果中
+_ADMIN_STATS = {
+    "/v1/admin/ratelimit.list":"get_ratelimit_stats",
+    "/v1/admin/media_cache.list":"get_media_stats",
+    "/v1/admin/event_queue.list":"get_event_queue_stats",
+    "/v1/admin/worker.list":"get_worker_stats",
+}
+
+# 汇总登录信息时，单个适配器的超时秒数
+_LOGIN_TIMEOUT = 5
 
 class Satori:
     def __init__(self) -> None:
         self._config:Config = Config()
         self.adapterlist = []
         self.wsmap = {}
-        self._evt_id = 100
-
-    async def _get_adapter(self,platform,self_id):
-        ''' 用于获取适配器 '''
-        for adapter in self.adapterlist:
-            info = adapter["info"]
-            for bot in info:
-                if self_id == bot["self_id"] and bot["platform"] == platform:
-                    return adapter["adapter"]
-        return None
+        self._event_sn = 0 # 最后一个事件的序号，每个事件加一，所有连接共用
+        self._replay:_ReplayBuffer = None
+        self._journal:Journal = None
+        self._bot_index = {} # (platform,self_id) -> {"adapter":适配器,"api":{API路径:适配器的函数}}
+        self._events_out = {} # 适配器 -> 已经分发的事件数
+        self._api_inflight = 0 # 正在处理的satori API调用数
+        self._event_tasks = [] # 每个适配器的事件分发任务
+        self._runner:web.AppRunner = None
+
+    def _get_bot(self,platform,self_id) -> dict:
+        ''' 用于获取bot所在的适配器和它支持的API '''
+        return self._bot_index.get((platform,self_id))
+
+    def _register_adapter(self,adapter,login_info:list,platform:str) -> None:
+        '''登记适配器，根据适配器实现了哪些函数生成API表，并建立bot索引'''
+        api = {}
+        for path,(func_name,_) in _API_TABLE.items():
+            func = getattr(adapter,func_name,None)
+            if func != None:
+                api[path] = func
+        entry = {
+            "adapter":adapter,
+            "platform":platform,
+            "info":login_info,
+            "api":api,
+        }
+        self.adapterlist.append(entry)
+        self._index_logins(entry,login_info)
+
+    def _index_logins(self,entry:dict,login_info:list) -> None:
+        for bot in login_info:
+            self._bot_index[(bot["platform"],bot["self_id"])] = entry
+
+    async def _get_logins(self) -> list:
+        '''并发获取所有适配器的登录信息，适配器自己会缓存登录信息，所以这里通常不会产生网络请求
+            某个适配器超时或出错时，使用它上一次的登录信息'''
+        async def get_one(entry:dict) -> list:
+            adapter = entry["adapter"]
+            if not hasattr(adapter,"get_login"):
+                return []
+            try:
+                login_info = await asyncio.wait_for(adapter.get_login(None,None),_LOGIN_TIMEOUT)
+            except Exception:
+                _log.exception("获取登录信息失败")
+                return entry["info"]
+            entry["info"] = login_info
+            self._index_logins(entry,login_info)
+            return login_info
+        logins = []
+        for login_info in await asyncio.gather(*[get_one(entry) for entry in self.adapterlist]):
+            logins += login_info
+        return logins
     
+    async def _get_adapter_stats(self,func_name:str) -> list:
+        '''收集每个bot的统计信息，在工作进程中运行的适配器返回的是协程'''
+        ret = []
+        for entry in self.adapterlist:
+            adapter = entry["adapter"]
+            if not hasattr(adapter,func_name):
+                continue
+            stats = getattr(adapter,func_name)()
+            if inspect.isawaitable(stats):
+                stats = await stats
+            for bot in entry["info"]:
+                ret.append({"platform":bot["platform"],"self_id":bot["self_id"],**stats})
+        return ret
+
+    async def _render_metrics(self) -> str:
+        '''Prometheus文本格式的运行指标，适配器的部分由各自的get_metrics提供'''
+        writer = MetricsWriter()
+        await self._get_logins() # 适配器缓存了登录信息，这里只是刷新一下状态
+        for index,entry in enumerate(self.adapterlist):
+            adapter = entry["adapter"]
+            labels = {"platform":entry["platform"],"adapter":index}
+            writer.counter("satori_events_out_total","分发给订阅者的事件数",labels,self._events_out.get(adapter,0))
+            try:
+                if hasattr(adapter,"get_metrics"):
+                    metrics = adapter.get_metrics()
+                    if inspect.isawaitable(metrics):
+                        metrics = await metrics
+                    write_adapter_metrics(writer,labels,metrics)
+                if hasattr(adapter,"get_worker_stats"):
+                    worker = adapter.get_worker_stats()
+                    writer.gauge("satori_worker_up","工作进程是否在运行",labels,worker["alive"])
+                    writer.counter("satori_worker_restarts_total","工作进程意外退出后重启的次数",labels,worker["restarts"])
+            except Exception:
+                _log.exception("获取适配器指标失败")
+            for bot in entry["info"]:
+                writer.gauge("satori_login_status","bot的登录状态，0离线，1在线，2连接中，3断开，4重连中",
+                             {"platform":bot["platform"],"self_id":bot["self_id"]},bot["status"])
+        writer.gauge("satori_event_sn","最后一个事件的序号",{},self._event_sn)
+        writer.gauge("satori_subscribers","事件websocket连接数",{},len(self.wsmap))
+        for ws_id,subscriber in self.wsmap.items():
+            stats = subscriber.stats()
+            labels = {"subscriber":ws_id}
+            writer.gauge("satori_subscriber_lag","订阅者还未发出的事件数",labels,stats["lag"])
+            writer.gauge("satori_subscriber_max_lag","订阅者积压过的最多事件数",labels,stats["max_lag"])
+            writer.counter("satori_subscriber_sent_total","发给订阅者的事件数",labels,stats["sent"])
+            writer.counter("satori_subscriber_dropped_total","订阅者积压满时丢弃的事件数",labels,stats["dropped"])
+        writer.gauge("satori_api_calls_inflight","正在处理的satori API调用数",{},self._api_inflight)
+        writer.gauge("satori_tasks_inflight","事件循环中未完成的任务数",{},len(asyncio.all_tasks()))
+        return writer.render()
+
+    async def _get_replay(self,last_sn:int) -> list:
+        '''获取last_sn之后的所有事件帧，内存中没有的部分从日志中分批读取，直到和内存中的部分接上
+            每次读取之间缓冲区可能又淘汰了一些事件，所以每一批之前都重新检查'''
+        frames = []
+        while self._journal != None:
+            first_sn = self._replay.first_sn()
+            until_sn = self._event_sn if first_sn == None else first_sn - 1
+            if last_sn >= until_sn:
+                break
+            chunk = await self._journal.read_range(last_sn,until_sn)
+            if len(chunk) == 0:
+                _log.warning("日志中缺少%s之后的事件，重放不完整",last_sn)
+                break
+            for sn,frame in chunk:
+                frames.append(frame)
+                last_sn = sn
+        return frames + self._replay.since(last_sn)
+
     async def ws_send_json(ws,js) -> None:
-        js = remove_json_null(js)
-        print("--------ws_send_json",json.dumps(js))
-        await ws.send_json(js)
+        await Satori.ws_send_text(ws,json_dumps(remove_json_null(js)))
+
+    async def ws_send_text(ws,text:str) -> None:
+        '''发送已经编码好的帧'''
+        _log_send.debug("%s",text)
+        await ws.send_str(text)
+
+    def encode_event(msg:dict) -> str:
+        '''将事件体编码一次，返回去掉开头"{"的片段，之后用make_event_frame拼上事件id即可'''
+        return encode_event(msg)
+
+    def _json_response(ret) -> web.Response:
+        return web.Response(body=json_dumps_bytes(remove_json_null(ret)),headers={
+            "Content-Type":"application/json; charset=utf-8"
+        })
+
+    def make_event_frame(encoded_body:str,evt_id:int) -> str:
+        return '{"op":0,"body":{"id":' + str(evt_id) + encoded_body + '}'
     
     async def _handle_http_normal(self,request:web.Request):
-        print("----http normal",request)
+        _log_http.debug("%s",request)
         '''在这里处理普通api调用'''
         # 鉴权
         if self._config.access_token != "":
             if request.headers.get("Authorization") != "Bearer " + self._config.access_token:
-                print("token err")
+                _log_http.warning("token错误 %s",request.remote)
                 return web.Response(text="token err")
         method = request.url.path
         platform = request.headers.get("X-Platform")
         self_id = request.headers.get("X-Self-ID")
-        adapter:AdapterOnebot = await self._get_adapter(platform,self_id)
-        if adapter == None:
+        api = _API_TABLE.get(method)
+        if api == None:
+            return web.Response(text="method not found")
+        bot = self._get_bot(platform,self_id)
+        if bot == None:
             return web.Response(text="bot not found")
-        if method == "/v1/login.get":
-            ret = await adapter.get_login(platform,self_id)
-            return web.Response(text=json.dumps(remove_json_null(ret)),headers={
-                "Content-Type":"application/json; charset=utf-8"
-            })
-        elif method == "/v1/guild.member.get":
-            body = await request.json()
-            ret = await adapter.get_guild_member(platform,self_id,body["guild_id"],body["user_id"])
-            return web.Response(text=json.dumps(remove_json_null(ret)),headers={
-                "Content-Type":"application/json; charset=utf-8"
-            })
-        elif method == "/v1/message.create":
-            body = await request.json()
-            ret = await adapter.create_message(platform,self_id,body["channel_id"],body["content"])
-            return web.Response(text=json.dumps(remove_json_null(ret)),headers={
-                "Content-Type":"application/json; charset=utf-8"
-            })
-        elif method == "/v1/channel.list":
-            body = await request.json()
-            ret = await adapter.get_channel_list(platform,self_id,body["guild_id"])
-            return web.Response(text=json.dumps(remove_json_null(ret)),headers={
-                "Content-Type":"application/json; charset=utf-8"
-            })
-        elif method == "/v1/user.get":
-            body = await request.json()
-            ret = await adapter.get_user(platform,self_id,body["user_id"])
-            return web.Response(text=json.dumps(remove_json_null(ret)),headers={
-                "Content-Type":"application/json; charset=utf-8"
-            })
-        return web.Response(text="method not found")
+        func = bot["api"].get(method)
+        if func == None:
+            return web.Response(text="method not supported")
+        _,arg_names = api
+        args = []
+        if len(arg_names) != 0:
+            body = json_loads(await request.read())
+            for name in arg_names:
+                args.append(body[name])
+        self._api_inflight += 1
+        try:
+            ret = await func(platform,self_id,*args)
+        finally:
+            self._api_inflight -= 1
+        return Satori._json_response(ret)
     
     async def _handle_http_admin(self,request:web.Request):
-        print("----http admin",request)
+        _log_http.debug("%s",request)
         '''在这里处理管理api调用'''
         # 鉴权
         if self._config.access_token != "":
             if request.headers.get("Authorization") != "Bearer " + self._config.access_token:
-                print("token err")
+                _log_http.warning("token错误 %s",request.remote)
                 return web.Response(text="token err")
         method = request.url.path
         if method == "/v1/admin/login.list":
-            ret = []
-            for adapter in self.adapterlist:
-                ret += await adapter["adapter"].get_login(None,None)
-            return web.Response(text=json.dumps(remove_json_null(ret)),headers={
-                "Content-Type":"application/json; charset=utf-8"
+            ret = await self._get_logins()
+            return Satori._json_response(ret)
+        if method == "/v1/admin/metrics":
+            return web.Response(body=(await self._render_metrics()).encode(),headers={
+                "Content-Type":"text/plain; version=0.0.4; charset=utf-8"
             })
+        stats_func = _ADMIN_STATS.get(method)
+        if stats_func != None:
+            ret = await self._get_adapter_stats(stats_func)
+            return Satori._json_response(ret)
         return web.Response(text="method not found")
     
     async def _handle_http_foo(self,request:web.Request):
         '''在这里处理其余任何api调用'''
-        print("--------http other",request)
+        _log_http.debug("%s",request)
         return web.Response(text="method not found")
     
     async def _handle_events_ws(self,request:web.Request):
@@ -107,62 +406,75 @@ class Satori:
         ws = web.WebSocketResponse()
         ws.can_prepare(request)
         await ws.prepare(request)
-        self.wsmap[ws_id] = {
-            "ws":ws,
-            "is_access":False
-        }
-        print("--------http ws",request,ws_id)
+        self.wsmap[ws_id] = _EventSubscriber(ws,request.transport,self._config.ws_queue_size,self._config.ws_overflow)
+        _log_ws.info("事件连接建立 %s %s",ws_id,request.remote)
         try:
             async for msg in ws:
                 if msg.type == aiohttp.WSMsgType.TEXT:
-                    data_json = json.loads(msg.data)
-                    print("--------recv_ws",json.dumps(msg.data))
+                    data_json = json_loads(msg.data)
+                    _log_ws.debug("收到 %s",msg.data)
                     op = data_json["op"]
                     if op == 3:
                         if self._config.access_token != "":
                             if data_json["body"]["token"] != self._config.access_token:
                                 raise "token err"
-                        self.wsmap[ws_id]["is_access"] = True
-                        async def get_logins(self,ws):
-                            logins = []
-                            for adapter in self.adapterlist:
-                                logins += await adapter["adapter"].get_login(None,None)
-                            await Satori.ws_send_json(ws,{
-                                "op":4,
-                                "body":{
-                                    "logins":logins
-                                }
-                            })
-                        asyncio.create_task(get_logins(self,ws))
+                        body = get_json_or(data_json,"body",{})
+                        last_sn = get_json_or(body,"sn",get_json_or(body,"sequence",None))
+                        logins = await self._get_logins()
+                        subscriber = self.wsmap[ws_id]
+                        subscriber.put_ctrl({
+                            "op":4,
+                            "body":{
+                                "logins":logins
+                            }
+                        })
+                        # 先重放last_sn之后的事件，再开始接收新事件，_get_replay返回后中间不能有await，以免丢失或重复事件
+                        if last_sn != None:
+                            subscriber.put_replay(await self._get_replay(int(last_sn)))
+                        subscriber.is_access = True
                     elif op == 1:
-                        async def send_pong(ws):
-                            await Satori.ws_send_json(ws,{
-                                "op":2
-                            })
-                        asyncio.create_task(send_pong(ws))
+                        self.wsmap[ws_id].put_ctrl({
+                            "op":2
+                        })
                 elif msg.type == aiohttp.WSMsgType.ERROR:
-                    print('ws connection closed with exception %s' %
-                        ws.exception())
+                    _log_ws.warning("事件连接异常关闭 %s",ws.exception())
         finally:
+            self.wsmap[ws_id].stop()
             del self.wsmap[ws_id]
-            print("--------http ws close",ws_id)
+            _log_ws.info("事件连接关闭 %s",ws_id)
         return ws
 
     async def init_after(self):
         async def event_loop(self:Satori,adapter:AdapterOnebot):
             while True:
-                msg = await adapter.get_msg()
-                for wsid in self.wsmap:
-                    ws = self.wsmap[wsid]
-                    if ws["is_access"]:
-                        msg["id"] = self._evt_id
-                        asyncio.create_task(Satori.ws_send_json(ws["ws"],{"op":0,"body":msg}))
-                        self._evt_id += 1
+                # 一次取出积压的多个事件，减少突发时每个事件的调度开销
+                if hasattr(adapter,"get_events"):
+                    bodies = await adapter.get_events(self._config.event_batch)
+                else:
+                    bodies = [Satori.encode_event(await adapter.get_msg())]
+                self._events_out[adapter] = self._events_out.get(adapter,0) + len(bodies)
+                for body in bodies:
+                    self._event_sn += 1
+                    frame = Satori.make_event_frame(body,self._event_sn)
+                    self._replay.append(self._event_sn,frame)
+                    if self._journal:
+                        self._journal.append(self._event_sn,frame)
+                    for subscriber in list(self.wsmap.values()):
+                        if subscriber.is_access:
+                            await subscriber.put(frame)
         # 读取配置文件
         await self._config.read_config()
+        setup_logging(self._config.log)
+        self._replay = _ReplayBuffer(self._config.replay_size,self._config.replay_bytes)
+        if self._config.journal != None:
+            self._journal = Journal(self._config.journal)
+            await self._journal.open()
+            self._event_sn = self._journal.last_sn() # 重启后接着日志中的序号
         # 创建 adapter
         for botcfg in self._config.botlist:
-            if botcfg["platform"] == "onebot":
+            if use_worker(botcfg):
+                adapter = WorkerAdapter(botcfg)
+            elif botcfg["platform"] == "onebot":
                 adapter = AdapterOnebot(botcfg)
             elif botcfg["platform"] == "kook":
                 adapter = AdapterKook(botcfg)
@@ -174,37 +486,60 @@ class Satori:
                 await adapter.init_after()
             if hasattr(adapter,"enable"):
                 await adapter.enable()
-            if hasattr(adapter,"get_msg"):
-                asyncio.create_task(event_loop(self,adapter))
+            if hasattr(adapter,"get_events") or hasattr(adapter,"get_msg"):
+                self._event_tasks.append(asyncio.create_task(event_loop(self,adapter)))
             login_info = []
             if hasattr(adapter,"get_login"):
                 login_info = await adapter.get_login(None,None)
-            self.adapterlist.append({
-                "adapter":adapter,
-                "info":login_info,
-            })
+            self._register_adapter(adapter,login_info,botcfg["platform"])
         # 创建server
         app = web.Application(client_max_size=1024**2*100) # 100MB
         app.add_routes([
             web.post("/v1/admin/{method}",self._handle_http_admin),
+            web.get("/v1/admin/metrics",self._handle_http_admin), # Prometheus用GET抓取
             web.get("/v1/events",self._handle_events_ws),
             web.post("/v1/{method}",self._handle_http_normal),
             web.post("/{method}",self._handle_http_foo),
         ])
-        runner = web.AppRunner(app)
-        await runner.setup()
-        site = web.TCPSite(runner,self._config.web_host,self._config.web_port)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner,self._config.web_host,self._config.web_port)
         asyncio.create_task(site.start())
 
+    async def release(self):
+        '''退出前调用：停止分发事件，关闭服务和适配器，最后把日志中还没写盘的事件写完'''
+        for task in self._event_tasks:
+            task.cancel()
+        if self._runner != None:
+            await self._runner.cleanup()
+        for entry in self.adapterlist:
+            adapter = entry["adapter"]
+            if hasattr(adapter,"release"):
+                try:
+                    await adapter.release()
+                except Exception:
+                    _log.exception("释放适配器失败")
+        if self._journal != None:
+            await self._journal.close()
+
 
 
 async def main():
     satori = Satori()
-    await satori.init_after()
-    while True:
-        await asyncio.sleep(1)
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT,signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig,stop.set)
+        except (NotImplementedError,AttributeError):
+            pass # windows不支持，Ctrl+C时asyncio.run会取消main，同样会走到finally
+    try:
+        await satori.init_after()
+        await stop.wait()
+    finally:
+        _log.info("正在退出")
+        await satori.release()
     
 
 if __name__ == '__main__':
-    loop = asyncio.get_event_loop()
-    loop.run_until_complete(main())
\ No newline at end of file
+    asyncio.run(main())
\ No newline at end of file
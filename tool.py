@@ -1,5 +1,36 @@
-from html.parser import HTMLParser
 from enum import Enum
+import json
+import re
+
+from escape import satori_escape, satori_unescape
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# json编解码，安装了orjson时使用orjson，否则使用标准库
+# json_dumps的输出是紧凑格式，且不转义非ascii字符
+if orjson:
+    def json_loads(data):
+        '''data可以是str或bytes'''
+        return orjson.loads(data)
+
+    def json_dumps(obj) -> str:
+        return orjson.dumps(obj).decode()
+
+    def json_dumps_bytes(obj) -> bytes:
+        return orjson.dumps(obj)
+else:
+    def json_loads(data):
+        '''data可以是str或bytes'''
+        return json.loads(data)
+
+    def json_dumps(obj) -> str:
+        return json.dumps(obj,ensure_ascii=False,separators=(",",":"))
+
+    def json_dumps_bytes(obj) -> bytes:
+        return json_dumps(obj).encode()
 
 def get_json_or(js,key,default):
     '''获取json中的字段'''
@@ -8,6 +39,23 @@ def get_json_or(js,key,default):
             return js[key]
     return default
 
+def encode_event_bytes(msg:dict) -> bytes:
+    '''将事件体编码一次，返回去掉开头"{"的片段(UTF-8编码)
+        之后拼上事件id即可得到完整的事件，不需要重新编码整个事件
+        模型的to_dict不会生成None字段，但适配器直接拼出来的dict可能有，
+        所以编码后检查一下":null"(紧凑格式)，有时才调用remove_json_null重新编码，平时不多遍历一次'''
+    msg.pop("id",None)
+    body = json_dumps_bytes(msg)
+    if b":null" in body:
+        body = json_dumps_bytes(remove_json_null(msg))
+    if body == b"{}":
+        return b"}"
+    return b"," + body[1:]
+
+def encode_event(msg:dict) -> str:
+    '''同encode_event_bytes，返回str'''
+    return encode_event_bytes(msg).decode()
+
 def remove_json_null(js) -> dict:
     '''将json中的None字段删除'''
     if isinstance(js,dict):
@@ -24,59 +72,84 @@ def remove_json_null(js) -> dict:
     else:
         return js
 
-class _MyHTMLParser(HTMLParser):
-    def __init__(self, *, convert_charrefs: bool = True) -> None:
-        super().__init__(convert_charrefs=convert_charrefs)
-        self.data = {
-            "data":[]
-        }
-        self.temp_data = self.data
-    def handle_starttag(self, tag, attrs):
-        tag_obj = {
-            "pre": self.temp_data,
-            "type":tag,
-            "data":[]
-        }
-        obj = dict()
-        for it in attrs:
-            obj[it[0]] = it[1]
-        tag_obj["attrs"] = obj
-        self.temp_data["data"].append(tag_obj)
-        self.temp_data = tag_obj
+# satori消息元素的标签：注释、结束标签、开始标签(可以自闭合)
+_SATORI_TAG_RE = re.compile(r'<(?:!--.*?-->|(/?)([A-Za-z][^\s/>]*)((?:[^>"\']|"[^"]*"|\'[^\']*\')*?)(/?)>)',re.S)
+# 标签中的属性：名字，双引号值，单引号值，无引号值(不包含自闭合的"/")
+_SATORI_ATTR_RE = re.compile(r'([^\s/=>"\']+)(?:\s*=\s*(?:"([^"]*)"|\'([^\']*)\'|((?:[^\s>/]|/(?!$))+)))?')
 
-    def handle_endtag(self, tag):
-        last = self.temp_data["pre"]
-        del self.temp_data["pre"]
-        self.temp_data["data"] = self.temp_data["data"]
-        self.temp_data = last
+def _satori_append_text(data:list,text:str) -> None:
+    text = satori_unescape(text)
+    if len(data) != 0 and isinstance(data[-1],str):
+        data[-1] += text
+    else:
+        data.append(text)
 
-    def handle_data(self, data):
-        self.temp_data["data"].append(data)
+def _satori_parse_attrs(text:str) -> dict:
+    attrs = {}
+    for m in _SATORI_ATTR_RE.finditer(text):
+        name,val1,val2,val3 = m.groups()
+        if val1 != None:
+            val = satori_unescape(val1)
+        elif val2 != None:
+            val = satori_unescape(val2)
+        elif val3 != None:
+            val = satori_unescape(val3)
+        else:
+            val = None
+        attrs[name.lower()] = val
+    return attrs
 
 def parse_satori_html(text):
-    parser = _MyHTMLParser()
-    parser.feed(text)
-    ret = parser.data["data"]
-    return ret
+    '''将satori消息解析为元素列表，一次线性扫描完成
+        列表中的str是文本，dict是元素：{"type":标签名,"attrs":属性,"data":子元素列表}
+        没有标签的纯文本不会建树'''
+    if "<" not in text:
+        if text == "":
+            return []
+        return [satori_unescape(text)]
+    root = []
+    stack = [] # 未闭合的元素：(标签名,子元素列表)
+    cur = root
+    pos = 0
+    for m in _SATORI_TAG_RE.finditer(text):
+        if m.start() > pos:
+            _satori_append_text(cur,text[pos:m.start()])
+        pos = m.end()
+        is_end,name,attrs,self_close = m.groups()
+        if name == None: # 注释
+            continue
+        name = name.lower()
+        if is_end:
+            # 闭合最近的同名元素，没有匹配的开始标签时忽略
+            for i in range(len(stack) - 1,-1,-1):
+                if stack[i][0] == name:
+                    del stack[i:]
+                    cur = stack[-1][1] if stack else root
+                    break
+            continue
+        node = {
+            "type":name,
+            "attrs":_satori_parse_attrs(attrs),
+            "data":[]
+        }
+        cur.append(node)
+        if not self_close:
+            stack.append((name,node["data"]))
+            cur = node["data"]
+    if pos < len(text):
+        _satori_append_text(cur,text[pos:])
+    return root
 
 def satori_to_plain(text):
     '''将text转为satori的纯文本'''
-    ret = ""
-    for ch in text:
-        if ch == "\"":
-            ret += "&quot;"
-        elif ch == "&":
-            ret += "&amp;"
-        elif ch == "<":
-            ret += "&lt;"
-        elif ch == ">":
-            ret += "&gt;"
-        else:
-            ret += ch
-    return ret
+    return satori_escape(text)
+
 
+# satori的数据模型，使用__slots__减少内存占用
+# to_dict直接生成satori的json对象，值为None的字段不输出，所以得到的dict不需要再经过remove_json_null
 
 class SatoriUser():
+    __slots__ = ("id","name","nick","avatar","is_bot")
     def __init__(self,id:str,name:str = None,avatar:str = None,is_bot:bool = None) -> None:
         self.id = id
         self.name = name
@@ -84,49 +157,59 @@ class SatoriUser():
         self.avatar = avatar
         self.is_bot = is_bot
     def to_dict(self) -> dict:
-        return {
-            "id":self.id,
-            "name":self.name,
-            "nick":self.nick,
-            "avatar":self.avatar,
-            "is_bot":self.is_bot,
-        }
+        ret = {"id":self.id}
+        if self.name != None:
+            ret["name"] = self.name
+        if self.nick != None:
+            ret["nick"] = self.nick
+        if self.avatar != None:
+            ret["avatar"] = self.avatar
+        if self.is_bot != None:
+            ret["is_bot"] = self.is_bot
+        return ret
     
 class SatoriGuildMember():
+    __slots__ = ("user","nick","avatar","joined_at")
     def __init__(self,user:SatoriUser = None,nick:str = None,avatar:str = None,joined_at:int = None) -> None:
         self.user = user
         self.nick = nick
         self.avatar = avatar
         self.joined_at = joined_at
     def to_dict(self) -> dict:
-        return {
-            "user":self.user.to_dict() if self.user else None,
-            "nick":self.nick,
-            "avatar":self.avatar,
-            "joined_at":self.joined_at,
-        }
+        ret = {}
+        if self.user != None:
+            ret["user"] = self.user.to_dict()
+        if self.nick != None:
+            ret["nick"] = self.nick
+        if self.avatar != None:
+            ret["avatar"] = self.avatar
+        if self.joined_at != None:
+            ret["joined_at"] = self.joined_at
+        return ret
     
 class SatoriGuildRole():
+    __slots__ = ("id","name")
     def __init__(self,id,name:str = None) -> None:
         self.id = id
         self.name = name
     def to_dict(self) -> dict:
-        return {
-            "id":self.id,
-            "name":self.name,
-        }
+        if self.name == None:
+            return {"id":self.id}
+        return {"id":self.id,"name":self.name}
 
 class SatoriGuild():
-    def __init__(self,id,name:str = None,avatar:str = None) -> None:
+    __slots__ = ("id","name","avatar")
+    def __init__(self,id:str,name:str = None,avatar:str = None) -> None:
         self.id = id
         self.name = name
         self.avatar = avatar
     def to_dict(self) -> dict:
-        return {
-            "id":self.id,
-            "name":self.name,
-            "avatar":self.avatar,
-        }
+        ret = {"id":self.id}
+        if self.name != None:
+            ret["name"] = self.name
+        if self.avatar != None:
+            ret["avatar"] = self.avatar
+        return ret
     
 class SatoriChannel():
     class ChannelType(Enum):
@@ -134,31 +217,21 @@ class SatoriChannel():
         DIRECT = 1
         CATEGORY = 2
         VOICE = 3
-        
+
+    __slots__ = ("id","type","name","parent_id")
     def __init__(self,id:str,type:ChannelType,name:str = None,parent_id:str = None) -> None:
         self.id = id
         self.type = type
         self.name = name
         self.parent_id = parent_id
     def to_dict(self) -> dict:
-        return {
-            "id":self.id,
-            "type":self.type.value,
-            "name":self.name,
-            "parent_id":self.parent_id,
-        }
-    
-class SatoriGuild():
-    def __init__(self,id:str,name:str = None,avatar:str = None) -> None:
-        self.id = id
-        self.name = name
-        self.avatar = avatar
-    def to_dict(self) -> dict:
-        return {
-            "id":self.id,
-            "name":self.name,
-            "avatar":self.avatar,
-        }
+        ret = {"id":self.id,"type":self.type.value}
+        if self.name != None:
+            ret["name"] = self.name
+        if self.parent_id != None:
+            ret["parent_id"] = self.parent_id
+        return ret
+
 class SatoriLogin():
     class LoginStatus(Enum):
         OFFLINE = 0
@@ -166,20 +239,25 @@ class SatoriLogin():
         CONNECT = 2
         DISCONNECT = 3
         RECONNECT = 4
+
+    __slots__ = ("status","user","self_id","platform")
     def __init__(self,status:LoginStatus,user:SatoriUser = None,self_id:str = None,platform:str = None) -> None:
         self.status = status
         self.user = user
         self.self_id = self_id
         self.platform = platform
     def to_dict(self) -> dict:
-        return {
-            "status":self.status.value,
-            "user":self.user.to_dict() if self.user else None,
-            "self_id":self.self_id,
-            "platform":self.platform,
-        }
+        ret = {"status":self.status.value}
+        if self.user != None:
+            ret["user"] = self.user.to_dict()
+        if self.self_id != None:
+            ret["self_id"] = self.self_id
+        if self.platform != None:
+            ret["platform"] = self.platform
+        return ret
     
 class SatoriMessage():
+    __slots__ = ("id","content","channel","guild","member","user","created_at","updated_at")
     def __init__(self,id:str,content:str,
                  channel:SatoriChannel = None,
                  guild:SatoriGuild = None,
@@ -196,18 +274,25 @@ class SatoriMessage():
         self.created_at = created_at
         self.updated_at = updated_at
     def to_dict(self) -> dict:
-        return {
-            "id":self.id,
-            "content":self.content,
-            "channel":self.channel.to_dict() if self.channel else None,
-            "guild":self.guild.to_dict() if self.guild else None,
-            "member":self.member.to_dict() if self.member else None,
-            "user":self.user.to_dict() if self.user else None,
-            "created_at":self.created_at,
-            "updated_at":self.updated_at,
-        }
+        ret = {"id":self.id}
+        if self.content != None:
+            ret["content"] = self.content
+        if self.channel != None:
+            ret["channel"] = self.channel.to_dict()
+        if self.guild != None:
+            ret["guild"] = self.guild.to_dict()
+        if self.member != None:
+            ret["member"] = self.member.to_dict()
+        if self.user != None:
+            ret["user"] = self.user.to_dict()
+        if self.created_at != None:
+            ret["created_at"] = self.created_at
+        if self.updated_at != None:
+            ret["updated_at"] = self.updated_at
+        return ret
 
 class SatoriPrivateMessageCreatedEvent():
+    __slots__ = ("id","type","platform","self_id","timestamp","channel","message","user")
     def __init__(self,id:int,platform:str,self_id:str,timestamp:int,channel:SatoriChannel,message:SatoriMessage,user:SatoriUser) -> None:
         self.id = id
         self.type = "message-created"
@@ -230,6 +315,7 @@ class SatoriPrivateMessageCreatedEvent():
         }
     
 class SatoriGroupMessageCreatedEvent():
+    __slots__ = ("id","type","platform","self_id","timestamp","channel","message","user","guild","member","role")
     def __init__(self,id:int,platform:str,self_id:str,timestamp:int,channel:SatoriChannel,message:SatoriMessage,user:SatoriUser,member:SatoriGuildMember,guild:SatoriGuild,role:SatoriGuildRole) -> None:
         self.id = id
         self.type = "message-created"
@@ -256,3 +342,26 @@ class SatoriGroupMessageCreatedEvent():
             "member":self.member.to_dict(),
             "role":self.role.to_dict(),
         }
+
+class SatoriGuildMemberAddedEvent():
+    __slots__ = ("id","type","platform","self_id","timestamp","guild","member","user")
+    def __init__(self,id:int,platform:str,self_id:str,timestamp:int,guild:SatoriGuild,member:SatoriGuildMember,user:SatoriUser) -> None:
+        self.id = id
+        self.type = "guild-member-added"
+        self.platform = platform
+        self.self_id = self_id
+        self.timestamp = timestamp
+        self.guild = guild
+        self.member = member
+        self.user = user
+    def to_dict(self) -> dict:
+        return {
+            "id":self.id,
+            "type":self.type,
+            "platform":self.platform,
+            "self_id":self.self_id,
+            "timestamp":self.timestamp,
+            "guild":self.guild.to_dict(),
+            "member":self.member.to_dict(),
+            "user":self.user.to_dict(),
+        }
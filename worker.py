@@ -0,0 +1,291 @@
+'''在单独的进程中运行适配器，让繁忙的平台(比如米游社的protobuf解析)不影响其它适配器和http接口
+    bot配置中写"worker":true即可启用，satori中使用的是WorkerAdapter这个代理，它和真正的适配器有相同的函数
+    进程之间通过multiprocessing.Pipe通信，每条消息是一个json数组：
+        主进程 -> 工作进程：
+            ["call",调用id,函数名,参数列表]    调用适配器的函数
+            ["pull",最多几个事件]              取事件，工作进程有事件时回复events，同一时间只有一个pull
+            ["stop"]                           释放适配器并退出
+        工作进程 -> 主进程：
+            ["ready",函数名列表]               适配器的init_after已经完成，列出适配器实现了哪些函数
+            ["ret",调用id,返回值]
+            ["err",调用id,错误信息]
+            ["events",编码好的事件列表]
+    事件在工作进程中就已经编码好(见tool.encode_event)，主进程只需要拼上事件id
+    主进程只在需要事件时才去取，工作进程来不及发送的事件留在它自己的事件队列中，按event_queue的配置处理
+'''
+import asyncio
+import functools
+import inspect
+import multiprocessing
+import threading
+import traceback
+
+from tool import get_json_or, json_loads, json_dumps_bytes, encode_event
+from log import get_logger, setup_logging, current_config
+
+_log = get_logger("worker")
+
+# 可以通过进程代理调用的适配器函数，stats结尾的在适配器中是普通函数，其余是协程函数
+_PROXY_METHODS = (
+    "get_login",
+    "get_guild_member",
+    "create_message",
+    "get_channel_list",
+    "get_user",
+    "get_media_stats",
+    "get_ratelimit_stats",
+    "get_event_queue_stats",
+    "get_metrics",
+)
+
+# 工作进程意外退出后，等待多少秒再重新启动
+_RESTART_DELAY = 3
+
+
+class WorkerError(Exception):
+    '''工作进程中的调用失败，或者工作进程已经退出'''
+
+
+def _start_reader(conn,loop,on_message) -> threading.Thread:
+    '''在线程中阻塞读取管道，收到的消息交给事件循环处理，管道关闭时传入None
+        不使用add_reader，因为windows的事件循环不支持管道'''
+    def run():
+        while True:
+            try:
+                data = conn.recv_bytes()
+            except (EOFError,OSError):
+                break
+            loop.call_soon_threadsafe(on_message,json_loads(data))
+        loop.call_soon_threadsafe(on_message,None)
+    thread = threading.Thread(target=run,daemon=True)
+    thread.start()
+    return thread
+
+
+def _make_adapter(config:dict):
+    # 在工作进程中才导入适配器，主进程不需要加载用不到的平台
+    platform = config["platform"]
+    if platform == "onebot":
+        from onebot_adapter import AdapterOnebot
+        return AdapterOnebot(config)
+    elif platform == "kook":
+        from kook_adapter import AdapterKook
+        return AdapterKook(config)
+    elif platform == "mihoyo":
+        from mihoyo_adapter import AdapterMihoyo
+        return AdapterMihoyo(config)
+    elif platform == "qq":
+        from qq_adapter import AdapterQQ
+        return AdapterQQ(config)
+    raise ValueError("未知的平台 {}".format(platform))
+
+
+def _worker_main(conn,config:dict,log_config:dict) -> None:
+    '''工作进程的入口'''
+    setup_logging(log_config)
+    asyncio.run(_worker_serve(conn,config))
+
+
+async def _worker_serve(conn,config:dict) -> None:
+    loop = asyncio.get_running_loop()
+    messages = asyncio.Queue()
+    _start_reader(conn,loop,messages.put_nowait)
+    adapter = _make_adapter(config)
+    if hasattr(adapter,"init_after"):
+        await adapter.init_after()
+    tasks = set()
+
+    def send(msg) -> None:
+        try:
+            conn.send_bytes(json_dumps_bytes(msg))
+        except (OSError,ValueError):
+            pass # 主进程已经退出，下一次读取管道时会发现
+
+    def spawn(coro) -> None:
+        task = asyncio.create_task(coro)
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+
+    async def call(call_id:int,name:str,args:list) -> None:
+        try:
+            ret = getattr(adapter,name)(*args)
+            if inspect.isawaitable(ret):
+                ret = await ret
+            send(["ret",call_id,ret])
+        except Exception:
+            send(["err",call_id,traceback.format_exc()])
+
+    async def pull(max_count:int) -> None:
+        if hasattr(adapter,"get_events"):
+            bodies = await adapter.get_events(max_count)
+        else:
+            bodies = [encode_event(await adapter.get_msg())]
+        send(["events",bodies])
+
+    methods = [name for name in _PROXY_METHODS if hasattr(adapter,name)]
+    if hasattr(adapter,"get_events") or hasattr(adapter,"get_msg"):
+        methods.append("get_events")
+    send(["ready",methods])
+    try:
+        while True:
+            msg = await messages.get()
+            if msg == None or msg[0] == "stop":
+                break
+            if msg[0] == "call":
+                spawn(call(msg[1],msg[2],msg[3]))
+            elif msg[0] == "pull":
+                spawn(pull(msg[1]))
+    finally:
+        for task in list(tasks):
+            task.cancel()
+        if hasattr(adapter,"release"):
+            await adapter.release()
+        conn.close()
+
+
+class WorkerAdapter:
+    '''在工作进程中运行的适配器的代理，satori像使用普通适配器一样使用它
+        只有真正的适配器实现了的函数才会出现在代理上，所以satori中的hasattr判断依然有效
+        工作进程意外退出时会自动重启，期间的调用抛出WorkerError'''
+    def __init__(self,config = {}) -> None:
+        self._config = config
+        self._platform = config["platform"]
+        self._process = None
+        self._conn = None
+        self._ready = None # 本次启动的工作进程完成init_after时设置
+        self._calls = {} # 调用id -> Future
+        self._call_id = 0
+        self._events = []
+        self._events_ready = asyncio.Event()
+        self._pulling = False
+        self._is_stop = False
+        self._supervisor = None
+        self.restarts = 0
+
+    async def init_after(self) -> None:
+        '''启动工作进程，等到里面的适配器完成init_after'''
+        self._spawn()
+        self._supervisor = asyncio.create_task(self._supervise())
+        await asyncio.shield(self._ready)
+
+    async def release(self) -> None:
+        self._is_stop = True
+        self._send(["stop"])
+        if self._process != None:
+            await asyncio.to_thread(self._process.join)
+        if self._supervisor:
+            self._supervisor.cancel()
+
+    def _spawn(self) -> None:
+        ctx = multiprocessing.get_context("spawn")
+        parent_conn,child_conn = ctx.Pipe()
+        self._process = ctx.Process(target=_worker_main,args=(child_conn,self._config,current_config()),daemon=True,
+                                    name="satori-worker-{}".format(self._platform))
+        self._process.start()
+        child_conn.close()
+        self._conn = parent_conn
+        self._ready = asyncio.get_running_loop().create_future()
+        self._pulling = False
+        _start_reader(parent_conn,asyncio.get_running_loop(),functools.partial(self._on_message,parent_conn))
+
+    async def _supervise(self) -> None:
+        while True:
+            await asyncio.to_thread(self._process.join)
+            if self._is_stop:
+                return
+            _log.warning("%s的工作进程退出，exitcode=%s，%s秒后重启",self._platform,self._process.exitcode,_RESTART_DELAY)
+            self.restarts += 1
+            await asyncio.sleep(_RESTART_DELAY)
+            self._spawn()
+
+    def _send(self,msg) -> bool:
+        if self._conn == None:
+            return False
+        try:
+            self._conn.send_bytes(json_dumps_bytes(msg))
+            return True
+        except (OSError,ValueError):
+            return False
+
+    def _on_message(self,conn,msg) -> None:
+        if conn is not self._conn:
+            return # 已经退出的工作进程留下的消息
+        if msg == None:
+            # 管道断开，工作进程已经退出
+            self._conn = None
+            for fut in self._calls.values():
+                if not fut.done():
+                    fut.set_exception(WorkerError("worker:{}的工作进程已经退出".format(self._platform)))
+            self._calls.clear()
+            if not self._ready.done():
+                self._ready.set_exception(WorkerError("worker:{}的工作进程启动失败".format(self._platform)))
+                self._ready.exception()
+            # 让等待事件的get_events在重启后重新发出pull
+            self._pulling = False
+            self._events_ready.set()
+            return
+        kind = msg[0]
+        if kind == "events":
+            self._events += msg[1]
+            self._pulling = False
+            self._events_ready.set()
+        elif kind == "ret" or kind == "err":
+            fut = self._calls.pop(msg[1],None)
+            if fut == None or fut.done():
+                return
+            if kind == "ret":
+                fut.set_result(msg[2])
+            else:
+                fut.set_exception(WorkerError(msg[2]))
+        elif kind == "ready":
+            for name in msg[1]:
+                if name == "get_events":
+                    continue
+                setattr(self,name,self._make_proxy(name))
+            if "get_events" in msg[1]:
+                self.get_events = self._get_events
+            self._ready.set_result(None)
+
+    def _make_proxy(self,name:str):
+        async def proxy(*args):
+            return await self._call(name,list(args))
+        proxy.__name__ = name
+        return proxy
+
+    async def _call(self,name:str,args:list):
+        self._call_id += 1
+        call_id = self._call_id
+        fut = asyncio.get_running_loop().create_future()
+        self._calls[call_id] = fut
+        if not self._send(["call",call_id,name,args]):
+            del self._calls[call_id]
+            raise WorkerError("worker:{}的工作进程不可用".format(self._platform))
+        return await fut
+
+    async def _get_events(self,max_count:int) -> list:
+        '''阻塞并等待工作进程送来的事件，一次返回一批'''
+        while not self._events:
+            if not self._pulling and self._ready.done() and self._send(["pull",max_count]):
+                self._pulling = True
+            self._events_ready.clear()
+            if self._pulling:
+                await self._events_ready.wait()
+            else:
+                # 工作进程正在重启
+                await asyncio.sleep(0.1)
+        bodies = self._events
+        self._events = []
+        return bodies
+
+    def get_worker_stats(self) -> dict:
+        return {
+            "pid":self._process.pid if self._process != None else None,
+            "alive":self._process != None and self._process.is_alive(),
+            "restarts":self.restarts,
+            "pending_calls":len(self._calls),
+        }
+
+
+def use_worker(config:dict) -> bool:
+    '''bot配置中是否要求在工作进程中运行'''
+    return get_json_or(config,"worker",False)